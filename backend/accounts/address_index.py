@@ -0,0 +1,48 @@
+"""
+Contains the address index a sync uses to find the peers transfers
+are sent to, without querying the database for every transfer
+"""
+
+from django.contrib.auth.models import User
+
+from backend.accounts.models import CryptoAddress
+
+
+class AddressIndex(object):
+    """
+    Maps the crypto addresses of a user to the peers they belong to.
+    All addresses are loaded with one query when the index is created,
+    so create one index per sync.
+
+    Keyword arguments:
+    owner -- the user whose addresses are indexed
+    """
+
+    def __init__(self, owner: User):
+        self.by_address_str = {}
+        self.by_address = {}
+        for address_str, address, peer_id in CryptoAddress.objects.filter(
+                peer__owner=owner).values_list("address_str", "address",
+                                               "peer_id"):
+            self.by_address_str[address_str] = peer_id
+            self.by_address.setdefault(address, peer_id)
+
+    def __len__(self):
+        return len(self.by_address_str)
+
+    def resolve(self, currency: str, address: str) -> int:
+        """
+        Returns the id of the peer an address belongs to or None if
+        the address is unknown. Addresses stored for another coin
+        are found as well, e.g. a BCH address that was added as BTC.
+
+        Keyword arguments:
+        currency -- symbol of the coin sent to the address
+        address -- the address
+        """
+        if not address:
+            return None
+        peer_id = self.by_address_str.get("{}:{}".format(currency, address))
+        if peer_id is None:
+            peer_id = self.by_address.get(address)
+        return peer_id
@@ -1,6 +1,8 @@
 from django.contrib import admin
 from backend.accounts.models import CryptoAddress, Peer, Account
+from backend.accounts.models import ExchangeMarkets
 
 admin.site.register(CryptoAddress)
 admin.site.register(Peer)
 admin.site.register(Account)
+admin.site.register(ExchangeMarkets)
@@ -0,0 +1,85 @@
+"""
+Contains the pool of ccxt exchange clients of this process. Pooled
+clients keep their HTTP session, their market maps and ccxt's request
+throttling state between syncs of the same account.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+import ccxt
+from django.conf import settings
+
+from backend.accounts.markets import get_markets
+
+# clients of this process by (service, api key), least recently used
+# first, and the pid they were created in, see get_exchange
+POOL = OrderedDict()
+POOL_PID = None
+_POOL_LOCK = threading.Lock()
+
+
+def _close_exchange(exchange: ccxt.Exchange):
+    session = getattr(exchange, "session", None)
+    if session is not None:
+        session.close()
+
+
+def get_exchange(service_type: str, api_key: str,
+                 api_secret: str) -> ccxt.Exchange:
+    """
+    Returns the pooled client of an exchange account, creating it if
+    needed. At most EXCHANGE_POOL_SIZE clients are kept, the least
+    recently used one is closed when the pool is full. The pool is
+    emptied after a fork, e.g. in a Celery prefork worker, because
+    connections can't be shared between processes.
+
+    Arguments:
+        service_type {str} -- the ccxt id of the exchange
+        api_key {str} -- the API key of the account
+        api_secret {str} -- the API secret of the account
+
+    Returns:
+        ccxt.Exchange -- the client
+    """
+    global POOL_PID
+    key = (service_type, api_key)
+    with _POOL_LOCK:
+        if POOL_PID != os.getpid():
+            # the clients belong to the parent process, don't close them
+            POOL.clear()
+            POOL_PID = os.getpid()
+
+        exchange = POOL.get(key)
+        if exchange is not None and exchange.secret != api_secret:
+            # the account's secret was changed
+            _close_exchange(POOL.pop(key))
+            exchange = None
+
+        if exchange is None:
+            exchange = getattr(ccxt, service_type)({
+                "api_key": api_key,
+                "secret": api_secret
+            })
+            POOL[key] = exchange
+            while len(POOL) > getattr(settings, "EXCHANGE_POOL_SIZE", 16):
+                _close_exchange(POOL.popitem(last=False)[1])
+        else:
+            POOL.move_to_end(key)
+        return exchange
+
+
+def load_cached_markets(exchange: ccxt.Exchange) -> dict:
+    """
+    Hands the cached markets to the exchange instead of letting ccxt
+    download them, see get_markets. A pooled client keeps its market
+    maps until the cached markets change.
+
+    Returns:
+        dict -- the markets by symbol
+    """
+    markets = get_markets(exchange.id)
+    if getattr(exchange, "cached_markets", None) is not markets:
+        exchange.set_markets(markets)
+        exchange.cached_markets = markets
+    return markets
@@ -0,0 +1,93 @@
+"""
+Contains the cache of the exchanges' market metadata. Markets are
+stored in the ExchangeMarkets table and refreshed by a Celery beat
+task, so neither syncs nor GraphQL queries have to download them.
+"""
+
+import json
+from datetime import timedelta
+import ccxt
+from django.conf import settings
+from django.utils.timezone import now
+from requests.exceptions import RequestException
+
+from backend.accounts.models import Account, ExchangeMarkets
+
+# markets parsed in this process: service id -> (updated, markets)
+PARSED_MARKETS = {}
+
+
+def refresh_markets(service_id: str) -> dict:
+    """
+    Downloads the markets of an exchange and stores them
+
+    Arguments:
+        service_id {str} -- the ccxt id of the exchange
+
+    Returns:
+        dict -- the markets by symbol
+    """
+    markets = getattr(ccxt, service_id)().load_markets()
+    entry, _ = ExchangeMarkets.objects.update_or_create(
+        service_id=service_id,
+        defaults={
+            "markets": json.dumps(markets, default=str),
+            "updated": now()
+        })
+    PARSED_MARKETS[service_id] = (entry.updated, markets)
+    return markets
+
+
+def get_markets(service_id: str, refresh: bool = True) -> dict:
+    """
+    Returns the cached markets of an exchange. Markets that were never
+    downloaded are downloaded once, e.g. before the beat task first
+    ran. Markets older than MARKETS_TTL seconds are downloaded again
+    if refresh is True, if that fails the old markets are returned.
+
+    Arguments:
+        service_id {str} -- the ccxt id of the exchange
+
+    Keyword Arguments:
+        refresh {bool} -- download stale markets and raise if missing
+                          markets can't be downloaded
+                          (default: {True})
+
+    Returns:
+        dict -- the markets by symbol, empty if there are none
+    """
+    updated = ExchangeMarkets.objects.filter(
+        service_id=service_id).values_list(
+            "updated", flat=True).first()
+
+    ttl = getattr(settings, "MARKETS_TTL", 86400)
+    if updated is None:
+        download = refresh or hasattr(ccxt, service_id)
+    else:
+        download = refresh and updated < now() - timedelta(seconds=ttl)
+    if download:
+        try:
+            return refresh_markets(service_id)
+        except (ccxt.BaseError, RequestException) as err:
+            if updated is None and refresh:
+                raise
+            print("Using the cached markets of {}: {}".format(
+                service_id, err))
+
+    if updated is None:
+        return {}
+
+    parsed = PARSED_MARKETS.get(service_id)
+    if parsed is None or parsed[0] != updated:
+        entry = ExchangeMarkets.objects.get(service_id=service_id)
+        parsed = (entry.updated, json.loads(entry.markets))
+        PARSED_MARKETS[service_id] = parsed
+    return parsed[1]
+
+
+def get_market_services() -> list:
+    """Returns the ids of all supported exchanges with markets in ccxt"""
+    return [
+        service[0] for service in Account.SERVICE_TYPES
+        if service[2] == "api" and hasattr(ccxt, service[0])
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 2.0.5 on 2026-10-18 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0007_auto_20180510_1515'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExchangeMarkets',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('service_id', models.CharField(max_length=50, unique=True)),
+                ('markets', models.TextField()),
+                ('updated', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.0.5 on 2026-10-18 18:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0008_exchangemarkets'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cryptoaddress',
+            name='address',
+            field=models.CharField(db_index=True, max_length=256),
+        ),
+    ]
@@ -48,7 +48,7 @@ class CryptoAddress(models.Model):
 
     coin = models.ForeignKey(Coin, on_delete=models.PROTECT)
 
-    address = models.CharField(max_length=256)
+    address = models.CharField(max_length=256, db_index=True)
 
     address_str = models.CharField(max_length=300, blank=True)
 
@@ -113,3 +113,23 @@ class Account(Peer):
         '''
         super(Account, self).save(force_insert, force_update, using,
                                   update_fields, "Account")
+
+
+class ExchangeMarkets(models.Model):
+    """
+    The market metadata of an exchange as returned by ccxt's
+    load_markets, so it doesn't have to be downloaded for every sync
+    or query. See backend/accounts/markets.py
+    """
+    id = models.AutoField(primary_key=True)
+
+    # the ccxt id of the exchange, equals Account.service_type
+    service_id = models.CharField(max_length=50, unique=True)
+
+    # the markets as JSON
+    markets = models.TextField()
+
+    updated = models.DateTimeField()
+
+    def __str__(self):
+        return "{} {}".format(self.service_id, self.updated)
@@ -1,12 +1,12 @@
 import json
 import graphene
-import ccxt
 import celery
 from django.db.models import ObjectDoesNotExist
 
 from graphene_django.types import DjangoObjectType
 
 from backend.accounts.models import Account, CryptoAddress, Peer
+from backend.accounts.markets import get_markets
 from backend.coins.models import Coin
 from backend.accounts.tasks import async_update_account_trx
 
@@ -106,22 +106,19 @@ class Query(object):
         if not info.context.user.is_authenticated:
             return l
 
-        service_id = kwargs.get('service')
-        try:
-            exchange = getattr(ccxt, service_id)()
-            markets = exchange.load_markets()
-            for m in markets:
-                market = markets[m]
-                if market:
-                    s = SupportedSymbol()
-                    s.symbol = market["symbol"]
-                    s.base = market["base"]
-                    s.quote = market["quote"]
-                    l.append(s)
-        except AttributeError:
-            # coinbase will land here
-            # it is not supported by ccxt and will receive special treatment
-            pass
+        # the cached markets are used, they are refreshed by the
+        # async_update_exchange_markets task and only downloaded here
+        # if the task hasn't run yet. Coinbase is not supported by ccxt
+        # and has no markets.
+        markets = get_markets(kwargs.get('service'), refresh=False)
+        for m in markets:
+            market = markets[m]
+            if market:
+                s = SupportedSymbol()
+                s.symbol = market["symbol"]
+                s.base = market["base"]
+                s.quote = market["quote"]
+                l.append(s)
 
         return l
 
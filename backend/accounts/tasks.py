@@ -4,6 +4,7 @@ from __future__ import absolute_import, unicode_literals
 
 from backend.celery import app
 from backend.accounts.models import Account
+from backend.accounts.markets import get_market_services, refresh_markets
 
 from backend.transactions.fetchers.generic_exchange import update_exchange_trx_generic
 from backend.transactions.fetchers.coinbase import update_coinbase_trx
@@ -17,8 +18,49 @@ def async_update_account_trx(self, account_id):
     print("Starting task update transactions for account: ", account.name)
 
     self.update_state(state='RUNNING', meta={'current': 0, 'total': 3})
+
+    def progress(processed: int, imported: int):
+        self.update_state(
+            state='RUNNING',
+            meta={
+                'current': 1,
+                'total': 3,
+                'processed': processed,
+                'imported': imported
+            })
+
     if account.service_type == "coinbase":
-        update_coinbase_trx(account)
+        result = update_coinbase_trx(account, progress)
     else:
-        update_exchange_trx_generic(account)
-    self.update_state(state='SUCCESS', meta={'current': 3, 'total': 3})
+        result = update_exchange_trx_generic(account, progress)
+    self.update_state(
+        state='SUCCESS', meta=dict(result, current=3, total=3))
+
+    # markets that failed are resumed by the next sync
+    return result
+
+
+@app.task(bind=True)
+def async_update_exchange_markets(self):
+    """Starts a celery async task to refresh the cached exchange markets"""
+    services = get_market_services()
+    for idx, service_id in enumerate(services):
+        self.update_state(
+            state='RUNNING',
+            meta={
+                'current': idx,
+                'total': len(services)
+            })
+        try:
+            markets = refresh_markets(service_id)
+            print("{}: {} markets".format(service_id, len(markets)))
+        except Exception as err:  # pylint: disable=W0703
+            # keep the old markets, the next run will try again
+            print("Could not refresh markets of {}: {}".format(
+                service_id, err))
+    self.update_state(
+        state='SUCCESS',
+        meta={
+            'current': len(services),
+            'total': len(services)
+        })
@@ -0,0 +1,40 @@
+"""Contains all tests for the address index"""
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from mixer.backend.django import mixer
+
+from ..address_index import AddressIndex
+
+pytestmark = pytest.mark.django_db
+
+
+def test_address_index():
+    """
+    Tests that the addresses of the owner are loaded with one query
+    and resolved with and without matching coin
+    """
+    user = mixer.blend("auth.User")
+    peer = mixer.blend("accounts.Peer", owner=user)
+    ltc = mixer.blend("coins.Coin", symbol="LTC")
+    btc = mixer.blend("coins.Coin", symbol="BTC")
+    mixer.blend(
+        "accounts.CryptoAddress", peer=peer, coin=ltc, address="LcnAddress1")
+    mixer.blend(
+        "accounts.CryptoAddress", peer=peer, coin=btc, address="1BtcAddress")
+
+    # addresses of other users are not indexed
+    other = mixer.blend("accounts.Peer")
+    mixer.blend(
+        "accounts.CryptoAddress", peer=other, coin=ltc, address="LcnAddress2")
+
+    with CaptureQueriesContext(connection) as queries:
+        index = AddressIndex(user)
+    assert len(queries.captured_queries) == 1
+
+    assert len(index) == 2
+    assert index.resolve("LTC", "LcnAddress1") == peer.id
+    assert index.resolve("BCH", "1BtcAddress") == peer.id
+    assert index.resolve("LTC", "LcnAddress2") is None
+    assert index.resolve("LTC", None) is None
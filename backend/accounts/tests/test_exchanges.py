@@ -0,0 +1,64 @@
+"""Contains all tests for the pool of exchange clients"""
+
+import json
+import pytest
+from django.utils.timezone import now
+from _pytest.monkeypatch import MonkeyPatch
+from mixer.backend.django import mixer
+
+import backend.accounts.exchanges as exchanges
+
+from ..exchanges import get_exchange, load_cached_markets
+
+pytestmark = pytest.mark.django_db
+
+
+def test_get_exchange(monkeypatch: MonkeyPatch, settings):
+    """
+    Tests that clients are reused per account, the least recently used
+    one is evicted and the pool is emptied in a forked process
+    """
+    settings.EXCHANGE_POOL_SIZE = 2
+
+    binance = get_exchange("binance", "key1", "secret1")
+    assert binance.apiKey == "key1"
+    assert get_exchange("binance", "key1", "secret1") is binance
+    cryptopia = get_exchange("cryptopia", "key1", "secret1")
+    assert cryptopia is not binance
+    assert get_exchange("binance", "key2", "secret2") is not binance
+
+    # binance was used more recently than cryptopia
+    assert list(exchanges.POOL) == [("cryptopia", "key1"),
+                                    ("binance", "key2")]
+    assert get_exchange("binance", "key1", "secret1") is not binance
+
+    # a changed secret creates a new client
+    pooled = get_exchange("binance", "key2", "secret2")
+    assert get_exchange("binance", "key2", "secret3") is not pooled
+
+    monkeypatch.setattr(exchanges, "POOL_PID", -1)
+    assert get_exchange("binance", "key2", "secret3") is not pooled
+    assert len(exchanges.POOL) == 1
+
+
+def test_load_cached_markets():
+    """Tests that a pooled client keeps its markets until they change"""
+    mixer.blend(
+        "accounts.ExchangeMarkets",
+        service_id="binance",
+        markets=json.dumps({
+            "ETH/BTC": {
+                "symbol": "ETH/BTC",
+                "base": "ETH",
+                "quote": "BTC"
+            }
+        }),
+        updated=now())
+
+    exchange = get_exchange("binance", "key", "secret")
+    markets = load_cached_markets(exchange)
+    assert list(exchange.markets) == ["ETH/BTC"]
+
+    exchange.markets = None
+    assert load_cached_markets(exchange) is markets
+    assert exchange.markets is None
@@ -0,0 +1,80 @@
+"""Contains all tests for the market metadata cache"""
+
+import json
+from datetime import timedelta
+import pytest
+import ccxt
+from django.utils.timezone import now
+from _pytest.monkeypatch import MonkeyPatch
+from mixer.backend.django import mixer
+
+from backend.accounts.models import ExchangeMarkets
+
+from ..markets import get_markets, get_market_services
+
+pytestmark = pytest.mark.django_db
+
+MARKETS = {"ETH/BTC": {"symbol": "ETH/BTC", "base": "ETH", "quote": "BTC"}}
+
+
+def test_get_markets(monkeypatch: MonkeyPatch, settings):
+    """
+    Tests that markets are downloaded once, read from the table until
+    they are stale and that stale markets are used if a refresh fails
+    """
+    settings.MARKETS_TTL = 3600
+    downloads = []
+
+    def load_markets(self):
+        downloads.append(self.id)
+        return MARKETS
+
+    monkeypatch.setattr(ccxt.binance, "load_markets", load_markets)
+
+    # missing markets are downloaded even without refresh
+    assert get_markets("binance", refresh=False) == MARKETS
+    assert get_markets("binance") == MARKETS
+    assert downloads == ["binance"]
+
+    ExchangeMarkets.objects.filter(service_id="binance").update(
+        updated=now() - timedelta(hours=2))
+    assert get_markets("binance", refresh=False) == MARKETS
+    assert get_markets("binance") == MARKETS
+    assert downloads == ["binance", "binance"]
+
+    def fail_load_markets(self):
+        raise ccxt.ExchangeNotAvailable("down")
+
+    monkeypatch.setattr(ccxt.binance, "load_markets", fail_load_markets)
+    ExchangeMarkets.objects.filter(service_id="binance").update(
+        updated=now() - timedelta(hours=2))
+    assert get_markets("binance") == MARKETS
+
+    monkeypatch.setattr(ccxt.kraken, "load_markets", fail_load_markets)
+    assert get_markets("kraken", refresh=False) == {}
+    with pytest.raises(ccxt.ExchangeNotAvailable):
+        get_markets("kraken")
+    assert get_markets("unknown", refresh=False) == {}
+
+
+def test_get_markets_reloads_changes():
+    """Tests that markets changed by another process are parsed again"""
+    entry = mixer.blend(
+        "accounts.ExchangeMarkets",
+        service_id="kraken",
+        markets=json.dumps(MARKETS),
+        updated=now())
+    assert get_markets("kraken") == MARKETS
+
+    entry.markets = json.dumps({})
+    entry.updated = now()
+    entry.save()
+    assert get_markets("kraken") == {}
+
+
+def test_get_market_services():
+    """Tests that only services with an API supported by ccxt are listed"""
+    services = get_market_services()
+    assert "binance" in services
+    assert "coinbase" not in services
+    assert "livecoin" not in services
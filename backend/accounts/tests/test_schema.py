@@ -1,5 +1,7 @@
+from datetime import timedelta
 import pytest
 import ccxt
+from django.utils.timezone import now
 from mixer.backend.django import mixer
 from django.core.exceptions import ObjectDoesNotExist
 from django.contrib.auth.models import AnonymousUser
@@ -7,7 +9,7 @@ from django.test import RequestFactory
 
 from ...test_utils.utils import mock_resolve_info
 
-from backend.accounts.models import Account, CryptoAddress
+from backend.accounts.models import Account, CryptoAddress, ExchangeMarkets
 from .. import schema
 
 # We need to do this so that writing to the DB is possible in our tests.
@@ -132,7 +134,7 @@ def test_resolve_supported_services():
     assert len(res) > 0, "Should return more than one service"
 
 
-def test_resolve_supported_symbols():
+def test_resolve_supported_symbols(monkeypatch):
     query = schema.Query()
 
     req = RequestFactory().get("/")
@@ -144,9 +146,28 @@ def test_resolve_supported_symbols():
     assert len(res) == 0, "User not logged in, should return 0 symbols"
 
     req.user = mixer.blend("auth.User")
+    monkeypatch.setattr(
+        ccxt.binance, "load_markets", lambda self: {
+            "ETH/BTC": {
+                "symbol": "ETH/BTC",
+                "base": "ETH",
+                "quote": "BTC"
+            }
+        })
+    res = query.resolve_supported_symbols(resolveInfo,
+                                          **{"service": "binance"})
+    assert len(res) == 1, "No cached markets, should download them once"
+
+    def fail_load_markets(self):
+        raise AssertionError("Should not download markets")
+
+    monkeypatch.setattr(ccxt.binance, "load_markets", fail_load_markets)
+    ExchangeMarkets.objects.filter(service_id="binance").update(
+        updated=now() - timedelta(days=30))
     res = query.resolve_supported_symbols(resolveInfo,
                                           **{"service": "binance"})
     assert len(res) > 0, "User logged in, should return at least one symbol"
+    assert res[0].base == "ETH"
 
 
 def test_create_account_mutation():
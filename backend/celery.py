@@ -17,4 +17,11 @@ app.conf.beat_schedule = {
             'task_id': "task_update_coins"
         },
     },
+    'update-exchange-markets-every-6-hours': {
+        'task': 'backend.accounts.tasks.async_update_exchange_markets',
+        'schedule': 21600.0,  # 6 hours
+        'options': {
+            'task_id': "task_update_exchange_markets"
+        },
+    },
 }
@@ -1,5 +1,6 @@
 '''Contains all database models for the coins django app'''
 from django.contrib import admin
-from backend.coins.models import Coin
+from backend.coins.models import Coin, PriceCandle
 
 admin.site.register(Coin)
+admin.site.register(PriceCandle)
@@ -2,4 +2,10 @@ from django.apps import AppConfig
 
 
 class CoinsConfig(AppConfig):
-    name = 'coins'
+    name = 'backend.coins'
+
+    def ready(self):
+        # the price lookups and coin updates of every process use
+        # the pooled HTTP session
+        from backend.utils.http import use_pooled_session
+        use_pooled_session()
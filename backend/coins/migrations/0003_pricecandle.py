@@ -0,0 +1,28 @@
+# Generated by Django 2.0.5 on 2026-10-18 12:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('coins', '0002_auto_20180510_1515'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceCandle',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('symbol', models.CharField(max_length=10)),
+                ('quote', models.CharField(max_length=10)),
+                ('period', models.CharField(choices=[('day', 'Day'), ('hour', 'Hour')], default='day', max_length=4)),
+                ('bucket', models.DateTimeField()),
+                ('close', models.DecimalField(decimal_places=15, max_digits=30)),
+            ],
+            options={
+                'ordering': ('symbol', 'quote', 'bucket'),
+                'unique_together': {('symbol', 'quote', 'period', 'bucket')},
+            },
+        ),
+    ]
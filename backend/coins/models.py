@@ -19,3 +19,32 @@ class Coin(models.Model):
     def __str__(self):
         '''Assembles a string description for this object'''
         return "{} - {}".format(self.symbol, self.full_name)
+
+
+class PriceCandle(models.Model):
+    '''
+    Database model for the price of a symbol in a quote currency
+    over one period (a day or an hour). The bucket is the UTC start
+    of the period.
+    '''
+    PERIOD_DAY = "day"
+    PERIOD_HOUR = "hour"
+    PERIODS = ((PERIOD_DAY, "Day"), (PERIOD_HOUR, "Hour"))
+
+    class Meta:
+        ordering = ("symbol", "quote", "bucket")
+        unique_together = (("symbol", "quote", "period", "bucket"), )
+
+    id = models.AutoField(primary_key=True)
+    symbol = models.CharField(max_length=10)
+    quote = models.CharField(max_length=10)
+    period = models.CharField(
+        max_length=4, choices=PERIODS, default=PERIOD_DAY)
+    bucket = models.DateTimeField()
+    close = models.DecimalField(max_digits=30, decimal_places=15)
+
+    def __str__(self):
+        '''Assembles a string description for this object'''
+        return "{}/{} {} {}".format(self.symbol, self.quote,
+                                    self.bucket.isoformat(),
+                                    float(self.close))
@@ -5,6 +5,7 @@ import cryptocompare
 
 from backend.celery import app
 from backend.coins.models import Coin
+from backend.utils.http import get_http_stats
 
 
 @app.task(bind=True)
@@ -54,4 +55,6 @@ def async_update_supported_coins(self):
             print_counter = 0
 
     print("new: {} updated: {}".format(new_coins, updated))
+    print("HTTP requests: {requests} connections: {connections}".format(
+        **get_http_stats()))
     self.update_state(state='SUCCESS', meta={'current': 100, 'total': 100})
@@ -1,7 +1,9 @@
 '''Contains all model tests for this application'''
+from datetime import datetime, timezone
 import pytest
+from django.db import IntegrityError
 from mixer.backend.django import mixer
-from backend.coins.models import Coin
+from backend.coins.models import Coin, PriceCandle
 
 pytestmark = pytest.mark.django_db
 
@@ -19,3 +21,41 @@ def test_coin_str_func():
         "coins.Coin", cc_id=50, symbol="BTC", full_name="Bitcoin")
 
     assert coin.__str__() == name, "Should be the coins's name"
+
+
+def test_price_candle_str_func():
+    '''Test PriceCandle object string function'''
+    candle: PriceCandle = mixer.blend(
+        "coins.PriceCandle",
+        symbol="BTC",
+        quote="EUR",
+        period=PriceCandle.PERIOD_DAY,
+        bucket=datetime(2017, 12, 11, tzinfo=timezone.utc),
+        close=13006.11)
+
+    assert str(candle) == "BTC/EUR 2017-12-11T00:00:00+00:00 13006.11"
+
+
+def test_price_candle_unique():
+    '''There can only be one candle per pair, period and bucket'''
+    bucket = datetime(2017, 12, 11, tzinfo=timezone.utc)
+    mixer.blend(
+        "coins.PriceCandle",
+        symbol="BTC",
+        quote="EUR",
+        period=PriceCandle.PERIOD_DAY,
+        bucket=bucket)
+    mixer.blend(
+        "coins.PriceCandle",
+        symbol="BTC",
+        quote="EUR",
+        period=PriceCandle.PERIOD_HOUR,
+        bucket=bucket)
+
+    with pytest.raises(IntegrityError):
+        mixer.blend(
+            "coins.PriceCandle",
+            symbol="BTC",
+            quote="EUR",
+            period=PriceCandle.PERIOD_DAY,
+            bucket=bucket)
@@ -0,0 +1,39 @@
+"""Fixtures shared by all tests"""
+
+from collections import OrderedDict
+import pytest
+from _pytest.monkeypatch import MonkeyPatch
+from diskcache import FanoutCache
+
+import backend.accounts.exchanges as exchanges
+import backend.utils.utils as utils
+
+
+@pytest.fixture(autouse=True)
+def price_cache(monkeypatch: MonkeyPatch, tmpdir, settings):
+    """
+    Give every test empty price caches and fetch prices sequentially,
+    so patching get_price_history is enough to stay offline
+    """
+    settings.PRICE_ASYNC_REQUESTS = False
+    cache = FanoutCache(str(tmpdir.join("diskcache")), cull_limit=0)
+    monkeypatch.setattr(utils, "CACHE", cache)
+    monkeypatch.setattr(utils, "MEMORY_CACHE", None)
+    return cache
+
+
+@pytest.fixture(autouse=True)
+def rate_limits(tmpdir, settings):
+    """
+    Give every test fresh rate limiters and retries that don't slow it
+    down
+    """
+    settings.RATE_LIMIT_DIR = str(tmpdir.join("ratelimit"))
+    settings.EXCHANGE_RATE_LIMIT_BURST = 100
+    settings.EXCHANGE_RETRY_BACKOFF = 0
+
+
+@pytest.fixture(autouse=True)
+def exchange_pool(monkeypatch: MonkeyPatch):
+    """Give every test an empty pool of exchange clients"""
+    monkeypatch.setattr(exchanges, "POOL", OrderedDict())
@@ -40,7 +40,7 @@ INSTALLED_APPS = [
     'django.contrib.contenttypes', 'django.contrib.sessions',
     'django.contrib.messages', 'django.contrib.staticfiles',
     'django_celery_beat', 'rest_framework', 'corsheaders', 'backend.accounts',
-    'backend.coins', 'backend.transactions', 'backend.user_profile',
+    'backend.coins.apps.CoinsConfig', 'backend.transactions', 'backend.user_profile',
     'graphene_django', 'taggit'
 ]
 
@@ -158,4 +158,113 @@ CELERY_BROKER_URL = config['DEFAULT']['celery_broker_url']
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_RESULT_BACKEND = config['DEFAULT']['celery_db']
 CELERY_TASK_SERIALIZER = 'json'
-CELERY_TRACK_STARTED = True
\ No newline at end of file
+CELERY_TRACK_STARTED = True
+
+# Exchanges that need one request per market (e.g. Binance) only poll
+# the markets an account is likely to trade in, see select_markets.
+# All markets are checked if the last full sweep is older than this
+# many seconds.
+EXCHANGE_FULL_SWEEP_INTERVAL = 604800
+
+# Requests to an exchange are rate limited per exchange and API key
+# across all workers on this host with ccxt's rateLimit. The state of
+# the limiters is kept in RATE_LIMIT_DIR. EXCHANGE_RATE_LIMIT_BURST
+# requests may be sent at once after a pause.
+RATE_LIMIT_DIR = "/tmp/crypternity/ratelimit"
+EXCHANGE_RATE_LIMIT_BURST = 1
+
+# Seconds the market metadata of an exchange is used before a sync
+# downloads it again. It is refreshed every 6 hours by Celery beat.
+MARKETS_TTL = 86400
+
+# Fetch the markets of exchanges that need one request per market
+# concurrently with ccxt's asyncio variant, at most
+# EXCHANGE_ASYNC_CONCURRENCY at a time
+EXCHANGE_ASYNC_FETCH = False
+EXCHANGE_ASYNC_CONCURRENCY = 4
+
+# Every worker process keeps the ccxt clients of up to this many
+# exchange accounts, so their sessions and markets are reused
+EXCHANGE_POOL_SIZE = 16
+
+# Requests per second of all workers syncing the same Coinbase account.
+# With COINBASE_CONCURRENT_SYNC the wallets of an account are fetched
+# by COINBASE_SYNC_WORKERS threads in parallel before they are stored.
+COINBASE_RATE_LIMIT = 3.0
+COINBASE_CONCURRENT_SYNC = False
+COINBASE_SYNC_WORKERS = 4
+
+# Derive the book prices of Coinbase transactions from the fiat values
+# Coinbase provides, only the BTC leg is converted with the BTC rate of
+# the day. Book prices are looked up like for other exchanges otherwise.
+COINBASE_NATIVE_VALUATION = True
+
+# Timeouts and network errors of exchange requests are retried this
+# many times, waiting EXCHANGE_RETRY_BACKOFF seconds before the first
+# retry and twice as long before every further one. Markets that still
+# fail are resumed by the next sync.
+EXCHANGE_RETRIES = 3
+EXCHANGE_RETRY_BACKOFF = 1.0
+
+# Synced trades and transactions are priced and stored in chunks of
+# this many records while they are fetched, each chunk is committed
+IMPORT_CHUNK_SIZE = 500
+
+# Pool size per host, (connect, read) timeouts in seconds and retries
+# with exponential backoff of the shared HTTP session used for the
+# price and coin list requests, see backend/utils/http.py
+HTTP_POOL_SIZE = 10
+HTTP_TIMEOUT = (5, 30)
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+
+# Class prices are requested from and the keyword arguments it is
+# created with. backend.utils.price_providers.OfflinePriceProvider
+# generates stable synthetic prices without network access and takes
+# the options latency (seconds per request) and error_rate (0 to 1).
+PRICE_PROVIDER = "backend.utils.price_providers.CryptoCompareProvider"
+PRICE_PROVIDER_OPTIONS = {}
+
+# Granularity of historical prices: "minute", "hour" or "day".
+# Timestamps are normalized to UTC buckets of this size before
+# they are used as cache keys or sent to the price API.
+PRICE_GRANULARITY = "day"
+
+# Seconds a live price (lookup without a timestamp) is cached
+PRICE_LIVE_TTL = 60
+
+# Size and entry lifetime in seconds of the in-process price cache
+# which sits in front of the PriceCandle table and the diskcache
+PRICE_MEMORY_CACHE_SIZE = 10000
+PRICE_MEMORY_CACHE_TTL = 3600
+
+# Prices of crypto currencies in one of these fiat currencies are
+# calculated through the pivot currency, e.g. XLM -> EUR is
+# XLM -> BTC x BTC -> EUR, so the BTC -> EUR price of a day is
+# shared by all currencies
+PRICE_PIVOT_CURRENCY = "BTC"
+PRICE_FIAT_CURRENCIES = ("EUR", "USD", "GBP", "CHF", "JPY")
+
+# Run the range requests of a price prefetch concurrently, at most
+# PRICE_ASYNC_CONCURRENCY at a time and PRICE_ASYNC_RATE_LIMIT per second
+PRICE_ASYNC_REQUESTS = True
+PRICE_ASYNC_CONCURRENCY = 8
+PRICE_ASYNC_RATE_LIMIT = 10.0
+
+# Concurrent misses of the same price, also from other Celery workers
+# on this host, wait for the first one's request instead of sending
+# their own. A worker waits at most this many seconds for another one.
+PRICE_FETCH_LOCK_TIMEOUT = 30
+
+# Prices the API does not have are not requested again for
+# PRICE_NEGATIVE_TTL seconds. After PRICE_BREAKER_THRESHOLD failures of
+# a pair within that time its requests are paused for
+# PRICE_BREAKER_COOLDOWN seconds.
+PRICE_NEGATIVE_TTL = 21600
+PRICE_BREAKER_THRESHOLD = 3
+PRICE_BREAKER_COOLDOWN = 600
+
+# Prices whose request failed, e.g. because of a timeout, are only
+# skipped for PRICE_ERROR_TTL seconds and don't count as failures of
+# the pair.
+PRICE_ERROR_TTL = 300
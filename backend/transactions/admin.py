@@ -1,6 +1,9 @@
 from django.contrib import admin
 from backend.transactions.models import Transaction, TransactionUpdateHistoryEntry
+from backend.transactions.models import TradeSyncCursor, CoinbaseSyncCursor
 # Register your models here.
 
 admin.site.register(Transaction)
 admin.site.register(TransactionUpdateHistoryEntry)
+admin.site.register(TradeSyncCursor)
+admin.site.register(CoinbaseSyncCursor)
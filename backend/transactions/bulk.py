@@ -0,0 +1,214 @@
+"""
+Contains the bulk write path for imported transactions. Transactions
+and their tags are written with a few queries per chunk instead of
+saving every transaction and adding its tags one by one.
+"""
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, connection, transaction
+
+from backend.transactions.models import Transaction
+
+# number of transactions inserted per query
+BULK_CHUNK_SIZE = 500
+
+
+def get_tag_ids(names: set) -> dict:
+    """
+    Returns the ids of the tags with the given names,
+    creating the tags that don't exist yet
+
+    Arguments:
+        names {set} -- the tag names
+
+    Returns:
+        dict -- the tag ids by name
+    """
+    tag_model = Transaction.tags.through.tag_model()
+    tag_ids = dict(
+        tag_model.objects.filter(name__in=names).values_list("name", "id"))
+    for name in names - set(tag_ids):
+        # new tags are rare, save() takes care of unique slugs
+        tag_ids[name] = tag_model.objects.get_or_create(name=name)[0].id
+    return tag_ids
+
+
+def _external_key(trx: Transaction) -> tuple:
+    return (trx.source_peer_id, trx.external_id)
+
+
+def _skips_conflicts() -> bool:
+    """
+    Checks if the database skips transactions imported before while
+    inserting them, see _insert_skipping_conflicts
+    """
+    return connection.vendor == "postgresql"
+
+
+def drop_existing(entries: list) -> list:
+    """
+    Drops the entries whose transaction was imported before
+    or appears earlier in entries, see Transaction.external_id.
+    Databases that skip conflicting rows while inserting only drop
+    the duplicates within entries.
+    """
+    existing = set()
+    keys = {_external_key(trx) for trx, _ in entries if trx.external_id}
+    if keys and not _skips_conflicts():
+        existing = set(
+            Transaction.objects.filter(
+                source_peer_id__in={key[0]
+                                    for key in keys},
+                external_id__in={key[1]
+                                 for key in keys}).values_list(
+                                     "source_peer_id", "external_id"))
+
+    new_entries = []
+    for trx, tags in entries:
+        if trx.external_id:
+            key = _external_key(trx)
+            if key in existing:
+                continue
+            existing.add(key)
+        new_entries.append((trx, tags))
+    return new_entries
+
+
+def _insert_skipping_conflicts(chunk: list) -> list:
+    """
+    Inserts a chunk of transactions with an external_id in one
+    INSERT ... ON CONFLICT DO NOTHING query and returns the inserted
+    ones. Transactions imported before, also by a sync running at the
+    same time, are skipped by the database, so they don't have to be
+    queried before.
+    """
+    fields = [
+        field for field in Transaction._meta.concrete_fields
+        if not field.primary_key
+    ]
+    quote_name = connection.ops.quote_name
+    values = "({})".format(", ".join(["%s"] * len(fields)))
+    params = []
+    for trx in chunk:
+        params.extend(
+            field.get_db_prep_save(field.pre_save(trx, True), connection)
+            for field in fields)
+
+    source_peer = quote_name(
+        Transaction._meta.get_field("source_peer").column)
+    external_id = quote_name("external_id")
+    sql = ("INSERT INTO {table} ({columns}) VALUES {rows} "
+           "ON CONFLICT ({source_peer}, {external_id}) DO NOTHING "
+           "RETURNING {pk}, {source_peer}, {external_id}").format(
+               table=quote_name(Transaction._meta.db_table),
+               columns=", ".join(
+                   quote_name(field.column) for field in fields),
+               rows=", ".join([values] * len(chunk)),
+               source_peer=source_peer,
+               external_id=external_id,
+               pk=quote_name(Transaction._meta.pk.column))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        ids = {(row[1], row[2]): row[0] for row in cursor.fetchall()}
+
+    inserted = []
+    for trx in chunk:
+        pk = ids.pop(_external_key(trx), None)
+        if pk is None:
+            print("Skipping duplicate transaction {}".format(
+                trx.external_id))
+            continue
+        trx.pk = pk
+        trx._state.adding = False
+        trx._state.db = connection.alias
+        inserted.append(trx)
+    return inserted
+
+
+def _insert_transactions(chunk: list) -> list:
+    """
+    Inserts a chunk of transactions and returns the inserted ones.
+    On PostgreSQL transactions with an external_id are inserted with
+    _insert_skipping_conflicts. Otherwise, if another sync inserted
+    one of them in the meantime the chunk is saved one by one,
+    skipping the duplicates. Databases that can't return the ids of
+    bulk inserted rows (sqlite) always save them one by one.
+    """
+    inserted = []
+    if _skips_conflicts():
+        keyed = [trx for trx in chunk if trx.external_id]
+        if keyed:
+            inserted = _insert_skipping_conflicts(keyed)
+        chunk = [trx for trx in chunk if not trx.external_id]
+        if not chunk:
+            return inserted
+
+    if connection.features.can_return_ids_from_bulk_insert:
+        try:
+            with transaction.atomic():
+                return inserted + Transaction.objects.bulk_create(chunk)
+        except IntegrityError:
+            for trx in chunk:
+                trx.pk = None
+
+    for trx in chunk:
+        try:
+            with transaction.atomic():
+                trx.save()
+            inserted.append(trx)
+        except IntegrityError:
+            print("Skipping duplicate transaction {}".format(
+                trx.external_id))
+    return inserted
+
+
+def bulk_save_transactions(entries: list,
+                           chunk_size: int = BULK_CHUNK_SIZE) -> list:
+    """
+    Saves new transactions and their tags in one database transaction.
+    Transactions are inserted in chunks, the tag ids are resolved once
+    and the rows linking transactions and tags are bulk inserted.
+
+    Transactions with an external_id that was already imported for
+    their source peer are skipped, so a sync can be repeated or run
+    in parallel without creating duplicates.
+
+    Arguments:
+        entries {list} -- (Transaction, tag names) tuples of unsaved
+                          transactions
+
+    Keyword Arguments:
+        chunk_size {int} -- transactions per insert
+                            (default: {BULK_CHUNK_SIZE})
+
+    Returns:
+        list -- the saved transactions
+    """
+    entries = drop_existing(entries)
+    if not entries:
+        return []
+
+    through = Transaction.tags.through
+    content_type_id = ContentType.objects.get_for_model(Transaction).id
+
+    saved = []
+    with transaction.atomic():
+        tag_ids = get_tag_ids(
+            {name
+             for _, tags in entries for name in tags if name})
+        for start in range(0, len(entries), chunk_size):
+            chunk = entries[start:start + chunk_size]
+            inserted = set(
+                id(trx) for trx in _insert_transactions(
+                    [trx for trx, _ in chunk]))
+            chunk = [(trx, tags) for trx, tags in chunk if id(trx) in inserted]
+            through.objects.bulk_create([
+                through(
+                    content_type_id=content_type_id,
+                    object_id=trx.pk,
+                    tag_id=tag_ids[name]) for trx, tags in chunk
+                for name in set(tags) if name
+            ])
+            saved.extend(trx for trx, _ in chunk)
+
+    return saved
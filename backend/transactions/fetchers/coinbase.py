@@ -1,29 +1,118 @@
 """
 Contains all functions related to importing Coinbase data
 
-Note: We cannot use Transaction.objects.bulk_create since
-django-taggit needs object id before saving.
+Transactions are fetched, built and stored in chunks by the import
+pipeline, see import_in_chunks.
 """
 
+import calendar
 import json
-import time
 from requests.sessions import Session
 from datetime import datetime, timezone
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from dateutil import parser
+from django.conf import settings
 from django.utils.timezone import now
 
 from coinbase.wallet.client import Client, APIObject
 
 from backend.transactions.models import Transaction, TransactionUpdateHistoryEntry
+from backend.transactions.models import CoinbaseSyncCursor
+from backend.transactions.pipeline import import_in_chunks
+from backend.transactions.pipeline import get_legacy_sync_date
 
 from backend.accounts.models import Account
-from backend.utils.utils import get_name_price
+from backend.accounts.address_index import AddressIndex
+from backend.utils.utils import PriceResult, prefetch_prices
+from backend.utils.utils import get_day_timestamp
+from backend.utils.utils import resolve_name_price
+from backend.utils.utils import get_price_stats, reset_price_stats
+from backend.utils.rate_limit import TokenBucket, get_api_limiter
 
 TAG_COINBASE = "coinbase"
 
+# resources fetched for every wallet, see fetch_from_cb
+CB_RESOURCES = ("transfers", "buys", "sells")
 
-def process_send(cb_trx, timestamp: int, account: Account) -> Transaction:
+# items per page, the maximum of the Coinbase API
+CB_PAGE_LIMIT = 100
+
+# status of items that can still change
+CB_UNSETTLED = ("created", "pending")
+
+
+def native_valuation() -> bool:
+    """Checks if book prices are derived from Coinbase's fiat values,
+    see COINBASE_NATIVE_VALUATION"""
+    return getattr(settings, "COINBASE_NATIVE_VALUATION", True)
+
+
+def get_native_values(fiat_amount: float, fiat_currency: str,
+                      crypto_amount: float, crypto_currency: str,
+                      timestamp: float) -> tuple:
+    """Returns the EUR and BTC book prices of a Coinbase transaction
+    from the fiat value Coinbase provides. Only the missing legs are
+    looked up with the rate of the day, the legs Coinbase provides
+    are always priced. The BTC leg is the fiat value divided by the
+    BTC rate, the same rate fiat prices are triangulated through.
+
+    Arguments:
+        fiat_amount {float} -- the value of the transaction
+        fiat_currency {str} -- the currency of the value, usually EUR
+        crypto_amount {float} -- the amount of crypto currency
+        crypto_currency {str} -- the crypto currency
+        timestamp {float} -- the timestamp of the transaction
+
+    Returns:
+        tuple -- the EUR and BTC book prices as PriceResults
+    """
+
+    day = get_day_timestamp(timestamp)
+    if fiat_currency == "EUR":
+        book_price_eur = PriceResult(fiat_amount, True, None)
+    else:
+        book_price_eur = resolve_name_price(fiat_amount, fiat_currency, "EUR",
+                                            day)
+
+    if crypto_currency == "BTC":
+        book_price_btc = PriceResult(crypto_amount, True, None)
+    else:
+        btc_rate = resolve_name_price(1, "BTC", fiat_currency, day)
+        if btc_rate.priced and btc_rate.value:
+            book_price_btc = PriceResult(fiat_amount / btc_rate.value, True,
+                                         None)
+        else:
+            book_price_btc = PriceResult(0.0, False, btc_rate.reason)
+    return book_price_eur, book_price_btc
+
+
+def get_native_lookups(fiat_currency: str, crypto_currency: str,
+                       timestamp: float) -> list:
+    """Returns the price lookups get_native_values needs"""
+    day = get_day_timestamp(timestamp)
+    lookups = []
+    if fiat_currency != "EUR":
+        lookups.append((fiat_currency, "EUR", day))
+    if crypto_currency != "BTC":
+        lookups.append(("BTC", fiat_currency, day))
+    return lookups
+
+
+def get_tags(tag: str, prices: list) -> list:
+    """Returns the tags of a Coinbase transaction, transactions with
+    a book price that couldn't be resolved are tagged with a warning,
+    the user has to check the price"""
+    tags = [TAG_COINBASE, tag]
+    if not all(price.priced for price in prices):
+        tags.append(Transaction.TRX_TAG_WARNING)
+    return tags
+
+
+def process_send(cb_trx,
+                 timestamp: int,
+                 account: Account,
+                 address_index: AddressIndex = None) -> tuple:
     """Process all Coinbase send transactions
 
     Arguments:
@@ -31,12 +120,19 @@ def process_send(cb_trx, timestamp: int, account: Account) -> Transaction:
         timestamp {float} -- timestamp of last import from coinbase
         account {Account} -- the account this transaction originates from
 
+    Keyword Arguments:
+        address_index {AddressIndex} -- the known addresses of the user,
+                                        the peer the address a send
+                                        goes to belongs to becomes the
+                                        target peer (default: {None})
+
     Returns:
-        Transaction -- a Transaction object
+        tuple -- the unsaved Transaction object and its tags
     """
 
     new_trx = Transaction()
     new_trx.date = cb_trx["created_at"]
+    new_trx.external_id = cb_trx.get("id")
 
     # minus on coinbase (source peer)
     new_trx.spent_amount = abs(float(cb_trx["amount"]["amount"]))
@@ -62,32 +158,58 @@ def process_send(cb_trx, timestamp: int, account: Account) -> Transaction:
         # network fee for this transaction
         new_trx.fee_amount = abs(float(network["transaction_fee"]["amount"]))
         new_trx.fee_currency = network["transaction_fee"]["currency"]
-
-        new_trx.book_price_fee_eur = get_name_price(
-            new_trx.fee_amount, new_trx.fee_currency, "EUR", timestamp)
-        new_trx.book_price_fee_btc = get_name_price(
-            new_trx.fee_amount, new_trx.fee_currency, "BTC", timestamp)
         tag = Transaction.TRX_TAG_TRANSFER
         new_trx.icon = Transaction.TRX_ICON_TRANSFER
 
     # calculate book prices
     # number might be negative, make absolute
-    new_trx.book_price_eur = abs(float(cb_trx["native_amount"]["amount"]))
-    new_trx.book_price_btc = get_name_price(
-        new_trx.spent_amount, new_trx.spent_currency, "BTC", timestamp)
+    native_amount = abs(float(cb_trx["native_amount"]["amount"]))
+    if native_valuation():
+        prices = list(
+            get_native_values(native_amount,
+                              cb_trx["native_amount"]["currency"],
+                              new_trx.spent_amount, new_trx.spent_currency,
+                              timestamp))
+    else:
+        prices = [
+            PriceResult(native_amount, True, None),
+            resolve_name_price(new_trx.spent_amount, new_trx.spent_currency,
+                               "BTC", timestamp)
+        ]
+    new_trx.book_price_eur = prices[0].value
+    new_trx.book_price_btc = prices[1].value
+
+    # a refferal bonus has no fee
+    if network["status"] != "off_blockchain":
+        if native_valuation() and new_trx.fee_currency == \
+                new_trx.spent_currency and new_trx.spent_amount:
+            # the network fee is paid in the sent currency
+            share = new_trx.fee_amount / new_trx.spent_amount
+            new_trx.book_price_fee_eur = new_trx.book_price_eur * share
+            new_trx.book_price_fee_btc = new_trx.book_price_btc * share
+        else:
+            prices.append(
+                resolve_name_price(new_trx.fee_amount, new_trx.fee_currency,
+                                   "EUR", timestamp))
+            prices.append(
+                resolve_name_price(new_trx.fee_amount, new_trx.fee_currency,
+                                   "BTC", timestamp))
+            new_trx.book_price_fee_eur = prices[-2].value
+            new_trx.book_price_fee_btc = prices[-1].value
 
     new_trx.owner = account.owner
     new_trx.source_peer = account
-    # TODO: get target address and query database for known addresses
-    # If it exists, get the parent Peer for this address and set as target
-    # new_trx.target_peer = None
+    to = cb_trx.get("to") or {}
+    if address_index is not None:
+        target_peer_id = address_index.resolve(
+            to.get("currency") or new_trx.spent_currency, to.get("address"))
+        if target_peer_id is not None:
+            new_trx.target_peer_id = target_peer_id
 
-    new_trx.save()
-    new_trx.tags.add(TAG_COINBASE, tag)
-    new_trx.save()
+    return new_trx, get_tags(tag, prices)
 
 
-def process_buy_sell(cb_trx, timestamp, account: Account) -> Transaction:
+def process_buy_sell(cb_trx, timestamp, account: Account) -> tuple:
     """Process all Coinbase buys and sells
 
     Arguments:
@@ -99,11 +221,12 @@ def process_buy_sell(cb_trx, timestamp, account: Account) -> Transaction:
             ValueError -- when resource is not "buy" or "sell"
 
     Returns:
-        Transaction -- a Transaction object
+        tuple -- the unsaved Transaction object and its tags
     """
 
     new_trx: Transaction = Transaction()
     new_trx.date = cb_trx["created_at"]
+    new_trx.external_id = cb_trx.get("id")
 
     tag = "None"
 
@@ -126,51 +249,116 @@ def process_buy_sell(cb_trx, timestamp, account: Account) -> Transaction:
     else:
         raise ValueError("Type of transaction must either be buy or sell")
 
-    if new_trx.acquired_currency == "BTC":
-        new_trx.book_price_btc = new_trx.acquired_amount
-    else:
-        new_trx.book_price_btc = get_name_price(new_trx.acquired_amount,
-                                                new_trx.acquired_currency,
-                                                "BTC", timestamp)
-
-    new_trx.book_price_eur = abs(float(cb_trx["total"]["amount"]))
-    new_trx.book_price_btc = get_name_price(new_trx.book_price_eur, "EUR",
-                                            "BTC", timestamp)
-
-    new_trx.fee_amount = new_trx.book_price_fee_eur = abs(
-        float(cb_trx["fees"][0]["amount"]["amount"]))
+    total = abs(float(cb_trx["total"]["amount"]))
+    total_currency = cb_trx["total"]["currency"]
+    new_trx.fee_amount = abs(float(cb_trx["fees"][0]["amount"]["amount"]))
     new_trx.fee_currency = cb_trx["fees"][0]["amount"]["currency"]
-    new_trx.book_price_fee_btc = get_name_price(new_trx.book_price_fee_eur,
-                                                "EUR", "BTC", timestamp)
+
+    if native_valuation():
+        prices = list(
+            get_native_values(total, total_currency,
+                              abs(float(cb_trx["amount"]["amount"])),
+                              cb_trx["amount"]["currency"], timestamp))
+        new_trx.book_price_eur = prices[0].value
+        new_trx.book_price_btc = prices[1].value
+        if new_trx.fee_currency == total_currency and total:
+            # the fee is paid in the currency of the total
+            share = new_trx.fee_amount / total
+            new_trx.book_price_fee_eur = new_trx.book_price_eur * share
+            new_trx.book_price_fee_btc = new_trx.book_price_btc * share
+        else:
+            day = get_day_timestamp(timestamp)
+            prices.append(
+                resolve_name_price(new_trx.fee_amount, new_trx.fee_currency,
+                                   "EUR", day))
+            prices.append(
+                resolve_name_price(new_trx.fee_amount, new_trx.fee_currency,
+                                   "BTC", day))
+            new_trx.book_price_fee_eur = prices[-2].value
+            new_trx.book_price_fee_btc = prices[-1].value
+    else:
+        prices = [
+            resolve_name_price(total, "EUR", "BTC", timestamp),
+            resolve_name_price(new_trx.fee_amount, "EUR", "BTC", timestamp)
+        ]
+        new_trx.book_price_eur = total
+        new_trx.book_price_btc = prices[0].value
+        new_trx.book_price_fee_eur = new_trx.fee_amount
+        new_trx.book_price_fee_btc = prices[1].value
 
     new_trx.owner = account.owner
     new_trx.source_peer = account
     new_trx.target_peer = account
-    new_trx.save()
-    new_trx.tags.add(TAG_COINBASE, tag)
-    new_trx.save()
 
+    return new_trx, get_tags(tag, prices)
+
+
+def get_coinbase_limiter(api_key: str) -> TokenBucket:
+    """Returns the rate limiter shared by all requests with the API key,
+    it allows COINBASE_RATE_LIMIT requests per second"""
+    return get_api_limiter("coinbase", api_key,
+                           getattr(settings, "COINBASE_RATE_LIMIT", 3.0))
+
+
+def get_sync_cursors(account: Account, wallet_ids: list) -> list:
+    """Returns the cursors of all resources of the wallets, ordered by
+    wallet and resource. Missing cursors are created unsaved.
+
+    Arguments:
+        account {Account} -- the synced account
+        wallet_ids {list} -- ids of the Coinbase wallets
+
+    Returns:
+        list -- the CoinbaseSyncCursor objects
+    """
 
-def fetch_from_cb(what_to_fetch: str, cb_client: Client,
-                  cb_account_id: str) -> []:
+    existing = {(cursor.wallet_id, cursor.resource): cursor
+                for cursor in CoinbaseSyncCursor.objects.filter(
+                    account=account, wallet_id__in=wallet_ids)}
+    return [
+        existing.get((wallet_id, resource)) or CoinbaseSyncCursor(
+            account=account, wallet_id=wallet_id, resource=resource)
+        for wallet_id in wallet_ids for resource in CB_RESOURCES
+    ]
+
+
+def fetch_from_cb(what_to_fetch: str,
+                  cb_client: Client,
+                  cb_account_id: str,
+                  limiter: TokenBucket = None,
+                  cursor: CoinbaseSyncCursor = None):
     """Fetch the specified data from Coinbase
 
     buys and sells: Merchant buyouts like FIAT -> BTC etc.
     transfers: Coin transfers from Coinbase to a wallet address
 
+    The APIObjects are yielded oldest first, page by page. The next
+    page is only requested once the previous one was consumed.
+
     Arguments:
         what_to_fetch {str} -- either "buys", "sells" or "transfers"
         cb_client {Client} -- coinbase client object
         cb_account_id {str} -- coinbase account id to use
 
-    Returns:
-        [] -- a list with the APIObjects from Coinbase
+    Keyword Arguments:
+        limiter {TokenBucket} -- rate limiter to acquire before every
+                                 request (default: {None})
+        cursor {CoinbaseSyncCursor} -- only items after the cursor are
+                                       fetched, it is moved to the
+                                       newest settled item but not
+                                       saved (default: {None})
     """
 
-    the_list = []
-    data = dict()
+    data = {"order": "asc", "limit": CB_PAGE_LIMIT}
+    if cursor is not None and cursor.last_id:
+        data["starting_after"] = cursor.last_id
+    # items can still change until they are settled, the cursor
+    # must not move past them
+    unsettled = False
     next_uri = ""
     while next_uri != None:
+        if limiter is not None:
+            limiter.acquire()
         if what_to_fetch == "buys":
             ret = cb_client.get_buys(cb_account_id, **data)
         elif what_to_fetch == "sells":
@@ -178,15 +366,305 @@ def fetch_from_cb(what_to_fetch: str, cb_client: Client,
         elif what_to_fetch == "transfers":
             ret = cb_client.get_transactions(cb_account_id, **data)
 
-        the_list.extend(ret["data"])
+        for cb_trx in ret["data"]:
+            if cb_trx.get("status") in CB_UNSETTLED:
+                unsettled = True
+            if cursor is not None and not unsettled:
+                cursor.last_id = cb_trx["id"]
+            yield cb_trx
+        next_uri = ret.pagination["next_uri"]
+        if next_uri != None:
+            data["starting_after"] = ret["data"][-1]["id"]
+
+
+def filter_new_cb_transactions(what_to_fetch: str,
+                               cb_transactions,
+                               skip_until: datetime = None):
+    """Yields the completed sends, buys and sells
+
+    Buys and sells are only yielded once they are completed. The
+    cursor of their wallet is held before them until then, so a
+    later sync fetches them again, whenever they were created.
+
+    Unfortunately, the coinbase API only returns buys and sells
+    without the fee data when fetching through get_transactions.
+    For that reason we still have to use client.get_buys() and client.get_sells()
+    and only take the sends from the data returned from client.get_transactions()
+
+    Arguments:
+        what_to_fetch {str} -- either "buys", "sells" or "transfers"
+        cb_transactions {iterable} -- the APIObjects from fetch_from_cb
+
+    Keyword Arguments:
+        skip_until {datetime} -- transactions created until then were
+                                 already imported (default: {None})
+
+    Yields:
+        tuple -- (APIObject, timestamp) of the transaction
+    """
+
+    for cb_trx in cb_transactions:
+        if what_to_fetch == "transfers":
+            if cb_trx["type"] != "send":
+                continue
+        elif cb_trx["resource"] not in ("buy", "sell"):
+            continue
+        elif cb_trx["status"] != "completed":
+            # Skip everything not completed.
+            # This could be created or canceled.
+            continue
+
+        date = parser.parse(cb_trx["created_at"])
+        if skip_until is not None and date <= skip_until:
+            continue
+        yield cb_trx, calendar.timegm(date.utctimetuple())
+
+
+def get_wallets(client: Client, limiter: TokenBucket) -> list:
+    """Returns all crypto currency wallets of the Coinbase user"""
+    wallets = []
+    data = {"limit": CB_PAGE_LIMIT}
+    next_uri = ""
+    while next_uri != None:
+        limiter.acquire()
+        ret = client.get_accounts(**data)
+        wallets.extend(cb_account for cb_account in ret["data"]
+                       if cb_account["type"] != "fiat")
         next_uri = ret.pagination["next_uri"]
         if next_uri != None:
             data["starting_after"] = ret["data"][-1]["id"]
-    return the_list
+    return wallets
+
 
+def is_dormant_wallet(wallet, latest_update: datetime) -> bool:
+    """Checks if a wallet can't have new transactions. Coinbase updates
+    a wallet whenever its balance changes, so wallets that weren't
+    updated since the last sync and empty wallets that were never
+    updated since they were created are dormant.
 
-def update_coinbase_trx(account: Account):
-    """Synchronizes all transactions from Coinbase"""
+    Arguments:
+        wallet {APIObject} -- the Coinbase wallet
+        latest_update {datetime} -- start of the account's last sync
+
+    Returns:
+        bool -- True if the wallet can be skipped
+    """
+
+    if not wallet.get("updated_at"):
+        return False
+    updated = parser.parse(wallet["updated_at"])
+    if updated < latest_update:
+        return True
+
+    balance = float((wallet.get("balance") or {}).get("amount") or 0)
+    return balance == 0 and wallet.get("created_at") is not None and \
+        parser.parse(wallet["created_at"]) >= updated
+
+
+def get_skip_until(cursor: CoinbaseSyncCursor, legacy_date: datetime):
+    """Returns until when the transactions fetched with the cursor were
+    imported by a sync without cursors. Only cursors that were never
+    stored start before them."""
+    return legacy_date if cursor.pk is None else None
+
+
+def iter_new_cb_transactions(client: Client,
+                             limiter: TokenBucket,
+                             cursors: list,
+                             legacy_date: datetime = None):
+    """Yields the sends, buys and sells of Coinbase wallets after their
+    cursors, wallet by wallet and page by page
+
+    Arguments:
+        client {Client} -- coinbase client object
+        limiter {TokenBucket} -- rate limiter of the Coinbase account
+        cursors {list} -- the cursors of the wallets' resources
+
+    Keyword Arguments:
+        legacy_date {datetime} -- date of the last sync without cursors,
+                                  see get_legacy_sync_date
+                                  (default: {None})
+
+    Yields:
+        tuple -- (APIObject, timestamp) of the transaction
+    """
+
+    for cursor in cursors:
+        yield from filter_new_cb_transactions(
+            cursor.resource,
+            fetch_from_cb(cursor.resource, client, cursor.wallet_id,
+                          limiter, cursor),
+            get_skip_until(cursor, legacy_date))
+
+
+def fetch_cb_transactions_concurrently(client: Client,
+                                       limiter: TokenBucket,
+                                       cursors: list,
+                                       legacy_date: datetime = None) -> list:
+    """Fetches the sends, buys and sells of Coinbase wallets after
+    their cursors. All wallets and resources are fetched in
+    parallel by COINBASE_SYNC_WORKERS threads, the requests of all
+    threads share the limiter.
+
+    Arguments:
+        client {Client} -- coinbase client object
+        limiter {TokenBucket} -- rate limiter of the Coinbase account
+        cursors {list} -- the cursors of the wallets' resources
+
+    Keyword Arguments:
+        legacy_date {datetime} -- date of the last sync without cursors,
+                                  see get_legacy_sync_date
+                                  (default: {None})
+
+    Returns:
+        list -- (APIObject, timestamp) tuples in the same order as
+                iter_new_cb_transactions yields them
+    """
+
+    if not cursors:
+        return []
+
+    workers = min(getattr(settings, "COINBASE_SYNC_WORKERS", 4), len(cursors))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(
+            lambda cursor: list(
+                fetch_from_cb(cursor.resource, client, cursor.wallet_id,
+                              limiter, cursor)), cursors)
+
+        records = []
+        for cursor, cb_transactions in zip(cursors, results):
+            records.extend(
+                filter_new_cb_transactions(
+                    cursor.resource, cb_transactions,
+                    get_skip_until(cursor, legacy_date)))
+    return records
+
+
+def get_price_lookups(sends: list, buys_sells: list) -> list:
+    """Collects all (base, target, timestamp) price lookups needed
+    to calculate the book prices of the given Coinbase transactions
+
+    Arguments:
+        sends {list} -- (APIObject, timestamp) tuples of send transactions
+        buys_sells {list} -- (APIObject, timestamp) tuples of buys and sells
+
+    Returns:
+        list -- the price lookups
+    """
+
+    if native_valuation():
+        return get_native_price_lookups(sends, buys_sells)
+
+    lookups = []
+    for cb_trx, timestamp in sends:
+        lookups.append((cb_trx["amount"]["currency"], "BTC", timestamp))
+        if cb_trx["network"]["status"] != "off_blockchain":
+            fee_currency = cb_trx["network"]["transaction_fee"]["currency"]
+            lookups.append((fee_currency, "EUR", timestamp))
+            lookups.append((fee_currency, "BTC", timestamp))
+
+    for buy_sell, timestamp in buys_sells:
+        if buy_sell["resource"] == "buy":
+            acquired_currency = buy_sell["amount"]["currency"]
+        else:
+            acquired_currency = buy_sell["total"]["currency"]
+        lookups.append((acquired_currency, "BTC", timestamp))
+        lookups.append(("EUR", "BTC", timestamp))
+    return lookups
+
+
+def get_native_price_lookups(sends: list, buys_sells: list) -> list:
+    """Collects the price lookups of the given Coinbase transactions
+    when their book prices are derived from Coinbase's fiat values,
+    see get_price_lookups"""
+
+    lookups = []
+    for cb_trx, timestamp in sends:
+        currency = cb_trx["amount"]["currency"]
+        lookups.extend(
+            get_native_lookups(cb_trx["native_amount"]["currency"], currency,
+                               timestamp))
+        network = cb_trx["network"]
+        if network["status"] != "off_blockchain" and \
+                network["transaction_fee"]["currency"] != currency:
+            for target in ("EUR", "BTC"):
+                lookups.append((network["transaction_fee"]["currency"],
+                                target, timestamp))
+
+    for buy_sell, timestamp in buys_sells:
+        total_currency = buy_sell["total"]["currency"]
+        lookups.extend(
+            get_native_lookups(total_currency, buy_sell["amount"]["currency"],
+                               timestamp))
+        fee_currency = buy_sell["fees"][0]["amount"]["currency"]
+        if fee_currency != total_currency:
+            for target in ("EUR", "BTC"):
+                lookups.append((fee_currency, target, get_day_timestamp(timestamp)))
+    return lookups
+
+
+def build_cb_entries(records: list,
+                     account: Account,
+                     address_index: AddressIndex = None) -> list:
+    """Turns a chunk of Coinbase transactions into Transaction objects.
+    The book prices are resolved with a few range requests before
+    building the transactions.
+
+    Arguments:
+        records {list} -- (APIObject, timestamp) tuples
+        account {Account} -- the account the transactions belong to
+
+    Keyword Arguments:
+        address_index {AddressIndex} -- resolves the target peers of
+                                        sends (default: {None})
+
+    Returns:
+        list -- (Transaction, tag names) tuples
+    """
+
+    sends = []
+    buys_sells = []
+    for record in records:
+        if record[0]["resource"] in ("buy", "sell"):
+            buys_sells.append(record)
+        else:
+            sends.append(record)
+    prefetch_prices(get_price_lookups(sends, buys_sells))
+
+    entries = []
+    for cb_trx, timestamp in sends:
+        entries.append(
+            process_send(cb_trx, timestamp, account, address_index))
+
+    for buy_sell, timestamp in buys_sells:
+        entries.append(process_buy_sell(buy_sell, timestamp, account))
+    return entries
+
+
+def update_coinbase_trx(account: Account, progress=None) -> dict:
+    """Synchronizes all transactions from Coinbase
+
+    Wallets that can't have new transactions are skipped, see
+    is_dormant_wallet. The transactions are imported in chunks while
+    they are fetched, see import_in_chunks. With COINBASE_CONCURRENT_SYNC
+    enabled all wallets are fetched in parallel first, see
+    fetch_cb_transactions_concurrently.
+
+    Arguments:
+        account {Account} -- the account to sync
+
+    Keyword Arguments:
+        progress {function} -- called with the number of processed
+                               records and imported transactions after
+                               every chunk (default: {None})
+
+    Returns:
+        dict -- the number of imported transactions, the pending
+                markets (always empty for Coinbase) and the number of
+                requests skipping dormant wallets avoided
+    """
+    starttime: datetime = now()
+    reset_price_stats()
     last_update_query = TransactionUpdateHistoryEntry.objects.filter(
         account=account).order_by('-date')
     latest_update = datetime.utcfromtimestamp(0).replace(tzinfo=timezone.utc)
@@ -194,50 +672,57 @@ def update_coinbase_trx(account: Account):
         latest_update = last_update_query[:1][0].date
 
     client: Client = Client(account.api_key, account.api_secret)
-    cb_accounts = client.get_accounts()
-
-    num_imports = 0
+    limiter = get_coinbase_limiter(account.api_key)
+
+    wallets = get_wallets(client, limiter)
+    wallet_ids = [
+        wallet["id"] for wallet in wallets
+        if not is_dormant_wallet(wallet, latest_update)
+    ]
+    # at least one request per resource of every skipped wallet
+    avoided_requests = (len(wallets) - len(wallet_ids)) * len(CB_RESOURCES)
+    print("Skipping {} of {} wallets".format(
+        len(wallets) - len(wallet_ids), len(wallets)))
+
+    cursors = get_sync_cursors(account, wallet_ids)
+    last_ids = [cursor.last_id for cursor in cursors]
+    # wallets synced before the cursors existed have no stored cursor
+    legacy_date = get_legacy_sync_date(account)
+    address_index = AddressIndex(account.owner)
+
+    if getattr(settings, "COINBASE_CONCURRENT_SYNC", False):
+        # everything is fetched before it is processed and stored
+        records = fetch_cb_transactions_concurrently(client, limiter, cursors,
+                                                     legacy_date)
+    else:
+        records = iter_new_cb_transactions(client, limiter, cursors,
+                                           legacy_date)
 
-    for cb_account in cb_accounts["data"]:
-        if cb_account["type"] == "fiat":
-            continue
+    num_imports = import_in_chunks(
+        records,
+        lambda chunk: build_cb_entries(chunk, account, address_index),
+        progress=progress)
 
-        # Unfortunately, the coinbase API only returns buys and sells
-        # without the fee data when fetching through get_transactions.
-        # For that reason we still have to use client.get_buys() and client.get_sells()
-        # and cannot use the data returned from client.get_transactions()
-        cb_transactions = fetch_from_cb("transfers", client, cb_account["id"])
-        for cb_trx in cb_transactions:
-            if cb_trx["type"] == "send":
-                date = parser.parse(cb_trx["created_at"])
-                if date <= latest_update:
-                    continue
-                timestamp = time.mktime(date.timetuple())
-                process_send(cb_trx, timestamp, account)
-                num_imports += 1
-                time.sleep(1)  # sleep to prevent api spam
-
-        buy_sell_list = []
-        buy_sell_list.extend(fetch_from_cb("buys", client, cb_account["id"]))
-        buy_sell_list.extend(fetch_from_cb("sells", client, cb_account["id"]))
-
-        for buy_sell in buy_sell_list:
-            if buy_sell["resource"] == "buy" or buy_sell["resource"] == "sell":
-                if buy_sell["status"] != "completed":
-                    # Skip everything not completed.
-                    # This could be created or canceled.
-                    continue
-
-                date = parser.parse(buy_sell["created_at"])
-                if date <= latest_update:
-                    continue
-                timestamp = time.mktime(date.timetuple())
-                process_buy_sell(buy_sell, timestamp, account)
-                num_imports += 1
-                time.sleep(1)  # sleep to prevent api spam
+    # only move the cursors once the transactions are stored
+    for cursor, last_id in zip(cursors, last_ids):
+        if cursor.last_id != last_id:
+            cursor.save()
 
+    # the start of the sync, wallets updated while it ran
+    # aren't dormant in the next sync
     entry: TransactionUpdateHistoryEntry = TransactionUpdateHistoryEntry(
-        date=now(), account=account, fetched_transactions=num_imports)
+        date=starttime,
+        account=account,
+        fetched_transactions=num_imports,
+        avoided_requests=avoided_requests)
     entry.save()
 
     print("Imported {} transactions".format(num_imports))
+    print("Price lookups: {lookups} hit rate: {hit_rate:.0%}".format(
+        **get_price_stats()))
+
+    return {
+        "imported": num_imports,
+        "pending": [],
+        "avoided_requests": avoided_requests
+    }
@@ -3,130 +3,647 @@ Contains all functions related to importing transactions
 from exchanges supported by the ccxt library
 """
 
+import asyncio
+import calendar
+import importlib
+import json
+import re
 import ccxt
 import time
-from datetime import datetime, timezone
+from datetime import datetime, timedelta
+from django.conf import settings
 from django.utils.timezone import now
 from requests.exceptions import ReadTimeout
 from dateutil import parser
-from django.db.models import QuerySet
 
-from backend.utils.utils import get_name_price
+from backend.utils.utils import resolve_name_price, prefetch_prices
+from backend.utils.utils import get_price_stats, reset_price_stats
+from backend.utils.rate_limit import TokenBucket, get_exchange_limiter
 
 from backend.accounts.models import Account
+from backend.accounts.markets import get_markets
+from backend.accounts.exchanges import get_exchange, load_cached_markets
 from backend.transactions.models import Transaction
 from backend.transactions.models import TransactionUpdateHistoryEntry
+from backend.transactions.models import TradeSyncCursor
+from backend.transactions.pipeline import get_legacy_sync_date
+from backend.transactions.pipeline import import_in_chunks
 
 from ...utils.utils import exchange_can_batch
 
+# ccxt's asyncio variant, it was called ccxt.async before async
+# became a keyword. None if it can't be imported.
+try:
+    ccxt_async = importlib.import_module("ccxt.async_support")
+except ImportError:
+    try:
+        ccxt_async = importlib.import_module("ccxt.async")
+    except (ImportError, SyntaxError):
+        ccxt_async = None
 
-def fetch_trades_unbatched(exchange: ccxt.Exchange):
+# number of trades requested per page
+TRADES_PAGE_LIMIT = 500
+
+# attempts of a request that keeps hitting the exchange's rate limit
+RATE_LIMIT_ATTEMPTS = 4
+
+# errors of a request that are retried with exponential backoff
+RETRY_ERRORS = (ccxt.NetworkError, ReadTimeout)
+
+
+def get_retry_delay(retry: int) -> float:
+    """
+    Returns the seconds to wait before the given retry, starting with
+    EXCHANGE_RETRY_BACKOFF and doubling with every retry
+    """
+    return getattr(settings, "EXCHANGE_RETRY_BACKOFF", 1.0) * 2**retry
+
+
+def call_exchange(exchange: ccxt.Exchange, limiter: TokenBucket, method: str,
+                  *args):
+    """
+    Calls an API method of the exchange once the rate limiter of the
+    exchange and API key allows it. The limiter is shared by all
+    workers, if the exchange still answers with a rate limit error
+    the limiter slows down and the call is repeated. Timeouts and
+    other network errors are retried EXCHANGE_RETRIES times with
+    exponential backoff, see get_retry_delay.
+
+    Arguments:
+        exchange {ccxt.Exchange} -- the exchange to call
+        limiter {TokenBucket} -- the limiter of the exchange account,
+                                 see get_exchange_limiter
+        method {str} -- name of the ccxt method, e.g. "fetch_my_trades"
+        args -- the arguments of the method
+
+    Returns:
+        the result of the method
+    """
+    rate_limited = 0
+    retries = 0
+    while True:
+        limiter.acquire()
+        try:
+            return getattr(exchange, method)(*args)
+        except ccxt.DDoSProtection:
+            rate_limited += 1
+            if rate_limited == RATE_LIMIT_ATTEMPTS:
+                raise
+            limiter.penalize()
+        except RETRY_ERRORS as err:
+            if retries == getattr(settings, "EXCHANGE_RETRIES", 3):
+                raise
+            delay = get_retry_delay(retries)
+            print("{} failed, retrying in {}s: {}".format(method, delay, err))
+            time.sleep(delay)
+            retries += 1
+
+
+def get_trade_cursors(account: Account, markets) -> dict:
+    """
+    Returns the cursors of an account's markets by market. All cursors
+    of the account are loaded with one query, markets without a cursor
+    get a new one that isn't saved. Cursors are only stored once their
+    market had trades or failed, so polling many markets doesn't
+    create a row for each of them. New cursors start at the account's
+    last sync from before cursors existed, see get_legacy_sync_date.
+
+    Arguments:
+        account {Account} -- the account the markets belong to
+        markets {iterable} -- the markets, "" for the cursor of
+                              exchanges that fetch all trades at once
+
+    Returns:
+        dict -- the cursors by market
+    """
+    existing = {
+        cursor.market: cursor
+        for cursor in TradeSyncCursor.objects.filter(account=account)
+    }
+    start = 0
+    if any(market not in existing for market in markets):
+        legacy_date = get_legacy_sync_date(account)
+        if legacy_date is not None:
+            # the trades up to then were imported without external ids
+            start = int(legacy_date.timestamp() * 1000)
+    return {
+        market: existing.get(market) or TradeSyncCursor(
+            account=account, market=market, last_timestamp=start)
+        for market in markets
+    }
+
+
+def get_trade_cursor(account: Account, market: str = "") -> TradeSyncCursor:
+    """Returns the cursor of an account's market, see get_trade_cursors"""
+    return get_trade_cursors(account, [market])[market]
+
+
+def is_new_trade(trade: dict, cursor: TradeSyncCursor) -> bool:
+    """Checks if a trade is newer than the cursor's high-water mark"""
+    if trade["timestamp"] is None or not cursor.last_timestamp:
+        return True
+    if trade["timestamp"] == cursor.last_timestamp:
+        return str(trade["id"]) != cursor.last_trade_id
+    return trade["timestamp"] > cursor.last_timestamp
+
+
+def iter_trades_since(exchange: ccxt.Exchange,
+                      limiter: TokenBucket,
+                      cursor: TradeSyncCursor,
+                      symbol: str = None):
+    """
+    Yields the trades newer than the cursor, fetching the next page
+    only when the trades of the previous one were consumed
+
+    Arguments:
+        exchange {ccxt.Exchange} -- the exchange to fetch from
+        limiter {TokenBucket} -- the limiter of the exchange account
+        cursor {TradeSyncCursor} -- the cursor of the market
+
+    Keyword Arguments:
+        symbol {str} -- the market, None for all markets (default: {None})
+    """
+    since = cursor.last_timestamp or None
+    seen = set()
+    while True:
+        page = call_exchange(exchange, limiter, "fetch_my_trades", symbol,
+                             since, TRADES_PAGE_LIMIT)
+        trades = []
+        add_new_trades(page, cursor, seen, trades)
+        yield from trades
+        since = get_next_since(page, since, symbol)
+        if since is None:
+            return
+
+
+def add_new_trades(page: list, cursor: TradeSyncCursor, seen: set,
+                   trades: list):
+    """Appends the trades of a page that weren't fetched before to trades"""
+    for trade in page:
+        if trade["id"] not in seen and is_new_trade(trade, cursor):
+            seen.add(trade["id"])
+            trades.append(trade)
+
+
+def get_next_since(page: list, since: int, symbol: str) -> int:
+    """
+    Returns the since of the page after page or None if page is the last.
+    The next page starts at the newest trade of page, paging stops if
+    the exchange does not move forward.
+    """
+    if len(page) < TRADES_PAGE_LIMIT:
+        return None
+
+    newest = max(trade["timestamp"] or 0 for trade in page)
+    if since is not None and newest <= since:
+        print("Paging stuck at {} for {}".format(since, symbol or "*"))
+        return None
+    return newest
+
+
+async def call_exchange_async(exchange, limiter, method: str, *args):
+    """
+    Calls an API method of an async ccxt exchange, see call_exchange.
+    The shared limiter blocks, so it is waited for in a thread.
+    """
+    loop = asyncio.get_event_loop()
+    rate_limited = 0
+    retries = 0
+    while True:
+        await loop.run_in_executor(None, limiter.acquire)
+        try:
+            return await getattr(exchange, method)(*args)
+        except ccxt.DDoSProtection:
+            rate_limited += 1
+            if rate_limited == RATE_LIMIT_ATTEMPTS:
+                raise
+            await loop.run_in_executor(None, limiter.penalize)
+        except RETRY_ERRORS as err:
+            if retries == getattr(settings, "EXCHANGE_RETRIES", 3):
+                raise
+            delay = get_retry_delay(retries)
+            print("{} failed, retrying in {}s: {}".format(method, delay, err))
+            await asyncio.sleep(delay)
+            retries += 1
+
+
+async def fetch_market_async(exchange, limiter, semaphore: asyncio.Semaphore,
+                             cursor: TradeSyncCursor, symbol: str,
+                             failed: dict) -> list:
+    """
+    Fetches the trades of one market newer than the cursor. If the
+    market fails its error is added to failed and the trades fetched
+    until then are returned.
+    """
+    since = cursor.last_timestamp or None
+    trades = []
+    seen = set()
+    async with semaphore:
+        try:
+            while True:
+                page = await call_exchange_async(
+                    exchange, limiter, "fetch_my_trades", symbol, since,
+                    TRADES_PAGE_LIMIT)
+                add_new_trades(page, cursor, seen, trades)
+                since = get_next_since(page, since, symbol)
+                if since is None:
+                    return trades
+        except RETRY_ERRORS as err:
+            print("Fetching {} failed: {}".format(symbol, err))
+            failed[symbol] = str(err)
+            return trades
+
+
+def iter_trades_concurrently(account: Account,
+                             limiter: TokenBucket,
+                             markets: list,
+                             failed: dict = None):
+    """
+    Fetches the trades of many markets concurrently with ccxt's asyncio
+    variant, at most EXCHANGE_ASYNC_CONCURRENCY markets at a time. All
+    requests share the rate limiter of the account, so the exchange's
+    rate budget is used without waiting for each response in turn.
+    The trades of a market are yielded as soon as it is fetched, so
+    they are imported while the other markets are still fetched.
+
+    Arguments:
+        account {Account} -- the account to fetch the trades of
+        limiter {TokenBucket} -- the limiter of the exchange account
+        markets {list} -- the symbols of the markets to fetch
+
+    Keyword Arguments:
+        failed {dict} -- the errors of markets that failed are added
+                         to it by symbol (default: {None})
+
+    Yields:
+        dict -- the new trades, market by market
+    """
+    if failed is None:
+        failed = {}
+    # the exchange's HTTP session must belong to the loop its
+    # requests run in
+    loop = asyncio.new_event_loop()
+    exchange = getattr(ccxt_async, account.service_type)({
+        "api_key": account.api_key,
+        "secret": account.api_secret,
+        "asyncio_loop": loop
+    })
+    exchange.set_markets(get_markets(account.service_type))
+    cursors = get_trade_cursors(account, markets)
+
+    async def start_all() -> set:
+        # created in the loop, the semaphore belongs to it
+        semaphore = asyncio.Semaphore(
+            getattr(settings, "EXCHANGE_ASYNC_CONCURRENCY", 4))
+        return {
+            asyncio.ensure_future(
+                fetch_market_async(exchange, limiter, semaphore,
+                                   cursors[market], market, failed))
+            for market in markets
+        }
+
+    async def close_exchange():
+        if hasattr(exchange, "close"):
+            await exchange.close()
+        elif getattr(exchange, "session", None) is not None:
+            await exchange.session.close()
+
+    pending = set()
+    try:
+        pending = loop.run_until_complete(start_all())
+        while pending:
+            done, pending = loop.run_until_complete(
+                asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED))
+            for task in done:
+                yield from task.result()
+    finally:
+        # the import stopped before all markets were fetched
+        for task in pending:
+            task.cancel()
+        if pending:
+            loop.run_until_complete(
+                asyncio.gather(*pending, return_exceptions=True))
+        loop.run_until_complete(close_exchange())
+        loop.close()
+
+
+def advance_trade_cursors(account: Account, trades: list, batched: bool):
+    """
+    Moves the cursors of an account to the newest imported trades
+
+    Arguments:
+        account {Account} -- the account the trades belong to
+        trades {list} -- the imported trades
+        batched {bool} -- True if the trades were fetched for all
+                          markets at once, False if per market
+    """
+    newest = {}
+    for trade in trades:
+        if trade["timestamp"] is None:
+            continue
+        market = "" if batched else trade["symbol"]
+        if market not in newest or \
+                trade["timestamp"] > newest[market]["timestamp"]:
+            newest[market] = trade
+
+    cursors = get_trade_cursors(account, newest)
+    for market, trade in newest.items():
+        cursor = cursors[market]
+        if trade["timestamp"] > cursor.last_timestamp:
+            cursor.last_timestamp = trade["timestamp"]
+            cursor.last_trade_id = str(trade["id"])
+            cursor.save()
+
+
+def get_pending_markets(account: Account) -> set:
+    """Returns the markets of an account that failed in an earlier sync"""
+    return set(
+        TradeSyncCursor.objects.filter(
+            account=account, pending=True).values_list("market", flat=True))
+
+
+def update_checkpoints(account: Account, resumed: set, failed: dict):
+    """
+    Marks the markets that failed as pending, so the next sync resumes
+    them from their cursor, and clears the resumed markets that
+    succeeded this time
+
+    Arguments:
+        account {Account} -- the synced account
+        resumed {set} -- the markets that were pending before the sync
+        failed {dict} -- the errors of the markets that failed by symbol
+    """
+    cursors = get_trade_cursors(account, failed)
+    for market, error in failed.items():
+        cursor = cursors[market]
+        cursor.pending = True
+        cursor.last_error = error[:255]
+        cursor.save()
+
+    TradeSyncCursor.objects.filter(
+        account=account, market__in=resumed - set(failed)).update(
+            pending=False, last_error="")
+
+
+def parse_account_symbols(symbols: str) -> set:
+    """
+    Parses the symbols of an account into a set. They are stored as
+    a JSON list like '["ETH/BTC", "XLM/ETH"]', comma separated lists
+    are accepted as well.
+    """
+    if not symbols:
+        return set()
+    try:
+        parsed = json.loads(symbols)
+    except ValueError:
+        parsed = re.split(r"[\s,;]+", symbols)
+    if isinstance(parsed, str):
+        parsed = [parsed]
+    return {str(symbol).strip().upper() for symbol in parsed if symbol}
+
+
+def needs_full_sweep(account: Account) -> bool:
+    """
+    Checks if all markets of an account have to be checked for trades.
+    That's the case for the first sync and if the last full sweep is
+    older than EXCHANGE_FULL_SWEEP_INTERVAL seconds.
+    """
+    interval = getattr(settings, "EXCHANGE_FULL_SWEEP_INTERVAL", 604800)
+    return not TransactionUpdateHistoryEntry.objects.filter(
+        account=account,
+        full_sweep=True,
+        date__gte=now() - timedelta(seconds=interval)).exists()
+
+
+def select_markets(exchange: ccxt.Exchange, limiter: TokenBucket,
+                   account: Account, markets: dict) -> list:
+    """
+    Selects the markets an account is likely to have new trades in:
+    the markets in the account's symbols, markets with trades in
+    earlier syncs, markets that failed in the last sync and markets
+    whose base currency the account holds
+
+    Arguments:
+        exchange {ccxt.Exchange} -- the exchange of the account
+        limiter {TokenBucket} -- the limiter of the exchange account
+        account {Account} -- the account to select markets for
+        markets {dict} -- all markets of the exchange
+
+    Returns:
+        list -- the symbols of the selected markets
+    """
+    selected = parse_account_symbols(account.symbols)
+    selected.update(
+        TradeSyncCursor.objects.filter(account=account,
+                                       last_timestamp__gt=0).exclude(
+                                           market="").values_list(
+                                               "market", flat=True))
+    selected.update(get_pending_markets(account))
+
+    try:
+        balance = call_exchange(exchange, limiter, "fetch_balance")
+        held = {
+            currency
+            for currency, amount in balance.get("total", {}).items()
+            if amount
+        }
+    except (ccxt.BaseError, ReadTimeout) as err:
+        print("Could not fetch the balance: {}".format(err))
+        held = set()
+
+    for symbol, market in markets.items():
+        base = (market or {}).get("base") or symbol.split("/")[0]
+        if base in held:
+            selected.add(symbol)
+
+    return [symbol for symbol in markets if symbol in selected]
+
+
+def iter_trades_unbatched(exchange: ccxt.Exchange,
+                          limiter: TokenBucket,
+                          account: Account,
+                          full_sweep: bool = True,
+                          failed: dict = None):
     """
     Some exchanges like Binance don't support fetching all trades at
     once and need to fetch per trading pair (market).
+    Only trades newer than the market's cursor are yielded, market by
+    market. Unless full_sweep is True only the markets selected by
+    select_markets are polled. With EXCHANGE_ASYNC_FETCH enabled the
+    markets are fetched concurrently, see iter_trades_concurrently.
+    Markets that still fail after retrying are skipped and their
+    errors added to failed by symbol.
     """
-    markets = exchange.load_markets()
-    trades = []
+    if failed is None:
+        failed = {}
+    markets = load_cached_markets(exchange)
+    if not full_sweep:
+        markets = select_markets(exchange, limiter, account, markets)
+    print("Polling {} markets".format(len(markets)))
+    if ccxt_async is not None and getattr(settings, "EXCHANGE_ASYNC_FETCH",
+                                          False):
+        yield from iter_trades_concurrently(account, limiter, list(markets),
+                                            failed)
+        return
+
+    cursors = get_trade_cursors(account, markets)
     for market in markets:
         try:
-            trades += exchange.fetch_my_trades(market)
-        except ReadTimeout as err:
-            print(err)
-            continue
+            yield from iter_trades_since(exchange, limiter, cursors[market],
+                                         market)
+        except RETRY_ERRORS as err:
+            print("Fetching {} failed: {}".format(market, err))
+            failed[market] = str(err)
+
 
-        # exchange.rateLimit is milliseconds but time.sleep expects seconds
-        # plus add an extra 2 seconds as some exchanges like Bitfinex have varying rate limits
-        # and still return rate limit exceeded errors when using the value provided by CCXT
-        time.sleep((exchange.rateLimit / 1000) + 2)
-    return trades
+def get_price_lookups(trades: list) -> list:
+    """
+    Collects all (base, target, timestamp) price lookups needed
+    to calculate the book prices of the trades
+    """
+    lookups = []
+    for trade in trades:
+        split = trade["symbol"].split("/")
+        spent_currency = split[1] if trade["side"] == "buy" else split[0]
+        timestamp = calendar.timegm(
+            parser.parse(trade["datetime"]).utctimetuple())
+        for target in ("BTC", "EUR"):
+            lookups.append((spent_currency, target, timestamp))
+            lookups.append((trade["fee"]["currency"], target, timestamp))
+    return lookups
 
 
-def update_exchange_trx_generic(account: Account):
+def build_trade_entries(account: Account, trades: list) -> list:
     """
-    Fetches all trades and if older than last check imports to database
+    Turns a chunk of ccxt trades into transactions. The trades are
+    already filtered by the cursors of their markets, trades stored
+    before are dropped when saving by their external id. The book
+    prices are resolved with a few range requests before building
+    the transactions.
+
+    Arguments:
+        account {Account} -- the account the trades belong to
+        trades {list} -- the trades to import
+
+    Returns:
+        list -- (Transaction, tag names) tuples
+    """
+    prefetch_prices(get_price_lookups(trades))
+
+    entries = []
+    for trade in trades:
+        split = trade["symbol"].split("/")
+
+        trx = Transaction()
+        trx.external_id = "{}:{}".format(trade["symbol"], trade["id"])
+        if trade["side"] == "buy":
+            trx.spent_amount = trade["cost"]
+            trx.spent_currency = split[1]
+
+            trx.acquired_amount = trade["amount"]
+            trx.acquired_currency = split[0]
+        elif trade["side"] == "sell":
+            trx.spent_amount = trade["amount"]
+            trx.spent_currency = split[0]
+
+            trx.acquired_amount = trade["cost"]
+            trx.acquired_currency = split[1]
+
+        trx.fee_amount = trade["fee"]["cost"]
+        trx.fee_currency = trade["fee"]["currency"]
+
+        trx.date = trade["datetime"]
+        trx.owner = account.owner
+        trx.source_peer = account
+        trx.target_peer = account
+
+        date = parser.parse(trx.date)
+        timestamp = calendar.timegm(date.utctimetuple())
+
+        prices = [
+            resolve_name_price(trx.spent_amount, trx.spent_currency, "BTC",
+                               timestamp),
+            resolve_name_price(trx.spent_amount, trx.spent_currency, "EUR",
+                               timestamp),
+            resolve_name_price(trx.fee_amount, trx.fee_currency, "BTC",
+                               timestamp),
+            resolve_name_price(trx.fee_amount, trx.fee_currency, "EUR",
+                               timestamp)
+        ]
+        trx.book_price_btc = prices[0].value
+        trx.book_price_eur = prices[1].value
+        trx.book_price_fee_btc = prices[2].value
+        trx.book_price_fee_eur = prices[3].value
+        trx.icon = Transaction.TRX_ICON_EXCHANGE
+        tags = [account.service_type, Transaction.TRX_TAG_EXCHANGE]
+        if not all(price.priced for price in prices):
+            # import the trade anyway, the user has to check the price
+            tags.append(Transaction.TRX_TAG_WARNING)
+        entries.append((trx, tags))
+    return entries
+
+
+def update_exchange_trx_generic(account: Account, progress=None) -> dict:
+    """
+    Fetches all trades newer than the account's trade cursors
+    and imports them to the database.
+    Trades are imported in chunks while they are fetched, every chunk
+    is committed and moves the cursors, see import_in_chunks.
+    Markets that fail are resumed by the next sync.
+
+    Arguments:
+        account {Account} -- the account to sync
+
+    Keyword Arguments:
+        progress {function} -- called with the number of processed
+                               trades and imported transactions after
+                               every chunk (default: {None})
+
+    Returns:
+        dict -- the number of imported transactions and the markets
+                that are still pending
     """
     exchange: ccxt.Exchange = None
     starttime: datetime = now()
+    reset_price_stats()
 
     if hasattr(ccxt, account.service_type):
-        exchange: ccxt.Exchange = getattr(ccxt, account.service_type)({
-            "api_key":
-            account.api_key,
-            "secret":
-            account.api_secret
-        })
+        exchange: ccxt.Exchange = get_exchange(
+            account.service_type, account.api_key, account.api_secret)
     else:
         print("nope")
 
-    last_update_query: QuerySet = TransactionUpdateHistoryEntry.objects.filter(
-        account=account).order_by('-date')
-    latest_update = datetime.utcfromtimestamp(0).replace(tzinfo=timezone.utc)
+    # one limiter for all requests of the sync
+    limiter = get_exchange_limiter(exchange, account.api_key)
+    batched = exchange_can_batch(account.service_type)
+    full_sweep = batched or needs_full_sweep(account)
+    resumed = get_pending_markets(account)
+    failed = {}
+    if batched:
+        trades = iter_trades_since(exchange, limiter, get_trade_cursor(account))
+    else:
+        trades = iter_trades_unbatched(exchange, limiter, account, full_sweep,
+                                       failed)
 
-    if last_update_query.count():
-        latest_update = last_update_query[:1][0].date
+    num_imports = import_in_chunks(
+        trades,
+        lambda chunk: build_trade_entries(account, chunk),
+        # only move the cursors once the trades are stored
+        after_save=lambda chunk: advance_trade_cursors(account, chunk, batched),
+        progress=progress)
 
-    transactions = []
-    trades = []
-    if exchange_can_batch(account.service_type):
-        trades = exchange.fetch_my_trades()
-    else:
-        trades = fetch_trades_unbatched(exchange)
-
-    total = len(trades)
-    num_imports = 0
-
-    if trades:
-        for trade in trades:
-            # print(trade["symbol"] + " " + trade["datetime"])
-
-            trade_date = parser.parse(trade["datetime"])
-            if trade_date <= latest_update:
-                print("skiping ", trade["symbol"] + " " + trade["datetime"])
-                continue
-
-            split = trade["symbol"].split("/")
-
-            trx = Transaction()
-            if trade["side"] == "buy":
-                trx.spent_amount = trade["cost"]
-                trx.spent_currency = split[1]
-
-                trx.acquired_amount = trade["amount"]
-                trx.acquired_currency = split[0]
-            elif trade["side"] == "sell":
-                trx.spent_amount = trade["amount"]
-                trx.spent_currency = split[0]
-
-                trx.acquired_amount = trade["cost"]
-                trx.acquired_currency = split[1]
-
-            trx.fee_amount = trade["fee"]["cost"]
-            trx.fee_currency = trade["fee"]["currency"]
-
-            trx.date = trade["datetime"]
-            trx.owner = account.owner
-            trx.source_peer = account
-            trx.target_peer = account
-
-            date = parser.parse(trx.date)
-            timestamp = time.mktime(date.timetuple())
-
-            trx.book_price_btc = get_name_price(
-                trx.spent_amount, trx.spent_currency, "BTC", timestamp)
-            trx.book_price_eur = get_name_price(
-                trx.spent_amount, trx.spent_currency, "EUR", timestamp)
-            trx.book_price_fee_btc = get_name_price(
-                trx.fee_amount, trx.fee_currency, "BTC", timestamp)
-            trx.book_price_fee_eur = get_name_price(
-                trx.fee_amount, trx.fee_currency, "EUR", timestamp)
-            trx.icon = Transaction.TRX_ICON_EXCHANGE
-            trx.save()
-            trx.tags.add(account.service_type, Transaction.TRX_TAG_EXCHANGE)
-            trx.save()
-            num_imports += 1
-            time.sleep(0.2)  # avoid hammering the API's
+    update_checkpoints(account, resumed, failed)
 
     print("Imported {} trades.".format(num_imports))
+    if failed:
+        print("Pending markets: {}".format(", ".join(sorted(failed))))
+    print("Price lookups: {lookups} hit rate: {hit_rate:.0%}".format(
+        **get_price_stats()))
     entry: TransactionUpdateHistoryEntry = TransactionUpdateHistoryEntry(
-        date=starttime, account=account, fetched_transactions=num_imports)
+        date=starttime,
+        account=account,
+        fetched_transactions=num_imports,
+        full_sweep=full_sweep)
     entry.save()
+
+    return {"imported": num_imports, "pending": sorted(failed)}
@@ -1,8 +1,9 @@
 """Livecoin exchange importer functions"""
 import time
 
-from backend.utils.utils import get_name_price
+from backend.utils.utils import resolve_name_price, prefetch_prices
 from backend.transactions.models import Transaction
+from backend.transactions.bulk import bulk_save_transactions
 import arrow
 from backend.accounts.models import Peer
 
@@ -18,12 +19,27 @@ def import_data_livecoin(data, user):
         Transaction -- List with the imported transactions
     """
 
-    transactions = []
+    entries = []
     peer_cache = {}
-    for trx_input in data.transactions:  # type: TransactionData
-        if trx_input.transaction_type_raw == "Deposit":
-            continue
 
+    inputs = [
+        trx_input for trx_input in data.transactions
+        if trx_input.transaction_type_raw != "Deposit"
+    ]
+
+    # resolve all book prices with a few range requests before
+    # building the transactions
+    lookups = []
+    for trx_input in inputs:  # type: TransactionData
+        timestamp = arrow.get(trx_input.date, "DD.MM.YYYY HH:mm:ss").timestamp
+        for currency in (trx_input.spent_currency,
+                         trx_input.acquired_currency,
+                         trx_input.fee_currency):
+            lookups.append((currency, "BTC", timestamp))
+            lookups.append((currency, "EUR", timestamp))
+    prefetch_prices(lookups)
+
+    for trx_input in inputs:  # type: TransactionData
         trx = Transaction()
         date = arrow.get(trx_input.date, "DD.MM.YYYY HH:mm:ss")
         timestamp = date.timestamp
@@ -32,26 +48,35 @@ def import_data_livecoin(data, user):
 
         # calculate book price by spent amount
         book_price_ok = False
+        prices = []
         if trx_input.spent_amount > 0 and trx_input.spent_currency is not "":
             trx.spent_amount = trx_input.spent_amount
             trx.spent_currency = trx_input.spent_currency
 
-            trx.book_price_btc = get_name_price(
-                trx.spent_amount, trx.spent_currency, "BTC", timestamp)
-            trx.book_price_eur = get_name_price(
-                trx.spent_amount, trx.spent_currency, "EUR", timestamp)
+            prices.append(
+                resolve_name_price(trx.spent_amount, trx.spent_currency,
+                                   "BTC", timestamp))
+            prices.append(
+                resolve_name_price(trx.spent_amount, trx.spent_currency,
+                                   "EUR", timestamp))
+            trx.book_price_btc = prices[-2].value
+            trx.book_price_eur = prices[-1].value
             book_price_ok = True
 
         if trx_input.acquired_amount > 0 and trx_input.acquired_currency is not "":
             trx.acquired_amount = trx_input.acquired_amount
             trx.acquired_currency = trx_input.acquired_currency
             if not book_price_ok:
-                trx.book_price_btc = get_name_price(trx.acquired_amount,
-                                                    trx.acquired_currency,
-                                                    "BTC", timestamp)
-                trx.book_price_eur = get_name_price(trx.acquired_amount,
-                                                    trx.acquired_currency,
-                                                    "EUR", timestamp)
+                prices.append(
+                    resolve_name_price(trx.acquired_amount,
+                                       trx.acquired_currency, "BTC",
+                                       timestamp))
+                prices.append(
+                    resolve_name_price(trx.acquired_amount,
+                                       trx.acquired_currency, "EUR",
+                                       timestamp))
+                trx.book_price_btc = prices[-2].value
+                trx.book_price_eur = prices[-1].value
         # if trx_input.source_peer not in trx
         trx.source_peer = Peer(pk=trx_input.source_peer)
         trx.target_peer = Peer(pk=trx_input.target_peer)
@@ -59,35 +84,37 @@ def import_data_livecoin(data, user):
         if trx_input.fee_amount > 0:
             trx.fee_amount = trx_input.fee_amount
             trx.fee_currency = trx_input.fee_currency
-            trx.book_price_fee_btc = get_name_price(
-                trx.fee_amount, trx.fee_currency, "BTC", timestamp)
-            trx.book_price_fee_eur = get_name_price(
-                trx.fee_amount, trx.fee_currency, "EUR", timestamp)
+            prices.append(
+                resolve_name_price(trx.fee_amount, trx.fee_currency, "BTC",
+                                   timestamp))
+            prices.append(
+                resolve_name_price(trx.fee_amount, trx.fee_currency, "EUR",
+                                   timestamp))
+            trx.book_price_fee_btc = prices[-2].value
+            trx.book_price_fee_eur = prices[-1].value
 
+        tags = [data.service_type, data.import_mechanism]
         if trx_input.transaction_type == "exchange":
             trx.icon = Transaction.TRX_ICON_EXCHANGE
-            trx.save()
-            trx.tags.add(data.service_type, data.import_mechanism,
-                         Transaction.TRX_TAG_EXCHANGE)
+            tags.append(Transaction.TRX_TAG_EXCHANGE)
         elif trx_input.transaction_type == "income":
             trx.icon = Transaction.TRX_ICON_INCOME
-            trx.save()
-            trx.tags.add(data.service_type, data.import_mechanism,
-                         Transaction.TRX_TAG_INCOME)
+            tags.append(Transaction.TRX_TAG_INCOME)
         elif trx_input.transaction_type == "transfer":
             trx.icon = Transaction.TRX_ICON_TRANSFER
-            trx.save()
-            trx.tags.add(data.service_type, data.import_mechanism,
-                         Transaction.TRX_TAG_TRANSFER)
+            tags.append(Transaction.TRX_TAG_TRANSFER)
         else:
             trx.icon = Transaction.TRX_ICON_WARNING
-            trx.save()
-            trx.tags.add(data.service_type, data.import_mechanism,
-                         Transaction.TRX_TAG_WARNING)
+            tags.append(Transaction.TRX_TAG_WARNING)
+
+        if not all(price.priced for price in prices) and \
+                Transaction.TRX_TAG_WARNING not in tags:
+            # import the transaction anyway, the user has to check the price
+            tags.append(Transaction.TRX_TAG_WARNING)
 
         if trx_input.tags:
-            for tag in trx_input.tags:
-                trx.tags.add(tag)
-        trx.save()
-        transactions.append(trx)
+            tags.extend(trx_input.tags)
+        entries.append((trx, tags))
+
+    transactions = bulk_save_transactions(entries)
     return transactions
@@ -0,0 +1,28 @@
+# Generated by Django 2.0.5 on 2026-10-18 13:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0007_auto_20180510_1515'),
+        ('transactions', '0005_auto_20180412_1710'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TradeSyncCursor',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('market', models.CharField(blank=True, default='', max_length=20)),
+                ('last_timestamp', models.BigIntegerField(default=0)),
+                ('last_trade_id', models.CharField(blank=True, default='', max_length=100)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='accounts.Account')),
+            ],
+            options={
+                'unique_together': {('account', 'market')},
+            },
+        ),
+    ]
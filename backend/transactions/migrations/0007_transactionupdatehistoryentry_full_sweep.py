@@ -0,0 +1,18 @@
+# Generated by Django 2.0.5 on 2026-10-18 13:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0006_tradesynccursor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transactionupdatehistoryentry',
+            name='full_sweep',
+            field=models.BooleanField(default=False),
+        ),
+    ]
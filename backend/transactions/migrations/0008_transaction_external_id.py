@@ -0,0 +1,23 @@
+# Generated by Django 2.0.5 on 2026-10-18 15:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0008_exchangemarkets'),
+        ('transactions', '0007_transactionupdatehistoryentry_full_sweep'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='external_id',
+            field=models.CharField(blank=True, default=None, max_length=100, null=True),
+        ),
+        migrations.AlterUniqueTogether(
+            name='transaction',
+            unique_together={('source_peer', 'external_id')},
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.0.5 on 2026-10-18 16:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0008_transaction_external_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='tradesynccursor',
+            name='last_error',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='tradesynccursor',
+            name='pending',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.0.5 on 2026-10-18 17:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0008_exchangemarkets'),
+        ('transactions', '0009_tradesynccursor_pending'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CoinbaseSyncCursor',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('wallet_id', models.CharField(max_length=100)),
+                ('resource', models.CharField(max_length=20)),
+                ('last_id', models.CharField(blank=True, default='', max_length=100)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='accounts.Account')),
+            ],
+            options={
+                'unique_together': {('account', 'wallet_id', 'resource')},
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.0.5 on 2026-10-18 17:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0010_coinbasesynccursor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transactionupdatehistoryentry',
+            name='avoided_requests',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.0.5 on 2026-10-18 19:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('transactions', '0011_transactionupdatehistoryentry_avoided_requests'),
+    ]
+
+    operations = [
+        # the existing entries are from syncs without cursors
+        migrations.AddField(
+            model_name='transactionupdatehistoryentry',
+            name='cursor_sync',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='transactionupdatehistoryentry',
+            name='cursor_sync',
+            field=models.BooleanField(default=True),
+        ),
+    ]
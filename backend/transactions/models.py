@@ -36,9 +36,16 @@ class Transaction(models.Model):
 
     class Meta:
         ordering = ('-date', )
+        unique_together = (("source_peer", "external_id"), )
 
     id = models.AutoField(primary_key=True)
 
+    # id of the trade or transaction at the exchange it was imported
+    # from, prefixed with the market for exchanges that number trades
+    # per market. None for imports without ids like CSV files
+    external_id = models.CharField(
+        max_length=100, blank=True, null=True, default=None)
+
     owner = models.ForeignKey(
         related_name='owner',
         to='auth.user',
@@ -106,6 +113,83 @@ class TransactionUpdateHistoryEntry(models.Model):
 
     fetched_transactions = models.IntegerField()
 
+    # True if all markets of the exchange were checked for trades
+    full_sweep = models.BooleanField(default=False)
+
+    # requests the sync didn't need to send, e.g. for dormant wallets
+    avoided_requests = models.IntegerField(default=0)
+
+    # False for syncs from before the sync cursors existed. They
+    # imported transactions without external ids, so what they
+    # imported can only be told apart by date.
+    cursor_sync = models.BooleanField(default=True)
+
     def __str__(self):
         return "{} {} {}".format(self.account.id, self.date,
                                  self.fetched_transactions)
+
+
+class TradeSyncCursor(models.Model):
+    """
+    High-water mark of the trades imported from an exchange, so a sync
+    only has to fetch newer trades. It is also the checkpoint a failed
+    market is resumed from. Exchanges that can't fetch all
+    trades at once have one cursor per market, all others use a single
+    cursor with an empty market.
+    """
+
+    class Meta:
+        unique_together = (("account", "market"), )
+
+    id = models.AutoField(primary_key=True)
+
+    account = models.ForeignKey(
+        to='accounts.Account',
+        on_delete=models.CASCADE,
+    )
+
+    market = models.CharField(max_length=20, blank=True, default="")
+
+    # timestamp in milliseconds and id of the newest imported trade
+    last_timestamp = models.BigIntegerField(default=0)
+    last_trade_id = models.CharField(max_length=100, blank=True, default="")
+
+    # True if fetching the market failed in the last sync, the next
+    # sync resumes it from the cursor
+    pending = models.BooleanField(default=False)
+    last_error = models.CharField(max_length=255, blank=True, default="")
+
+    def __str__(self):
+        return "{} {} {}".format(self.account.id, self.market or "*",
+                                 self.last_timestamp)
+
+
+class CoinbaseSyncCursor(models.Model):
+    """
+    Position of a sync in the transfers, buys or sells of a Coinbase
+    wallet. The items are paged oldest first starting after last_id,
+    so a sync only downloads items it hasn't seen before.
+    """
+
+    class Meta:
+        unique_together = (("account", "wallet_id", "resource"), )
+
+    id = models.AutoField(primary_key=True)
+
+    account = models.ForeignKey(
+        to='accounts.Account',
+        on_delete=models.CASCADE,
+    )
+
+    wallet_id = models.CharField(max_length=100)
+
+    # "transfers", "buys" or "sells"
+    resource = models.CharField(max_length=20)
+
+    # id of the newest item that won't change anymore, empty if the
+    # wallet was never synced
+    last_id = models.CharField(max_length=100, blank=True, default="")
+
+    def __str__(self):
+        return "{} {} {} {}".format(self.account.id, self.wallet_id,
+                                    self.resource, self.last_id)
@@ -0,0 +1,91 @@
+"""
+Contains the streaming import pipeline. Fetchers yield the records of
+their source page by page, the pipeline groups them into chunks and
+builds, prices and stores one chunk at a time. Memory stays bounded by
+the chunk size and every stored chunk is committed, so an interrupted
+sync keeps its progress.
+"""
+
+from datetime import datetime
+from itertools import islice
+from django.conf import settings
+
+from backend.accounts.models import Account
+from backend.transactions.bulk import bulk_save_transactions
+from backend.transactions.models import TransactionUpdateHistoryEntry
+
+
+def get_legacy_sync_date(account: Account) -> datetime:
+    """
+    Returns the date of the account's last sync from before the sync
+    cursors existed or None if there is none. The transactions that
+    sync imported have no external ids, so a source without a cursor
+    must skip everything up to that date to not import them again.
+    """
+    return TransactionUpdateHistoryEntry.objects.filter(
+        account=account, cursor_sync=False).order_by("-date").values_list(
+            "date", flat=True).first()
+
+
+def chunked(records, size: int):
+    """
+    Groups an iterable into lists of at most size records
+
+    Arguments:
+        records {iterable} -- the records to group
+        size {int} -- the maximum size of a chunk
+    """
+    records = iter(records)
+    while True:
+        chunk = list(islice(records, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def import_in_chunks(records,
+                     build_entries,
+                     after_save=None,
+                     progress=None,
+                     chunk_size: int = None) -> int:
+    """
+    Imports records chunk by chunk. Every chunk is turned into
+    transactions by build_entries and saved in its own database
+    transaction before the next chunk is fetched.
+
+    Arguments:
+        records {iterable} -- the records to import, usually a generator
+                              paging through the source
+        build_entries {function} -- called with a chunk of records,
+                                    returns (Transaction, tag names)
+                                    tuples, see bulk_save_transactions
+
+    Keyword Arguments:
+        after_save {function} -- called with every chunk once it is
+                                 saved, e.g. to move sync cursors
+                                 (default: {None})
+        progress {function} -- called with the number of processed
+                               records and imported transactions after
+                               every chunk (default: {None})
+        chunk_size {int} -- records per chunk
+                            (default: {IMPORT_CHUNK_SIZE})
+
+    Returns:
+        int -- the number of imported transactions
+    """
+    if chunk_size is None:
+        chunk_size = getattr(settings, "IMPORT_CHUNK_SIZE", 500)
+
+    processed = 0
+    imported = 0
+    for chunk in chunked(records, chunk_size):
+        imported += len(bulk_save_transactions(build_entries(chunk)))
+        if after_save is not None:
+            after_save(chunk)
+
+        processed += len(chunk)
+        print("Processed {} records, imported {} transactions".format(
+            processed, imported))
+        if progress is not None:
+            progress(processed, imported)
+    return imported
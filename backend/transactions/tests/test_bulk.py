@@ -0,0 +1,124 @@
+"""Contains all tests for the bulk write path"""
+
+import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from mixer.backend.django import mixer
+from taggit.models import Tag
+
+from backend.transactions.models import Transaction
+
+from .. import bulk
+from ..bulk import bulk_save_transactions
+
+pytestmark = pytest.mark.django_db
+
+
+def new_transaction(account, amount: float) -> Transaction:
+    trx = Transaction()
+    trx.date = "2018-01-10T06:03:29.213Z"
+    trx.owner = account.owner
+    trx.source_peer = account
+    trx.target_peer = account
+    trx.spent_amount = amount
+    trx.book_price_eur = amount * 100
+    trx.book_price_btc = amount
+    return trx
+
+
+def test_bulk_save_transactions():
+    """
+    Tests that transactions are saved with their tags,
+    existing tags are reused and duplicate tags are dropped
+    """
+    account = mixer.blend("accounts.Account")
+    Tag.objects.create(name="binance")
+
+    entries = [(new_transaction(account, amount), ["binance", "exchange"])
+               for amount in range(1, 8)]
+    entries.append((new_transaction(account, 10), ["binance", "warning", "",
+                                                "warning"]))
+
+    with CaptureQueriesContext(connection) as queries:
+        saved = bulk_save_transactions(entries, chunk_size=3)
+
+    assert len(saved) == 8
+    assert Transaction.objects.count() == 8
+    assert Tag.objects.filter(name="binance").count() == 1
+    assert set(Transaction.objects.get(spent_amount=10).tags.names()) == {
+        "binance", "warning"
+    }
+    assert Transaction.objects.filter(tags__name="exchange").count() == 7
+
+    # the tags are linked with one insert per chunk
+    inserts = [
+        query for query in queries.captured_queries
+        if query["sql"].startswith("INSERT INTO \"taggit_taggeditem\"")
+    ]
+    assert len(inserts) == 3
+
+    assert bulk_save_transactions([]) == []
+
+
+def test_bulk_save_transactions_external_ids():
+    """
+    Tests that transactions imported before and duplicates within
+    a batch are skipped, transactions without an external id never are
+    """
+    account = mixer.blend("accounts.Account")
+    other = mixer.blend("accounts.Account")
+
+    existing = new_transaction(account, 1)
+    existing.external_id = "1"
+    existing.save()
+
+    entries = []
+    for amount, external_id, peer in ((1, "1", account), (2, "2", account),
+                                      (3, "2", account), (4, "1", other),
+                                      (5, None, account), (6, None, account)):
+        trx = new_transaction(peer, amount)
+        trx.external_id = external_id
+        entries.append((trx, ["exchange"]))
+
+    saved = bulk_save_transactions(entries)
+
+    assert [trx.spent_amount for trx in saved] == [2, 4, 5, 6]
+    assert Transaction.objects.count() == 5
+    assert Transaction.objects.filter(tags__name="exchange").count() == 4
+
+    # repeating the sync doesn't import anything new
+    entries = [(new_transaction(account, 2), [])]
+    entries[0][0].external_id = "2"
+    assert bulk_save_transactions(entries) == []
+
+
+def test_bulk_save_transactions_skip_conflicts(monkeypatch):
+    """
+    Tests that transactions imported before are skipped by the insert
+    without querying them first on databases that support it
+    """
+    monkeypatch.setattr(bulk, "_skips_conflicts", lambda: True)
+    account = mixer.blend("accounts.Account")
+
+    existing = new_transaction(account, 1)
+    existing.external_id = "1"
+    existing.save()
+
+    entries = []
+    for amount, external_id in ((1, "1"), (2, "2"), (3, "2"), (4, None)):
+        trx = new_transaction(account, amount)
+        trx.external_id = external_id
+        entries.append((trx, ["exchange"]))
+
+    with CaptureQueriesContext(connection) as queries:
+        saved = bulk_save_transactions(entries)
+
+    assert [trx.spent_amount for trx in saved] == [2, 4]
+    assert all(trx.pk for trx in saved)
+    assert Transaction.objects.count() == 3
+    assert Transaction.objects.filter(tags__name="exchange").count() == 2
+    assert not [
+        query for query in queries.captured_queries
+        if query["sql"].startswith("SELECT") and
+        "\"transactions_transaction\"" in query["sql"]
+    ]
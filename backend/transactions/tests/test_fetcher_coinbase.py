@@ -1,15 +1,21 @@
 from datetime import datetime, timedelta
 import json
+import threading
+import time
 import pytest
 from django.utils.timezone import now
 from _pytest.monkeypatch import MonkeyPatch
 from mixer.backend.django import mixer
 import coinbase
-import cryptocompare
+
+import backend.utils.utils as utils
+from backend.utils.tests.prices import patch_historical_price
 
 from backend.accounts.models import Account
-from backend.transactions.models import Transaction
+from backend.transactions.models import Transaction, CoinbaseSyncCursor
+from backend.transactions.models import TransactionUpdateHistoryEntry
 
+from ..fetchers import coinbase as coinbase_fetcher
 from ..fetchers.coinbase import update_coinbase_trx
 
 pytestmark = pytest.mark.django_db
@@ -29,7 +35,7 @@ class MockAPIObject(dict):
         return self.__pagination
 
 
-def new_get_accounts(self):
+def new_get_accounts(self, **params):
     """Fake coinbase get accounts for user"""
     return MockAPIObject(data=[{
         "id": "fiat_id",
@@ -45,12 +51,13 @@ def new_get_accounts(self):
     }])
 
 
-def new_get_buys(self, cb_account_id):
+def new_get_buys(self, cb_account_id, **params):
     """Fake get buys for account"""
     if cb_account_id == "wallet_id_btc":
         return MockAPIObject(data=[
             {
                 "created_at": "2017-12-27T15:16:22Z",
+                "id": "buy-1",
                 "resource": "buy",
                 "status": "completed",
                 "amount": {
@@ -70,12 +77,14 @@ def new_get_buys(self, cb_account_id):
             },
             {
                 "created_at": "2017-12-27T15:16:22Z",
+                "id": "buy-2",
                 "resource": "buy",
                 # should be skipped since it was canceled
                 "status": "canceled"
             },
             {
                 "created_at": "2018-01-28T13:11:35Z",
+                "id": "buy-3",
                 "resource": "buy",
                 "status": "completed",
                 "amount": {
@@ -97,6 +106,7 @@ def new_get_buys(self, cb_account_id):
                 "created_at": "2018-01-28T13:11:35Z",
                 # should be skipped and not end up in the database (neither sell nor buy)
                 # and it's status is canceled
+                "id": "buy-4",
                 "resource": "should be skipped",
                 "status": "canceled",
                 "amount": {
@@ -119,6 +129,7 @@ def new_get_buys(self, cb_account_id):
         return MockAPIObject(
             data=[{
                 "created_at": "2018-01-22T12:26:35Z",
+                "id": "buy-5",
                 "resource": "buy",
                 "status": "completed",
                 "amount": {
@@ -137,6 +148,7 @@ def new_get_buys(self, cb_account_id):
                 }]
             }, {
                 "created_at": "2018-01-22T11:04:01Z",
+                "id": "buy-6",
                 "resource": "buy",
                 "status": "completed",
                 "amount": {
@@ -158,12 +170,13 @@ def new_get_buys(self, cb_account_id):
         return MockAPIObject()
 
 
-def new_get_sells(self, cb_account_id):
+def new_get_sells(self, cb_account_id, **params):
     """Fake get sells for account"""
     if cb_account_id == "wallet_id_btc":
         return MockAPIObject(
             data=[{
                 "created_at": "2018-01-25T11:24:52Z",
+                "id": "sell-7",
                 "resource": "sell",
                 "status": "completed",
                 "amount": {
@@ -185,6 +198,7 @@ def new_get_sells(self, cb_account_id):
         return MockAPIObject(
             data=[{
                 "created_at": "2018-01-23T07:23:54Z",
+                "id": "sell-8",
                 "resource": "sell",
                 "status": "completed",
                 "amount": {
@@ -206,7 +220,7 @@ def new_get_sells(self, cb_account_id):
         return MockAPIObject()
 
 
-def new_get_transactions(self, cb_account_id):
+def new_get_transactions(self, cb_account_id, **params):
     """Fake get transactions for account"""
     if cb_account_id == "wallet_id_ltc":
         return MockAPIObject(data=[{
@@ -289,7 +303,7 @@ def new_get_transactions(self, cb_account_id):
             }
         }, 
         {
-            "id": "aaaaaaaaa-aaaa-aaaaaa-eeee-aaaaaa",
+            "id": "aaaaaaaaa-aaaa-aaaaaa-ffff-aaaaaa",
             "type": "send",
             "status": "completed",
             "amount": {
@@ -331,8 +345,9 @@ def test_refresh_coinbase_trx(monkeypatch: MonkeyPatch):
     account: Account = mixer.blend(
         "accounts.Account", owner=user, service_type="coinbase", api_key="123", api_secret="456")
 
-    monkeypatch.setattr(cryptocompare, "get_historical_price",
-                        new_get_historical_price)
+    patch_historical_price(monkeypatch, new_get_historical_price)
+    monkeypatch.setattr(utils, "fetch_price_histories",
+                        lambda requests: [{} for request in requests])
     monkeypatch.setattr(coinbase.wallet.client.Client, "get_accounts",
                         new_get_accounts)
     monkeypatch.setattr(coinbase.wallet.client.Client, "get_transactions",
@@ -347,78 +362,423 @@ def test_refresh_coinbase_trx(monkeypatch: MonkeyPatch):
     assert transaction.count() == 9, "Should import nine transations"
 
 
-def new_get_buys_transaction_history(self, cb_account):
+def new_get_buys_transaction_history(self, cb_account, **params):
     """Fake coinbase get buys transation history"""
     date: datetime = now()
     if cb_account == "wallet_id_btc":
-        return MockAPIObject(
-            data=[{
-                "created_at": str(date + timedelta(days=-1)),
-                "resource": "buy",
-                "status": "completed",
+        buys = [{
+            "created_at": str(date + timedelta(days=-1)),
+            "id": "buy-9",
+            "resource": "buy",
+            "status": "completed",
+            "amount": {
+                "amount": 10,
+                "currency": "BTC"
+            },
+            "total": {
+                "amount": 10,
+                "currency": "BTC"
+            },
+            "fees": [{
                 "amount": {
-                    "amount": 10,
-                    "currency": "BTC"
-                },
-                "total": {
-                    "amount": 10,
-                    "currency": "BTC"
-                },
-                "fees": [{
-                    "amount": {
-                        "amount": 1,
-                        "currency": "EUR"
-                    }
-                }]
-            }, {
-                "created_at": str(date + timedelta(days=1)),
-                "resource": "buy",
-                "status": "completed",
+                    "amount": 1,
+                    "currency": "EUR"
+                }
+            }]
+        }, {
+            "created_at": str(date + timedelta(days=1)),
+            "id": "buy-10",
+            "resource": "buy",
+            "status": "completed",
+            "amount": {
+                "amount": 5,
+                "currency": "BTC"
+            },
+            "total": {
+                "amount": 5,
+                "currency": "BTC"
+            },
+            "fees": [{
                 "amount": {
-                    "amount": 5,
-                    "currency": "BTC"
-                },
-                "total": {
-                    "amount": 5,
-                    "currency": "BTC"
-                },
-                "fees": [{
-                    "amount": {
-                        "amount": 0.5,
-                        "currency": "EUR"
-                    }
-                }]
-            }])
+                    "amount": 0.5,
+                    "currency": "EUR"
+                }
+            }]
+        }]
+        if "starting_after" in params:
+            ids = [buy["id"] for buy in buys]
+            buys = buys[ids.index(params["starting_after"]) + 1:]
+        return MockAPIObject(data=buys)
     else:
         return MockAPIObject()
 
 
 def test_update_trx_coinbase_transaction_history(monkeypatch: MonkeyPatch):
-    """  Test, that the update function does not import  """
+    """  Test, that the update function does not import transactions
+    before the cursor of their wallet  """
     user = mixer.blend("auth.User")
     account: Account = mixer.blend(
         "accounts.Account", owner=user, service_type="coinbase", api_key="123", api_secret="456")
 
     date: datetime = now()
 
-    monkeypatch.setattr(cryptocompare, "get_historical_price",
-                        new_get_historical_price)
+    patch_historical_price(monkeypatch, new_get_historical_price)
+    monkeypatch.setattr(utils, "fetch_price_histories",
+                        lambda requests: [{} for request in requests])
     monkeypatch.setattr(coinbase.wallet.client.Client, "get_accounts",
                         new_get_accounts)
     monkeypatch.setattr(coinbase.wallet.client.Client, "get_transactions",
-                        new_get_transactions)
+                        lambda self, cb_account, **params: MockAPIObject())
     monkeypatch.setattr(coinbase.wallet.client.Client, "get_buys",
                         new_get_buys_transaction_history)
     monkeypatch.setattr(coinbase.wallet.client.Client, "get_sells",
-                        lambda self, cb_account: MockAPIObject())
+                        lambda self, cb_account, **params: MockAPIObject())
 
     mixer.blend(
         "transactions.TransactionUpdateHistoryEntry",
         date=date,
         account=account,
         fetched_transactions=3)
+    mixer.blend(
+        "transactions.CoinbaseSyncCursor",
+        account=account,
+        wallet_id="wallet_id_btc",
+        resource="buys",
+        last_id="buy-9")
 
     update_coinbase_trx(account)
     transaction = Transaction.objects.filter(target_peer=account)
     assert transaction.count(
-    ) == 1, "Should not import transactions older than last update time"
+    ) == 1, "Should not import transactions before the cursor"
+
+
+def test_update_coinbase_trx_upgrade(monkeypatch: MonkeyPatch):
+    """Test that the first sync after the cursors were introduced
+    doesn't import the transactions of the syncs before them again"""
+    user = mixer.blend("auth.User")
+    account: Account = mixer.blend(
+        "accounts.Account", owner=user, service_type="coinbase", api_key="123", api_secret="456")
+
+    patch_historical_price(monkeypatch, new_get_historical_price)
+    monkeypatch.setattr(utils, "fetch_price_histories",
+                        lambda requests: [{} for request in requests])
+    monkeypatch.setattr(coinbase.wallet.client.Client, "get_accounts",
+                        new_get_accounts)
+    monkeypatch.setattr(coinbase.wallet.client.Client, "get_transactions",
+                        lambda self, cb_account, **params: MockAPIObject())
+    monkeypatch.setattr(coinbase.wallet.client.Client, "get_buys",
+                        new_get_buys_transaction_history)
+    monkeypatch.setattr(coinbase.wallet.client.Client, "get_sells",
+                        lambda self, cb_account, **params: MockAPIObject())
+
+    # imported buy-9 without an external id
+    mixer.blend(
+        "transactions.TransactionUpdateHistoryEntry",
+        date=now(),
+        account=account,
+        fetched_transactions=1,
+        cursor_sync=False)
+
+    assert update_coinbase_trx(account)["imported"] == 1
+    assert Transaction.objects.filter(
+        source_peer=account, external_id="buy-10").exists()
+    cursor = CoinbaseSyncCursor.objects.get(
+        account=account, wallet_id="wallet_id_btc", resource="buys")
+    assert cursor.last_id == "buy-10"
+
+
+def test_update_coinbase_trx_pending_buy(monkeypatch: MonkeyPatch):
+    """Test that a buy pending during a sync is imported by the sync
+    after it completed, although it was created before that sync"""
+    user = mixer.blend("auth.User")
+    account: Account = mixer.blend(
+        "accounts.Account", owner=user, service_type="coinbase", api_key="123", api_secret="456")
+
+    buy = {
+        "created_at": "2018-01-05T15:00:00Z",
+        "id": "buy-pending",
+        "resource": "buy",
+        "status": "pending",
+        "amount": {
+            "amount": 1,
+            "currency": "BTC"
+        },
+        "total": {
+            "amount": 1,
+            "currency": "BTC"
+        },
+        "fees": [{
+            "amount": {
+                "amount": 0.1,
+                "currency": "EUR"
+            }
+        }]
+    }
+
+    def get_buys(self, cb_account_id, **params):
+        if cb_account_id != "wallet_id_btc":
+            return MockAPIObject()
+        return MockAPIObject(data=[buy])
+
+    patch_historical_price(monkeypatch, new_get_historical_price)
+    monkeypatch.setattr(utils, "fetch_price_histories",
+                        lambda requests: [{} for request in requests])
+    monkeypatch.setattr(coinbase.wallet.client.Client, "get_accounts",
+                        new_get_accounts)
+    monkeypatch.setattr(coinbase.wallet.client.Client, "get_transactions",
+                        lambda self, cb_account, **params: MockAPIObject())
+    monkeypatch.setattr(coinbase.wallet.client.Client, "get_buys", get_buys)
+    monkeypatch.setattr(coinbase.wallet.client.Client, "get_sells",
+                        lambda self, cb_account, **params: MockAPIObject())
+
+    assert update_coinbase_trx(account)["imported"] == 0
+
+    buy["status"] = "completed"
+    assert update_coinbase_trx(account)["imported"] == 1
+    assert Transaction.objects.filter(
+        source_peer=account, external_id="buy-pending").exists()
+
+
+def test_filter_new_cb_transactions_utc(monkeypatch: MonkeyPatch):
+    """Test that Coinbase dates are read as UTC whatever the local time
+    zone"""
+    buy = new_get_buys(None, "wallet_id_btc")["data"][0]
+    monkeypatch.setenv("TZ", "America/New_York")
+    time.tzset()
+    try:
+        records = list(
+            coinbase_fetcher.filter_new_cb_transactions("buys", [buy]))
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+    assert records == [(buy, 1514387782)]
+
+
+def test_refresh_coinbase_trx_concurrently(monkeypatch: MonkeyPatch,
+                                           settings):
+    """Test that a concurrent sync fetches the wallets in parallel
+    and imports the same transactions"""
+    settings.COINBASE_CONCURRENT_SYNC = True
+    settings.COINBASE_SYNC_WORKERS = 6
+    user = mixer.blend("auth.User")
+    account: Account = mixer.blend(
+        "accounts.Account", owner=user, service_type="coinbase", api_key="123", api_secret="456")
+
+    threads = set()
+
+    def in_thread(fetch):
+        def fetch_in_thread(self, cb_account_id, **params):
+            threads.add(threading.get_ident())
+            return fetch(self, cb_account_id, **params)
+        return fetch_in_thread
+
+    patch_historical_price(monkeypatch, new_get_historical_price)
+    monkeypatch.setattr(utils, "fetch_price_histories",
+                        lambda requests: [{} for request in requests])
+    monkeypatch.setattr(coinbase.wallet.client.Client, "get_accounts",
+                        new_get_accounts)
+    monkeypatch.setattr(coinbase.wallet.client.Client, "get_transactions",
+                        in_thread(new_get_transactions))
+    monkeypatch.setattr(coinbase.wallet.client.Client, "get_buys",
+                        in_thread(new_get_buys))
+    monkeypatch.setattr(coinbase.wallet.client.Client, "get_sells",
+                        in_thread(new_get_sells))
+
+    update_coinbase_trx(account)
+    transaction = Transaction.objects.filter(target_peer=account)
+    assert transaction.count() == 9, "Should import nine transations"
+    assert threading.get_ident() not in threads
+
+
+def test_update_coinbase_trx_cursors(monkeypatch: MonkeyPatch):
+    """Test that syncs page oldest first from the stored wallet cursors
+    and that cursors don't move past unsettled transfers"""
+    user = mixer.blend("auth.User")
+    account: Account = mixer.blend(
+        "accounts.Account", owner=user, service_type="coinbase", api_key="123", api_secret="456")
+
+    monkeypatch.setattr(coinbase_fetcher, "CB_PAGE_LIMIT", 2)
+    sends = [{
+        "id": "send-{}".format(idx),
+        "type": "send",
+        "status": "completed",
+        "amount": {"amount": "-1.0", "currency": "LTC"},
+        "native_amount": {"amount": "-200.00", "currency": "EUR"},
+        "created_at": "2018-01-1{}T15:00:00Z".format(idx),
+        "resource": "transaction",
+        "network": {"status": "off_blockchain"},
+    } for idx in range(5)]
+    sends[3]["status"] = "pending"
+    calls = []
+
+    def get_transactions(self, cb_account_id, **params):
+        if cb_account_id != "wallet_id_ltc":
+            return MockAPIObject()
+        calls.append(params.get("starting_after"))
+        assert params["order"] == "asc"
+        start = 0
+        if "starting_after" in params:
+            start = [send["id"] for send in sends].index(
+                params["starting_after"]) + 1
+        page = sends[start:start + params["limit"]]
+        next_uri = "next" if start + params["limit"] < len(sends) else None
+        return MockAPIObject(pagination={"next_uri": next_uri}, data=page)
+
+    patch_historical_price(monkeypatch, new_get_historical_price)
+    monkeypatch.setattr(utils, "fetch_price_histories",
+                        lambda requests: [{} for request in requests])
+    monkeypatch.setattr(coinbase.wallet.client.Client, "get_accounts",
+                        new_get_accounts)
+    monkeypatch.setattr(coinbase.wallet.client.Client, "get_transactions",
+                        get_transactions)
+    monkeypatch.setattr(coinbase.wallet.client.Client, "get_buys",
+                        lambda self, cb_account, **params: MockAPIObject())
+    monkeypatch.setattr(coinbase.wallet.client.Client, "get_sells",
+                        lambda self, cb_account, **params: MockAPIObject())
+
+    update_coinbase_trx(account)
+    assert calls == [None, "send-1", "send-3"]
+    assert Transaction.objects.filter(source_peer=account).count() == 5
+    cursor = CoinbaseSyncCursor.objects.get(
+        account=account, wallet_id="wallet_id_ltc", resource="transfers")
+    assert cursor.last_id == "send-2"
+
+    calls.clear()
+    update_coinbase_trx(account)
+    assert calls == ["send-2"]
+    assert Transaction.objects.filter(source_peer=account).count() == 5
+
+
+def test_update_coinbase_trx_dormant_wallets(monkeypatch: MonkeyPatch):
+    """Test that wallets without activity since the last sync and
+    empty unused wallets are skipped and counted in the history"""
+    user = mixer.blend("auth.User")
+    account: Account = mixer.blend(
+        "accounts.Account", owner=user, service_type="coinbase", api_key="123", api_secret="456")
+    date: datetime = now()
+    mixer.blend(
+        "transactions.TransactionUpdateHistoryEntry",
+        date=date - timedelta(days=1),
+        account=account,
+        fetched_transactions=0)
+
+    wallets = [{
+        "id": "wallet_active",
+        "type": "wallet",
+        "balance": {"amount": "0.00000000", "currency": "BTC"},
+        "created_at": "2017-12-01T10:00:00Z",
+        "updated_at": str(date)
+    }, {
+        "id": "wallet_old",
+        "type": "wallet",
+        "balance": {"amount": "1.00000000", "currency": "LTC"},
+        "created_at": "2017-12-01T10:00:00Z",
+        "updated_at": str(date - timedelta(days=3))
+    }, {
+        "id": "wallet_unused",
+        "type": "wallet",
+        "balance": {"amount": "0.00000000", "currency": "ETH"},
+        "created_at": str(date),
+        "updated_at": str(date)
+    }]
+    fetched = []
+
+    def fetch(self, cb_account_id, **params):
+        fetched.append(cb_account_id)
+        return MockAPIObject()
+
+    monkeypatch.setattr(coinbase.wallet.client.Client, "get_accounts",
+                        lambda self, **params: MockAPIObject(data=wallets))
+    monkeypatch.setattr(coinbase.wallet.client.Client, "get_transactions",
+                        fetch)
+    monkeypatch.setattr(coinbase.wallet.client.Client, "get_buys", fetch)
+    monkeypatch.setattr(coinbase.wallet.client.Client, "get_sells", fetch)
+
+    result = update_coinbase_trx(account)
+    assert fetched == ["wallet_active"] * 3
+    assert result["avoided_requests"] == 6
+    entry = TransactionUpdateHistoryEntry.objects.filter(
+        account=account).latest("date")
+    assert entry.avoided_requests == 6
+
+
+def test_process_native_valuation(monkeypatch: MonkeyPatch, settings):
+    """Test that book prices are taken from Coinbase's fiat values and
+    only the BTC leg is converted with the rate of the day"""
+    settings.COINBASE_NATIVE_VALUATION = True
+    account: Account = mixer.blend("accounts.Account")
+    lookups = []
+
+    def resolve_name_price(amount, base, target, timestamp=None):
+        lookups.append((base, target, timestamp))
+        return utils.PriceResult(
+            amount * 10000 if base == "BTC" else amount, True, None)
+
+    monkeypatch.setattr(coinbase_fetcher, "resolve_name_price",
+                        resolve_name_price)
+    timestamp = 1515564209
+    day = 1515542400
+
+    buy = new_get_buys(None, "wallet_id_ltc")["data"][0]
+    trx, _ = coinbase_fetcher.process_buy_sell(buy, timestamp, account)
+    assert trx.book_price_eur == 260
+    assert trx.book_price_btc == 0.026
+    assert trx.book_price_fee_eur == 5
+    assert trx.book_price_fee_btc == pytest.approx(0.0005)
+
+    buy = new_get_buys(None, "wallet_id_btc")["data"][0]
+    trx, _ = coinbase_fetcher.process_buy_sell(buy, timestamp, account)
+    assert trx.book_price_eur == 300
+    assert trx.book_price_btc == 0.04
+
+    send = new_get_transactions(None, "wallet_id_ltc")["data"][0]
+    trx, _ = coinbase_fetcher.process_send(send, timestamp, account)
+    assert trx.book_price_eur == 46
+    assert trx.book_price_btc == 0.0046
+    assert trx.book_price_fee_eur == pytest.approx(0.23)
+    assert trx.book_price_fee_btc == pytest.approx(0.000023)
+
+    # one BTC rate per day, no lookups for BTC buys
+    assert lookups == [("BTC", "EUR", day)] * 2
+
+    # transactions without a price are imported with a warning
+    monkeypatch.setattr(
+        coinbase_fetcher, "resolve_name_price",
+        lambda amount, base, target, timestamp=None: utils.PriceResult(
+            0.0, False, "unknown"))
+    buy = new_get_buys(None, "wallet_id_ltc")["data"][0]
+    trx, tags = coinbase_fetcher.process_buy_sell(buy, timestamp, account)
+    assert trx.book_price_btc == 0.0
+    assert Transaction.TRX_TAG_WARNING in tags
+    buy = new_get_buys(None, "wallet_id_btc")["data"][0]
+    _, tags = coinbase_fetcher.process_buy_sell(buy, timestamp, account)
+    assert Transaction.TRX_TAG_WARNING not in tags
+
+
+def test_update_coinbase_trx_target_peers(monkeypatch: MonkeyPatch):
+    """Test that sends to known addresses get their peer as target"""
+    user = mixer.blend("auth.User")
+    account: Account = mixer.blend(
+        "accounts.Account", owner=user, service_type="coinbase", api_key="123", api_secret="456")
+    wallet = mixer.blend("accounts.Peer", owner=user)
+    mixer.blend(
+        "accounts.CryptoAddress",
+        peer=wallet,
+        coin=mixer.blend("coins.Coin", symbol="LTC"),
+        address="LcnAddress1")
+
+    patch_historical_price(monkeypatch, new_get_historical_price)
+    monkeypatch.setattr(utils, "fetch_price_histories",
+                        lambda requests: [{} for request in requests])
+    monkeypatch.setattr(coinbase.wallet.client.Client, "get_accounts",
+                        new_get_accounts)
+    monkeypatch.setattr(coinbase.wallet.client.Client, "get_transactions",
+                        new_get_transactions)
+    monkeypatch.setattr(coinbase.wallet.client.Client, "get_buys",
+                        lambda self, cb_account, **params: MockAPIObject())
+    monkeypatch.setattr(coinbase.wallet.client.Client, "get_sells",
+                        lambda self, cb_account, **params: MockAPIObject())
+
+    update_coinbase_trx(account)
+    transaction = Transaction.objects.get(target_peer=wallet)
+    assert transaction.external_id == "12234-6666-8888-0000-1111111111"
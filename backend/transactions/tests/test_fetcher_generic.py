@@ -1,17 +1,26 @@
 """Contains all tests for the generic exchange fetcher"""
+import asyncio
+import json
 import time
-from datetime import datetime, timedelta
+from collections import Counter
+from types import SimpleNamespace
+from datetime import datetime, timedelta, timezone
 import pytest
 from django.utils.timezone import now
 from _pytest.monkeypatch import MonkeyPatch
 from mixer.backend.django import mixer
 import ccxt
-import cryptocompare
+
+import backend.utils.rate_limit as rate_limit
+import backend.utils.utils as utils
+from backend.utils.tests.prices import patch_historical_price
 
 from backend.accounts.models import Account
 from backend.transactions.models import Transaction
 from backend.transactions.models import TransactionUpdateHistoryEntry
+from backend.transactions.models import TradeSyncCursor
 
+from ..fetchers import generic_exchange
 from ..fetchers.generic_exchange import update_exchange_trx_generic
 
 pytestmark = pytest.mark.django_db
@@ -31,7 +40,9 @@ BINANCE_CHECK_TRANSACTION_ID = 2
 BINANCE_AMOUNT = 0.20931215
 BINANCE_COST = 0.00357691
 BINANCE_PRICE = 0.01708888
+# EUR prices are calculated through BTC (LTC -> BTC x BTC -> EUR)
 BINANCE_BOOK_PRICE_EUR = \
+        new_get_historical_price("LTC", "BTC")["LTC"]["BTC"] * \
         new_get_historical_price("BTC")["BTC"]["EUR"] * BINANCE_AMOUNT
 
 
@@ -143,8 +154,9 @@ def patch_ccxt(monkeypatch: MonkeyPatch):
     monkeypatch.setattr(ccxt.binance, "fetch_my_trades", new_fetch_my_trades)
     monkeypatch.setattr(ccxt.cryptopia, "load_markets", new_load_markets)
     monkeypatch.setattr(ccxt.cryptopia, "fetch_my_trades", new_fetch_my_trades)
-    monkeypatch.setattr(cryptocompare, "get_historical_price",
-                        new_get_historical_price)
+    patch_historical_price(monkeypatch, new_get_historical_price)
+    monkeypatch.setattr(utils, "fetch_price_histories",
+                        lambda requests: [{} for request in requests])
 
 
 def test_update_exchange_trx_generic_binance(monkeypatch: MonkeyPatch):
@@ -180,7 +192,10 @@ def test_update_exchange_trx_generic_binance(monkeypatch: MonkeyPatch):
 
 def test_update_exchange_trx_generic_transaction_history(
         monkeypatch: MonkeyPatch):
-    """  Test, that the update function does not import  """
+    """
+    Test, that the update function does not import trades
+    that are not newer than the cursor of their market
+    """
     user = mixer.blend("auth.User")
     account_bin: Account = mixer.blend(
         "accounts.Account", owner=user, service_type="binance")
@@ -194,6 +209,12 @@ def test_update_exchange_trx_generic_transaction_history(
         date=date,
         account=account_bin,
         fetched_transactions=3)
+    mixer.blend(
+        "transactions.TradeSyncCursor",
+        account=account_bin,
+        market="BTC/ETH",
+        last_timestamp=1514000000000,
+        last_trade_id="4")
 
     monkeypatch.setattr(
         ccxt.binance, "fetch_my_trades",
@@ -202,7 +223,7 @@ def test_update_exchange_trx_generic_transaction_history(
             {
                 'amount': 0.3,
                 'cost': 0.00032,
-                'datetime': str(date + timedelta(days=-1)),  # Should be discarded
+                'datetime': str(date + timedelta(days=-1)),  # Behind the cursor
                 'fee': {
                     'cost': 0.00044,
                     'currency': 'BNB'
@@ -211,7 +232,7 @@ def test_update_exchange_trx_generic_transaction_history(
                 'price': 0.1,
                 'side': 'sell',
                 'symbol': 'BTC/ETH',
-                'timestamp': 1515564209213,
+                'timestamp': 1514000000000,
             },
             {
                 'amount': BINANCE_AMOUNT,
@@ -232,4 +253,522 @@ def test_update_exchange_trx_generic_transaction_history(
     update_exchange_trx_generic(account_bin)
     transaction = Transaction.objects.filter(target_peer=account_bin)
     assert transaction.count(
-    ) == 1, "Should not import transactions older than last update time"
+    ) == 1, "Should not import transactions behind the cursor"
+
+
+def test_update_exchange_trx_generic_cursors(monkeypatch: MonkeyPatch,
+                                             patch_ccxt):
+    """
+    Tests that a sync pages from the trade cursor and
+    only imports trades newer than the last sync
+    """
+    user = mixer.blend("auth.User")
+    account: Account = mixer.blend(
+        "accounts.Account", owner=user, service_type="cryptopia")
+
+    monkeypatch.setattr(generic_exchange, "TRADES_PAGE_LIMIT", 2)
+
+    trades = [{
+        'amount': 1.0,
+        'cost': 0.001,
+        'datetime': '2018-01-1{}T06:04:09.889Z'.format(day),
+        'fee': {
+            'cost': 0.00001,
+            'currency': 'BTC'
+        },
+        'id': str(day),
+        'price': 0.001,
+        'side': 'buy',
+        'symbol': 'EMC/BTC',
+        'timestamp': 1515564249889 + day * 86400000,
+    } for day in range(5)]
+    calls = []
+
+    def fetch_my_trades(self, symbol=None, since=None, limit=None,
+                        params={}):
+        calls.append(since)
+        page = [
+            trade for trade in trades
+            if since is None or trade["timestamp"] >= since
+        ]
+        return page[:limit]
+
+    monkeypatch.setattr(ccxt.cryptopia, "fetch_my_trades", fetch_my_trades)
+
+    update_exchange_trx_generic(account)
+    assert Transaction.objects.filter(target_peer=account).count() == 5
+    # pages overlap by one trade, since is inclusive
+    assert calls == [None] + [trade["timestamp"] for trade in trades[1:]]
+
+    cursor = TradeSyncCursor.objects.get(account=account, market="")
+    assert cursor.last_timestamp == trades[4]["timestamp"]
+    assert cursor.last_trade_id == "4"
+
+    calls.clear()
+    update_exchange_trx_generic(account)
+    assert calls == [trades[4]["timestamp"]]
+    assert Transaction.objects.filter(target_peer=account).count() == 5
+
+
+def test_update_exchange_trx_generic_sweep(monkeypatch: MonkeyPatch,
+                                           patch_ccxt):
+    """
+    Tests that a full sweep imports the trades of a market that was
+    never polled before, even if they are older than the last sync
+    """
+    user = mixer.blend("auth.User")
+    account: Account = mixer.blend(
+        "accounts.Account", owner=user, service_type="binance")
+    mixer.blend(
+        "accounts.ExchangeMarkets",
+        service_id="binance",
+        markets=json.dumps({"BTC/ETH": {}, "LTC/BTC": {}, "NEO/BTC": {}}),
+        updated=now())
+    mixer.blend(
+        "transactions.TransactionUpdateHistoryEntry",
+        date=now(),
+        account=account,
+        fetched_transactions=0)
+    mixer.blend(
+        "transactions.TradeSyncCursor",
+        account=account,
+        market="BTC/ETH",
+        last_timestamp=1515564209213,
+        last_trade_id="1")
+
+    def fetch_my_trades(self, symbol=None, since=None, limit=None,
+                        params={}):
+        return [
+            trade for trade in new_fetch_my_trades(self, symbol)
+            if trade["symbol"] == symbol
+        ]
+
+    monkeypatch.setattr(ccxt.binance, "fetch_my_trades", fetch_my_trades)
+
+    assert generic_exchange.needs_full_sweep(account)
+    result = update_exchange_trx_generic(account)
+    assert result == {"imported": 1, "pending": []}
+    assert Transaction.objects.filter(
+        target_peer=account, external_id="LTC/BTC:2").exists()
+    cursor = TradeSyncCursor.objects.get(account=account, market="LTC/BTC")
+    assert cursor.last_timestamp == 1514453212249
+    # markets without trades don't get a cursor
+    assert not TradeSyncCursor.objects.filter(
+        account=account, market="NEO/BTC").exists()
+
+
+def test_update_exchange_trx_generic_upgrade(monkeypatch: MonkeyPatch,
+                                             patch_ccxt):
+    """
+    Tests that the first sync after upgrading doesn't import the trades
+    of syncs from before the cursors existed again
+    """
+    user = mixer.blend("auth.User")
+    account: Account = mixer.blend(
+        "accounts.Account", owner=user, service_type="binance")
+    mixer.blend(
+        "accounts.ExchangeMarkets",
+        service_id="binance",
+        markets=json.dumps({"BTC/ETH": {}, "LTC/BTC": {}}),
+        updated=now())
+    # the trades before 2018-01-01 were imported without external ids
+    Transaction.objects.create(
+        owner=user,
+        source_peer=account,
+        target_peer=account,
+        date="2017-12-28T09:26:52.249Z",
+        book_price_eur=1,
+        book_price_btc=1)
+    mixer.blend(
+        "transactions.TransactionUpdateHistoryEntry",
+        date=datetime(2018, 1, 1, tzinfo=timezone.utc),
+        account=account,
+        fetched_transactions=1,
+        cursor_sync=False)
+
+    def fetch_my_trades(self, symbol=None, since=None, limit=None,
+                        params={}):
+        return [
+            trade for trade in new_fetch_my_trades(self, symbol)
+            if trade["symbol"] == symbol
+        ]
+
+    monkeypatch.setattr(ccxt.binance, "fetch_my_trades", fetch_my_trades)
+
+    result = update_exchange_trx_generic(account)
+    assert result == {"imported": 1, "pending": []}
+    assert Transaction.objects.filter(target_peer=account).count() == 2
+    assert Transaction.objects.filter(
+        target_peer=account, external_id="BTC/ETH:1").exists()
+
+
+def test_get_trade_cursors(django_assert_num_queries):
+    """
+    Tests that the cursors of many markets are loaded with one query,
+    plus one for the start of new cursors
+    """
+    user = mixer.blend("auth.User")
+    account: Account = mixer.blend(
+        "accounts.Account", owner=user, service_type="binance")
+    mixer.blend(
+        "transactions.TradeSyncCursor",
+        account=account,
+        market="BTC/ETH",
+        last_timestamp=1515564209213)
+    markets = ["BTC/ETH"] + ["M{}/BTC".format(idx) for idx in range(1000)]
+
+    with django_assert_num_queries(2):
+        cursors = generic_exchange.get_trade_cursors(account, markets)
+
+    assert len(cursors) == 1001
+    assert cursors["BTC/ETH"].last_timestamp == 1515564209213
+    assert cursors["M1/BTC"].pk is None
+    assert TradeSyncCursor.objects.filter(account=account).count() == 1
+
+
+def test_get_price_lookups_utc(monkeypatch: MonkeyPatch):
+    """Tests that trade dates are read as UTC whatever the local time zone"""
+    trade = new_fetch_my_trades(None, "LTC/BTC")[1]
+    monkeypatch.setenv("TZ", "America/New_York")
+    time.tzset()
+    try:
+        lookups = generic_exchange.get_price_lookups([trade])
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+    assert lookups[0] == ("LTC", "BTC", 1514453212)
+
+
+def test_select_markets():
+    """
+    Tests that only the account's symbols, markets traded before
+    and markets of held currencies are selected
+    """
+    user = mixer.blend("auth.User")
+    account: Account = mixer.blend(
+        "accounts.Account",
+        owner=user,
+        service_type="binance",
+        symbols='["XMR/BTC", "NEO/ETH"]')
+    mixer.blend(
+        "transactions.TradeSyncCursor",
+        account=account,
+        market="BTC/ETH",
+        last_timestamp=1515564209213)
+    mixer.blend(
+        "transactions.TradeSyncCursor",
+        account=account,
+        market="EOS/BTC",
+        last_timestamp=0)
+
+    class Exchange:
+        id = "binance"
+        rateLimit = 500
+
+        def fetch_balance(self):
+            return {"total": {"LTC": 1.5, "BTC": 0.0, "EOS": 0}}
+
+    markets = {
+        symbol: {
+            "base": symbol.split("/")[0]
+        }
+        for symbol in ("BTC/ETH", "LTC/BTC", "LTC/ETH", "XMR/BTC", "EOS/BTC",
+                       "TRX/BTC", "BTC/USDT")
+    }
+    exchange = Exchange()
+    limiter = rate_limit.get_exchange_limiter(exchange, account.api_key)
+    selected = generic_exchange.select_markets(exchange, limiter, account,
+                                               markets)
+    assert selected == ["BTC/ETH", "LTC/BTC", "LTC/ETH", "XMR/BTC"]
+
+    assert generic_exchange.parse_account_symbols("xmr/btc, NEO/ETH") == {
+        "XMR/BTC", "NEO/ETH"
+    }
+
+    assert generic_exchange.needs_full_sweep(account)
+    mixer.blend(
+        "transactions.TransactionUpdateHistoryEntry",
+        date=now() - timedelta(days=1),
+        account=account,
+        fetched_transactions=0,
+        full_sweep=True)
+    assert not generic_exchange.needs_full_sweep(account)
+
+
+def test_call_exchange_rate_limited(monkeypatch: MonkeyPatch):
+    """Tests that calls hitting the rate limit slow down and are repeated"""
+    penalties = []
+    responses = [ccxt.DDoSProtection("429"), ccxt.DDoSProtection("429"), {}]
+
+    def fetch_balance(self):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(ccxt.binance, "fetch_balance", fetch_balance)
+    monkeypatch.setattr(rate_limit.TokenBucket, "penalize",
+                        lambda self: penalties.append(self.key))
+
+    exchange = ccxt.binance({"api_key": "key"})
+    limiter = rate_limit.get_exchange_limiter(exchange, "key")
+    assert generic_exchange.call_exchange(exchange, limiter,
+                                          "fetch_balance") == {}
+    assert len(penalties) == 2
+
+
+def test_iter_trades_concurrently(monkeypatch: MonkeyPatch, settings):
+    """
+    Tests that markets are fetched concurrently and that
+    a timeout only drops the trades of its market
+    """
+    settings.EXCHANGE_ASYNC_FETCH = True
+    settings.EXCHANGE_ASYNC_CONCURRENCY = 3
+    in_flight = []
+    running = Counter()
+
+    class AsyncBinance:
+        id = "binance"
+        rateLimit = 500
+        closed = False
+
+        def __init__(self, config):
+            pass
+
+        def set_markets(self, markets):
+            self.markets = markets
+
+        async def fetch_my_trades(self, symbol=None, since=None, limit=None):
+            in_flight.append(symbol)
+            running["now"] += 1
+            running["max"] = max(running["max"], running["now"])
+            await asyncio.sleep(0.01)
+            running["now"] -= 1
+            if symbol == "XMR/BTC":
+                raise ccxt.RequestTimeout("timeout")
+            return [{
+                'id': symbol,
+                'symbol': symbol,
+                'timestamp': 1515564209213
+            }]
+
+        async def close(self):
+            AsyncBinance.closed = True
+
+    monkeypatch.setattr(generic_exchange, "ccxt_async",
+                        SimpleNamespace(binance=AsyncBinance))
+
+    user = mixer.blend("auth.User")
+    account: Account = mixer.blend(
+        "accounts.Account", owner=user, service_type="binance")
+    markets = ["BTC/ETH", "LTC/BTC", "XMR/BTC", "NEO/BTC"]
+    mixer.blend(
+        "accounts.ExchangeMarkets",
+        service_id="binance",
+        markets=json.dumps({market: {} for market in markets}),
+        updated=now())
+    failed = {}
+    trades = list(
+        generic_exchange.iter_trades_concurrently(
+            account, rate_limit.get_api_limiter("binance", None, 2), markets,
+            failed))
+
+    assert sorted(trade["id"] for trade in trades) == [
+        "BTC/ETH", "LTC/BTC", "NEO/BTC"
+    ]
+    assert list(failed) == ["XMR/BTC"]
+    # the failed market was retried
+    assert sorted(in_flight) == sorted(markets + ["XMR/BTC"] * 3)
+    assert running["max"] == 3
+    assert AsyncBinance.closed
+
+
+def test_iter_trades_concurrently_streams(monkeypatch: MonkeyPatch,
+                                         settings):
+    """
+    Tests that the trades of a market are yielded as soon as it is
+    fetched and that stopping early cancels the other markets
+    """
+    settings.EXCHANGE_ASYNC_CONCURRENCY = 2
+    delays = {"SLOW/BTC": 10, "FAST/BTC": 0}
+    fetched = []
+
+    class AsyncBinance:
+        id = "binance"
+        rateLimit = 500
+        closed = False
+
+        def __init__(self, config):
+            pass
+
+        def set_markets(self, markets):
+            self.markets = markets
+
+        async def fetch_my_trades(self, symbol=None, since=None, limit=None):
+            await asyncio.sleep(delays[symbol])
+            fetched.append(symbol)
+            return [{'id': symbol, 'symbol': symbol, 'timestamp': 1}]
+
+        async def close(self):
+            AsyncBinance.closed = True
+
+    monkeypatch.setattr(generic_exchange, "ccxt_async",
+                        SimpleNamespace(binance=AsyncBinance))
+
+    user = mixer.blend("auth.User")
+    account: Account = mixer.blend(
+        "accounts.Account", owner=user, service_type="binance")
+    mixer.blend(
+        "accounts.ExchangeMarkets",
+        service_id="binance",
+        markets=json.dumps({market: {} for market in delays}),
+        updated=now())
+
+    started = time.time()
+    trades = generic_exchange.iter_trades_concurrently(
+        account, rate_limit.get_api_limiter("binance", None, 2), list(delays))
+    assert next(trades)["id"] == "FAST/BTC"
+    trades.close()
+
+    # the slow market was cancelled instead of waited for
+    assert time.time() - started < 5
+    assert fetched == ["FAST/BTC"]
+    assert AsyncBinance.closed
+
+
+@pytest.mark.skipif(
+    generic_exchange.ccxt_async is None,
+    reason="ccxt's asyncio variant can't be imported")
+def test_iter_trades_concurrently_exchange_loop(monkeypatch: MonkeyPatch):
+    """
+    Tests that the real ccxt exchange sends its requests with the
+    event loop the markets are fetched in
+    """
+    loops = []
+
+    async def fetch_my_trades(self, symbol=None, since=None, limit=None):
+        loops.append(self.asyncio_loop is asyncio.get_event_loop())
+        return [{'id': symbol, 'symbol': symbol, 'timestamp': 1}]
+
+    monkeypatch.setattr(generic_exchange.ccxt_async.binance,
+                        "fetch_my_trades", fetch_my_trades)
+
+    user = mixer.blend("auth.User")
+    account: Account = mixer.blend(
+        "accounts.Account", owner=user, service_type="binance")
+    markets = {
+        "BTC/ETH": {"id": "BTCETH", "symbol": "BTC/ETH",
+                    "base": "BTC", "quote": "ETH"},
+        "LTC/BTC": {"id": "LTCBTC", "symbol": "LTC/BTC",
+                    "base": "LTC", "quote": "BTC"}
+    }
+    mixer.blend(
+        "accounts.ExchangeMarkets",
+        service_id="binance",
+        markets=json.dumps(markets),
+        updated=now())
+
+    trades = list(
+        generic_exchange.iter_trades_concurrently(
+            account, rate_limit.get_api_limiter("binance", None, 2),
+            list(markets)))
+
+    assert sorted(trade["id"] for trade in trades) == sorted(markets)
+    assert loops == [True, True]
+
+
+def test_call_exchange_retry(monkeypatch: MonkeyPatch, settings):
+    """Tests that network errors are retried a limited number of times"""
+    settings.EXCHANGE_RETRIES = 2
+    calls = []
+
+    def fetch_balance(self):
+        calls.append(1)
+        if len(calls) < 3:
+            raise ccxt.RequestTimeout("timeout")
+        return {}
+
+    monkeypatch.setattr(ccxt.binance, "fetch_balance", fetch_balance)
+
+    exchange = ccxt.binance({"api_key": "key"})
+    limiter = rate_limit.get_exchange_limiter(exchange, "key")
+    assert generic_exchange.call_exchange(exchange, limiter,
+                                          "fetch_balance") == {}
+    assert len(calls) == 3
+
+    calls.clear()
+    settings.EXCHANGE_RETRIES = 1
+    with pytest.raises(ccxt.RequestTimeout):
+        generic_exchange.call_exchange(exchange, limiter, "fetch_balance")
+    assert len(calls) == 2
+
+    assert generic_exchange.get_retry_delay(0) == 0
+    settings.EXCHANGE_RETRY_BACKOFF = 0.5
+    assert generic_exchange.get_retry_delay(2) == 2
+
+
+def test_update_exchange_trx_generic_resume(monkeypatch: MonkeyPatch):
+    """
+    Tests that a market failing during a sync is reported as pending
+    and resumed by the next sync, even though its trades are older
+    than that sync, and that all requests of a sync share one limiter
+    """
+    user = mixer.blend("auth.User")
+    account: Account = mixer.blend(
+        "accounts.Account", owner=user, service_type="binance")
+    markets = ["BTC/ETH", "LTC/BTC"]
+    mixer.blend(
+        "accounts.ExchangeMarkets",
+        service_id="binance",
+        markets=json.dumps({market: {} for market in markets}),
+        updated=now())
+    patch_historical_price(monkeypatch, new_get_historical_price)
+    monkeypatch.setattr(utils, "fetch_price_histories",
+                        lambda requests: [{} for request in requests])
+    monkeypatch.setattr(ccxt.binance, "fetch_balance",
+                        lambda self: {"total": {}})
+
+    failing = {"LTC/BTC"}
+
+    def fetch_my_trades(self, symbol=None, since=None, limit=None,
+                        params={}):
+        if symbol in failing:
+            raise ccxt.RequestTimeout("timeout")
+        return [{
+            'amount': 1.0,
+            'cost': 0.001,
+            'datetime': '2018-01-10T06:04:09.889Z',
+            'fee': {
+                'cost': 0.00001,
+                'currency': 'BTC'
+            },
+            'id': '1',
+            'price': 0.001,
+            'side': 'buy',
+            'symbol': symbol,
+            'timestamp': 1515564249889,
+        }]
+
+    monkeypatch.setattr(ccxt.binance, "fetch_my_trades", fetch_my_trades)
+    limiters = []
+
+    def get_exchange_limiter(exchange, api_key):
+        limiters.append(rate_limit.get_exchange_limiter(exchange, api_key))
+        return limiters[-1]
+
+    monkeypatch.setattr(generic_exchange, "get_exchange_limiter",
+                        get_exchange_limiter)
+
+    result = update_exchange_trx_generic(account)
+    assert result == {"imported": 1, "pending": ["LTC/BTC"]}
+    assert len(limiters) == 1
+    cursor = TradeSyncCursor.objects.get(account=account, market="LTC/BTC")
+    assert cursor.pending
+    assert "timeout" in cursor.last_error
+
+    failing.clear()
+    result = update_exchange_trx_generic(account)
+    assert result == {"imported": 1, "pending": []}
+    assert Transaction.objects.filter(
+        target_peer=account, external_id="LTC/BTC:1").exists()
+    assert not TradeSyncCursor.objects.filter(pending=True).exists()
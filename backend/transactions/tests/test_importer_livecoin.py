@@ -4,11 +4,15 @@ import pytest
 from _pytest.monkeypatch import MonkeyPatch
 from mixer.backend.django import mixer
 from faker import Faker
-import cryptocompare
+
+import backend.utils.utils as utils
+from backend.utils.tests.prices import patch_historical_price
 
 import backend.transactions.schema as schema
 from backend.accounts.models import Account
+from backend.transactions.models import Transaction
 
+from backend.transactions.importers import livecoin
 from backend.transactions.importers.livecoin import import_data_livecoin
 
 pytestmark = pytest.mark.django_db
@@ -61,8 +65,9 @@ def test_import_csv_livecoin(monkeypatch: MonkeyPatch):
     livecoin: Account = mixer.blend(
         "accounts.Account", owner=user, service_type="livecoin")
 
-    monkeypatch.setattr(cryptocompare, "get_historical_price",
-                        new_get_historical_price)
+    patch_historical_price(monkeypatch, new_get_historical_price)
+    monkeypatch.setattr(utils, "fetch_price_histories",
+                        lambda requests: [{} for request in requests])
 
     data = schema.ImportTransactionInput()
     data.service_type = "livecoin"
@@ -87,3 +92,28 @@ def test_import_csv_livecoin(monkeypatch: MonkeyPatch):
 
     res = import_data_livecoin(data, user)
     assert len(res) == 7
+
+
+def test_import_csv_livecoin_unpriced(monkeypatch: MonkeyPatch):
+    """Tests that transactions without a price are imported with a warning"""
+    user = mixer.blend("auth.User")
+    livecoin_account: Account = mixer.blend(
+        "accounts.Account", owner=user, service_type="livecoin")
+
+    monkeypatch.setattr(
+        livecoin, "resolve_name_price",
+        lambda amount, base, target, timestamp=None: utils.PriceResult(
+            0.0, False, "unknown"))
+    monkeypatch.setattr(livecoin, "prefetch_prices", lambda lookups: 0)
+
+    data = schema.ImportTransactionInput()
+    data.service_type = "livecoin"
+    data.import_mechanism = "csv"
+    data.transactions = [
+        make_fake_transaction_data(
+            source_peer=livecoin_account.pk, target_peer=livecoin_account.pk)
+    ]
+
+    res = import_data_livecoin(data, user)
+    assert res[0].book_price_eur == 0.0
+    assert Transaction.TRX_TAG_WARNING in res[0].tags.names()
@@ -0,0 +1,48 @@
+"""Contains all tests for the streaming import pipeline"""
+
+import pytest
+from mixer.backend.django import mixer
+
+from backend.transactions.models import Transaction
+
+from ..pipeline import chunked, import_in_chunks
+from .test_bulk import new_transaction
+
+pytestmark = pytest.mark.django_db
+
+
+def test_chunked():
+    """Tests grouping an iterable into chunks"""
+    assert list(chunked(range(7), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(chunked([], 3)) == []
+
+
+def test_import_in_chunks():
+    """
+    Tests that every chunk is stored before the next records
+    are fetched and that the progress is reported per chunk
+    """
+    account = mixer.blend("accounts.Account")
+    stored_when_fetched = []
+
+    def records():
+        for amount in range(1, 8):
+            stored_when_fetched.append(Transaction.objects.count())
+            yield amount
+
+    saved_chunks = []
+    progress = []
+    imported = import_in_chunks(
+        records(),
+        lambda chunk: [(new_transaction(account, amount), ["exchange"])
+                       for amount in chunk],
+        after_save=saved_chunks.append,
+        progress=lambda processed, imported: progress.append(
+            (processed, imported)),
+        chunk_size=3)
+
+    assert imported == 7
+    assert Transaction.objects.filter(tags__name="exchange").count() == 7
+    assert stored_when_fetched == [0, 0, 0, 3, 3, 3, 6]
+    assert saved_chunks == [[1, 2, 3], [4, 5, 6], [7]]
+    assert progress == [(3, 3), (6, 6), (7, 7)]
@@ -0,0 +1,105 @@
+"""Contains an asyncio client to fetch many price documents concurrently"""
+
+import asyncio
+from urllib.parse import urlparse
+import aiohttp
+
+
+class AsyncPriceClient(object):
+    """
+    Fetches JSON documents concurrently over one aiohttp session,
+    so connections are kept alive and reused.
+
+    At most max_concurrency requests are in flight at the same time
+    and requests to the same host are started at most host_rate_limit
+    times per second.
+
+    Usage:
+        async with AsyncPriceClient() as client:
+            documents = await client.fetch_all(urls)
+    """
+
+    def __init__(self,
+                 max_concurrency: int = 8,
+                 host_rate_limit: float = 10.0,
+                 timeout: float = 30):
+        self.max_concurrency = max_concurrency
+        self.host_rate_limit = host_rate_limit
+        self.timeout = timeout
+        self._session = None
+        self._semaphore = None
+        self._host_locks = {}
+        self._host_next_request = {}
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_concurrency))
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self._session.close()
+
+    async def _wait_for_host(self, host: str):
+        """Waits until the next request to host is allowed"""
+        lock = self._host_locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            loop = asyncio.get_event_loop()
+            delay = self._host_next_request.get(host, 0) - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._host_next_request[host] = \
+                loop.time() + 1 / self.host_rate_limit
+
+    async def _get(self, url: str) -> dict:
+        async with self._session.get(url) as response:
+            return await response.json(content_type=None)
+
+    async def get_json(self, url: str) -> dict:
+        """
+        Fetches a JSON document. Returns None if the request failed
+        or the API answered with an error.
+        """
+        async with self._semaphore:
+            await self._wait_for_host(urlparse(url).netloc)
+            try:
+                document = await asyncio.wait_for(
+                    self._get(url), self.timeout)
+            except (aiohttp.ClientError, asyncio.TimeoutError,
+                    ValueError) as err:
+                print("Error fetching {}: {}".format(url, err))
+                return None
+
+        if not isinstance(document, dict) or \
+                document.get("Response") == "Error":
+            print("[ERROR] {}".format(url))
+            return None
+        return document
+
+    async def fetch_all(self, urls: list) -> list:
+        """Fetches all urls concurrently, see get_json"""
+        return await asyncio.gather(*[self.get_json(url) for url in urls])
+
+
+def fetch_json_concurrently(urls: list, **options) -> list:
+    """
+    Fetches all urls concurrently with an AsyncPriceClient
+    from synchronous code like Celery tasks.
+
+    Keyword arguments:
+    urls -- list of urls to fetch
+    options -- keyword arguments for AsyncPriceClient
+
+    Returns the JSON documents in the order of urls,
+    None for failed requests
+    """
+
+    async def fetch():
+        async with AsyncPriceClient(**options) as client:
+            return await client.fetch_all(urls)
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(fetch())
+    finally:
+        loop.close()
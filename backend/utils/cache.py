@@ -0,0 +1,89 @@
+"""Contains the in-process cache used in front of the slower price caches"""
+
+import threading
+from cachetools import Cache, TTLCache
+
+
+class _CountingTTLCache(TTLCache):
+    """
+    TTLCache that counts the entries evicted because they expired or
+    to make room. Entries removed by clear() are not counted.
+    """
+
+    evictions = 0
+    _clearing = False
+
+    def _stored_size(self) -> int:
+        # TTLCache.currsize expires entries itself, read the size of
+        # the entries stored including the expired ones
+        return Cache.currsize.fget(self)
+
+    def expire(self, time=None):
+        size = self._stored_size()
+        super(_CountingTTLCache, self).expire(time)
+        if not self._clearing:
+            self.evictions += size - self._stored_size()
+
+    def popitem(self):
+        item = super(_CountingTTLCache, self).popitem()
+        if not self._clearing:
+            self.evictions += 1
+        return item
+
+    def clear(self):
+        self._clearing = True
+        try:
+            super(_CountingTTLCache, self).clear()
+        finally:
+            self._clearing = False
+
+
+class MemoryCache(object):
+    """
+    A bounded LRU cache whose entries expire after ttl seconds.
+    It is safe to use from multiple threads and counts its hits,
+    misses and evictions.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = _CountingTTLCache(maxsize, ttl)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def evictions(self) -> int:
+        """Number of entries evicted because they expired or the cache
+        was full"""
+        return self._cache.evictions
+
+    def get(self, key, default=None):
+        """Returns the value for key or default if it is missing or expired"""
+        with self._lock:
+            try:
+                val = self._cache[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return val
+
+    def set(self, key, value):
+        """Stores value under key, evicting the least recently used entry"""
+        with self._lock:
+            self._cache[key] = value
+
+    def __len__(self):
+        return len(self._cache)
+
+    def reset_stats(self):
+        """Resets the hit, miss and eviction counters"""
+        with self._lock:
+            self._cache.evictions = 0
+            self.hits = 0
+            self.misses = 0
+
+    def clear(self):
+        """Removes all entries"""
+        with self._lock:
+            self._cache.clear()
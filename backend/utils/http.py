@@ -0,0 +1,108 @@
+"""
+Contains the pooled HTTP session used for all outbound API calls,
+so connections are kept alive and reused between calls
+"""
+
+import importlib
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from django.conf import settings
+
+# the session of this process and the pid it was created in,
+# see get_session
+SESSION = None
+SESSION_PID = None
+_SESSION_LOCK = threading.Lock()
+
+
+class PooledSession(requests.Session):
+    """A requests session that applies HTTP_TIMEOUT to every request"""
+
+    def __init__(self, timeout):
+        super(PooledSession, self).__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super(PooledSession, self).request(method, url, **kwargs)
+
+
+def _create_session() -> PooledSession:
+    session = PooledSession(getattr(settings, "HTTP_TIMEOUT", (5, 30)))
+    retry = Retry(
+        total=getattr(settings, "HTTP_RETRIES", 3),
+        backoff_factor=getattr(settings, "HTTP_BACKOFF", 0.5),
+        status_forcelist=(429, 500, 502, 503, 504))
+    pool_size = getattr(settings, "HTTP_POOL_SIZE", 10)
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size,
+        max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session() -> PooledSession:
+    """
+    Returns the HTTP session of this process. Its connection pools
+    are sized with HTTP_POOL_SIZE, failed requests are retried
+    HTTP_RETRIES times with HTTP_BACKOFF and requests time out after
+    HTTP_TIMEOUT seconds. A new session is created after a fork, e.g.
+    in a Celery worker, because connections can't be shared between
+    processes.
+    """
+    global SESSION, SESSION_PID
+    with _SESSION_LOCK:
+        if SESSION is None or SESSION_PID != os.getpid():
+            SESSION = _create_session()
+            SESSION_PID = os.getpid()
+        return SESSION
+
+
+def get_http_stats() -> dict:
+    """
+    Returns the connection counters of this process' session
+
+    requests -- number of requests sent
+    connections -- number of connections opened
+    reused -- requests sent over an already open connection
+    """
+    num_requests = 0
+    num_connections = 0
+    if SESSION is not None and SESSION_PID == os.getpid():
+        for adapter in set(SESSION.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                num_requests += pool.num_requests
+                num_connections += pool.num_connections
+
+    return {
+        "requests": num_requests,
+        "connections": num_connections,
+        "reused": max(num_requests - num_connections, 0)
+    }
+
+
+class _SessionRequests(object):
+    """Stands in for the requests module in libraries calling requests.get"""
+
+    def __getattr__(self, name):
+        if name in ("get", "post", "request"):
+            return getattr(get_session(), name)
+        return getattr(requests, name)
+
+
+def use_pooled_session():
+    """
+    Makes the cryptocompare package send its requests over the pooled
+    session, it calls requests.get for every request otherwise
+    """
+    module = importlib.import_module("cryptocompare.cryptocompare")
+    if not isinstance(module.requests, _SessionRequests):
+        module.requests = _SessionRequests()
@@ -0,0 +1,236 @@
+"""
+Contains the price providers the price lookups in utils.py use.
+The provider is selected with the PRICE_PROVIDER setting.
+"""
+
+from abc import ABC, abstractmethod
+import hashlib
+import math
+import time
+import cryptocompare as cc
+from django.conf import settings
+
+from backend.utils.async_prices import fetch_json_concurrently
+
+# size of a price bucket in seconds for each supported granularity
+GRANULARITIES = {"minute": 60, "hour": 3600, "day": 86400}
+
+URL_HIST_PRICE = {
+    "minute": "https://min-api.cryptocompare.com/data/histominute?fsym={}&tsym={}",
+    "hour": cc.URL_HIST_PRICE_HOUR,
+    "day": cc.URL_HIST_PRICE_DAY,
+}
+
+
+class PriceProviderError(Exception):
+    """
+    Raised when a provider could not be asked for a price, e.g. because
+    of a network error. Unlike a missing price it may work next time.
+    """
+
+
+class PriceProvider(ABC):
+    """
+    Base class of all price providers. Prices are close prices of
+    UTC buckets of the given granularity (minute, hour or day).
+    Missing prices are returned as None or left out, never as 0.
+    get_price raises PriceProviderError if the request failed.
+    """
+
+    def get_price(self, base: str, target: str, bucket: int,
+                  granularity: str) -> float:
+        """
+        Returns the price of one base in target for a single bucket
+
+        Keyword arguments:
+        base -- name to convert from
+        target -- name to convert to
+        bucket -- start of the bucket as a Unix Timestamp
+        granularity -- minute, hour or day
+        """
+        return self.get_price_history(base, target, bucket, 0,
+                                      granularity).get(bucket)
+
+    @abstractmethod
+    def get_price_history(self, base: str, target: str, to_timestamp: int,
+                          limit: int, granularity: str) -> dict:
+        """
+        Returns a dict mapping the buckets of a range to the price.
+        Raises PriceProviderError if the request failed.
+
+        Keyword arguments:
+        base -- name to convert from
+        target -- name to convert to
+        to_timestamp -- last bucket of the range as a Unix Timestamp
+        limit -- number of buckets before to_timestamp to include
+        granularity -- minute, hour or day
+        """
+
+    def get_price_histories(self, requests: list) -> list:
+        """
+        Returns one dict per request, see get_price_history. The dict
+        of a failed request is empty. Providers with a batch API should
+        override this.
+
+        Keyword arguments:
+        requests -- list of (base, target, to_timestamp, limit, granularity)
+                    tuples
+        """
+        histories = []
+        for request in requests:
+            try:
+                histories.append(self.get_price_history(*request))
+            except PriceProviderError:
+                histories.append({})
+        return histories
+
+    @abstractmethod
+    def get_spot_prices(self, bases: list, targets: list) -> dict:
+        """
+        Returns the current prices of all bases in all targets
+        as a dict like {"BTC": {"EUR": 9000.0}}
+
+        Keyword arguments:
+        bases -- names to convert from
+        targets -- names to convert to
+        """
+
+
+class CryptoCompareProvider(PriceProvider):
+    """Fetches prices from the cryptocompare.com API"""
+
+    @staticmethod
+    def _query(url: str) -> dict:
+        # cryptocompare returns None if the request failed and, unless
+        # errorCheck is disabled, also for error responses
+        response = cc.query_cryptocompare(url, errorCheck=False)
+        if response is None:
+            raise PriceProviderError("request failed")
+        if response.get("Response") == "Error":
+            # e.g. an unknown or delisted coin, the price is missing
+            return {}
+        return response
+
+    def get_price(self, base: str, target: str, bucket: int,
+                  granularity: str) -> float:
+        if granularity != "day":
+            return super(CryptoCompareProvider, self).get_price(
+                base, target, bucket, granularity)
+
+        response = self._query(cc.URL_HIST_PRICE.format(base, target, bucket))
+        return response.get(base, {}).get(target) or None
+
+    @staticmethod
+    def _history_url(base: str, target: str, to_timestamp: int, limit: int,
+                     granularity: str) -> str:
+        url = URL_HIST_PRICE[granularity].format(base, target)
+        return url + "&limit={}&toTs={}".format(limit, to_timestamp)
+
+    @staticmethod
+    def _parse_history(response: dict) -> dict:
+        if not response:
+            return {}
+
+        # buckets before a coin was listed come back with a price of 0
+        return {
+            candle["time"]: candle["close"]
+            for candle in response.get("Data", []) if candle.get("close")
+        }
+
+    def get_price_history(self, base: str, target: str, to_timestamp: int,
+                          limit: int, granularity: str) -> dict:
+        url = self._history_url(base, target, to_timestamp, limit,
+                                granularity)
+        return self._parse_history(self._query(url))
+
+    def get_price_histories(self, requests: list) -> list:
+        """
+        With PRICE_ASYNC_REQUESTS enabled the requests run concurrently,
+        at most PRICE_ASYNC_CONCURRENCY at a time and
+        PRICE_ASYNC_RATE_LIMIT per second, otherwise one after another.
+        """
+        if len(requests) < 2 or not getattr(settings, "PRICE_ASYNC_REQUESTS",
+                                            False):
+            return super(CryptoCompareProvider,
+                         self).get_price_histories(requests)
+
+        responses = fetch_json_concurrently(
+            [self._history_url(*request) for request in requests],
+            max_concurrency=getattr(settings, "PRICE_ASYNC_CONCURRENCY", 8),
+            host_rate_limit=getattr(settings, "PRICE_ASYNC_RATE_LIMIT", 10.0))
+        return [self._parse_history(response) for response in responses]
+
+    def get_spot_prices(self, bases: list, targets: list) -> dict:
+        return cc.get_price(bases, targets) or {}
+
+
+class OfflinePriceProvider(PriceProvider):
+    """
+    Generates synthetic prices without network access, e.g. to measure
+    the import throughput locally. The same pair and bucket always
+    get the same price, so repeated runs are comparable.
+
+    Keyword arguments:
+    latency -- seconds every request takes (default: 0)
+    error_rate -- share of prices that are missing, between 0 and 1
+                  (default: 0)
+    """
+
+    def __init__(self, latency: float = 0, error_rate: float = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+
+    @staticmethod
+    def _hash(*parts) -> float:
+        """Maps parts to a stable number between 0 and 1"""
+        digest = hashlib.md5("/".join(str(part)
+                                      for part in parts).encode()).digest()
+        return int.from_bytes(digest[:8], "big") / 2**64
+
+    def _request(self):
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _price(self, base: str, target: str, bucket: int) -> float:
+        if base == target:
+            return 1.0
+        if self._hash("error", base, target, bucket) < self.error_rate:
+            return None
+
+        # a base price between 0.001 and 1000 per pair that
+        # drifts slowly over time with some noise per bucket
+        price = 10**(self._hash(base, target) * 6 - 3)
+        phase = self._hash("phase", base, target) * 2 * math.pi
+        drift = 1 + 0.3 * math.sin(bucket / (86400 * 90) + phase)
+        noise = 1 + 0.02 * (self._hash(base, target, bucket) - 0.5)
+        return round(price * drift * noise, 8)
+
+    def get_price(self, base: str, target: str, bucket: int,
+                  granularity: str) -> float:
+        self._request()
+        return self._price(base, target, bucket)
+
+    def get_price_history(self, base: str, target: str, to_timestamp: int,
+                          limit: int, granularity: str) -> dict:
+        self._request()
+        size = GRANULARITIES[granularity]
+        history = {}
+        for bucket in range(to_timestamp - limit * size, to_timestamp + 1,
+                            size):
+            price = self._price(base, target, bucket)
+            if price is not None:
+                history[bucket] = price
+        return history
+
+    def get_spot_prices(self, bases: list, targets: list) -> dict:
+        self._request()
+        bucket = int(time.time()) // 60 * 60
+        prices = {}
+        for base in bases:
+            for target in targets:
+                price = self._price(base, target, bucket)
+                if price is not None:
+                    prices.setdefault(base, {})[target] = price
+        return prices
@@ -0,0 +1,147 @@
+"""
+Contains a token bucket rate limiter whose state is shared by all
+processes on this host, e.g. all Celery workers syncing accounts of
+the same exchange
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import time
+from django.conf import settings
+
+# seconds without rate limit errors before a slowed down bucket
+# doubles its rate again
+RECOVERY_INTERVAL = 60
+
+# a bucket never slows down below this share of its nominal rate
+MIN_RATE_FACTOR = 1 / 16
+
+
+class TokenBucket(object):
+    """
+    A token bucket that refills with rate tokens per second up to
+    capacity tokens. Its state lives in a file in RATE_LIMIT_DIR which
+    is locked while it is updated, so all buckets with the same key
+    share their tokens, no matter in which process they are.
+
+    Keyword arguments:
+    key -- name of the bucket
+    rate -- tokens per second
+    capacity -- maximum number of tokens, the allowed burst (default: 1)
+    """
+
+    def __init__(self, key: str, rate: float, capacity: float = 1):
+        self.key = key
+        self.rate = rate
+        self.capacity = capacity
+        directory = getattr(settings, "RATE_LIMIT_DIR",
+                            "/tmp/crypternity/ratelimit")
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, key)
+
+    def _update(self, update):
+        """Calls update with the locked state and stores it afterwards"""
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        with os.fdopen(fd, "r+") as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            try:
+                content = handle.read()
+                state = json.loads(content) if content else {
+                    "tokens": self.capacity,
+                    "updated": time.time(),
+                    "rate": self.rate,
+                    "penalized": 0
+                }
+                result = update(state)
+                handle.seek(0)
+                handle.truncate()
+                json.dump(state, handle)
+                handle.flush()
+                return result
+            finally:
+                fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def _refill(self, state: dict):
+        now = time.time()
+        rate = min(state["rate"], self.rate)
+        if rate < self.rate and \
+                now - state["penalized"] >= RECOVERY_INTERVAL:
+            rate = min(rate * 2, self.rate)
+            state["penalized"] = now
+
+        state["tokens"] = min(self.capacity, state["tokens"] +
+                              (now - state["updated"]) * rate)
+        state["updated"] = now
+        state["rate"] = rate
+
+    def _take(self, state: dict, tokens: float) -> float:
+        self._refill(state)
+        if state["tokens"] >= tokens:
+            state["tokens"] -= tokens
+            return 0
+        return (tokens - state["tokens"]) / state["rate"]
+
+    def acquire(self, tokens: float = 1) -> float:
+        """
+        Waits until tokens are available and takes them
+
+        Returns the number of seconds waited
+        """
+        waited = 0
+        while True:
+            wait = self._update(lambda state: self._take(state, tokens))
+            if wait <= 0:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+    def penalize(self):
+        """
+        Halves the rate of the bucket and empties it, call it when the
+        API answered with a rate limit error. The rate doubles again
+        after RECOVERY_INTERVAL seconds without errors.
+        """
+
+        def update(state):
+            self._refill(state)
+            state["rate"] = max(state["rate"] / 2,
+                                self.rate * MIN_RATE_FACTOR)
+            state["tokens"] = 0
+            state["penalized"] = time.time()
+            print("Rate limited on {}, slowing down to {:.2f}/s".format(
+                self.key, state["rate"]))
+
+        self._update(update)
+
+
+def get_api_limiter(service: str, api_key: str, rate: float) -> TokenBucket:
+    """
+    Returns the token bucket of an API key of a service, its burst is
+    EXCHANGE_RATE_LIMIT_BURST. The key is hashed, so it isn't stored
+    in the bucket's file name.
+
+    Keyword arguments:
+    service -- name of the API, e.g. the ccxt id of an exchange
+    api_key -- the API key requests are made with
+    rate -- requests per second
+    """
+    key = "{}-{}".format(
+        service,
+        hashlib.sha1((api_key or "").encode()).hexdigest()[:16])
+    return TokenBucket(key, rate,
+                       getattr(settings, "EXCHANGE_RATE_LIMIT_BURST", 1))
+
+
+def get_exchange_limiter(exchange, api_key: str) -> TokenBucket:
+    """
+    Returns the token bucket of an exchange account. Its rate is taken
+    from ccxt's rateLimit (milliseconds between requests), the burst
+    from EXCHANGE_RATE_LIMIT_BURST.
+
+    Keyword arguments:
+    exchange -- a ccxt exchange
+    api_key -- the API key requests are made with
+    """
+    return get_api_limiter(exchange.id, api_key, 1000 / exchange.rateLimit)
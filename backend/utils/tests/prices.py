@@ -0,0 +1,23 @@
+"""Helpers to fake the price API in tests"""
+
+from urllib.parse import parse_qs, urlparse
+from _pytest.monkeypatch import MonkeyPatch
+import cryptocompare
+
+
+def patch_historical_price(monkeypatch: MonkeyPatch, get_historical_price):
+    """
+    Answers cryptocompare's historical price requests with
+    get_historical_price(base, target, timestamp). Like the API it
+    returns the response, None if the request failed.
+    """
+    query_cryptocompare = cryptocompare.query_cryptocompare
+
+    def query(url, errorCheck=True):
+        if not url.startswith(cryptocompare.URL_HIST_PRICE.split("?")[0]):
+            return query_cryptocompare(url, errorCheck)
+        params = parse_qs(urlparse(url).query)
+        return get_historical_price(params["fsym"][0], params["tsyms"][0],
+                                    int(params["ts"][0]))
+
+    monkeypatch.setattr(cryptocompare, "query_cryptocompare", query)
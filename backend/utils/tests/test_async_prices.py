@@ -0,0 +1,47 @@
+"""Contains all tests for the async price client"""
+
+import asyncio
+from aiohttp import web
+
+from ..async_prices import AsyncPriceClient
+
+
+def test_fetch_all():
+    """
+    Tests that the documents are returned in order and that
+    failed requests and API errors come back as None
+    """
+
+    async def handler(request):
+        if request.match_info["name"] == "error":
+            return web.json_response({"Response": "Error"})
+        if request.match_info["name"] == "broken":
+            return web.Response(text="not json")
+        return web.json_response({"name": request.match_info["name"]})
+
+    async def run():
+        app = web.Application()
+        app.router.add_get("/{name}", handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        names = ["a", "error", "b", "broken", "c"]
+        urls = ["http://127.0.0.1:{}/{}".format(port, name) for name in names]
+        try:
+            async with AsyncPriceClient(max_concurrency=2,
+                                        host_rate_limit=1000) as client:
+                return await client.fetch_all(urls)
+        finally:
+            await runner.cleanup()
+
+    loop = asyncio.new_event_loop()
+    try:
+        documents = loop.run_until_complete(run())
+    finally:
+        loop.close()
+
+    assert documents == [{"name": "a"}, None, {"name": "b"}, None,
+                         {"name": "c"}]
@@ -0,0 +1,48 @@
+"""Contains all tests for the in-process cache"""
+
+import time
+
+from ..cache import MemoryCache
+
+
+def test_memory_cache_lru():
+    """Tests that the least recently used entry is evicted"""
+    cache = MemoryCache(2, 60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # b is now the least recently used
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+    assert cache.hits == 3
+    assert cache.misses == 1
+    assert cache.evictions == 1
+
+    cache.reset_stats()
+    assert cache.hits == cache.misses == cache.evictions == 0
+
+
+def test_memory_cache_ttl():
+    """Tests that expired entries are not returned"""
+    cache = MemoryCache(10, 0)
+    cache.set("a", 1)
+    assert cache.get("a", "expired") == "expired"
+
+
+def test_memory_cache_evictions():
+    """Tests that expired entries count as evictions, cleared ones don't"""
+    cache = MemoryCache(10, 0.01)
+    cache.set("a", 1)
+    time.sleep(0.02)
+    cache.set("b", 2)  # expires a
+    assert cache.evictions == 1
+
+    cache = MemoryCache(10, 60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.evictions == 0
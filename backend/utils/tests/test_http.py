@@ -0,0 +1,68 @@
+"""Contains all tests for the pooled HTTP session"""
+
+import json
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import cryptocompare
+
+from .. import http
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    """Handles every connection in its own thread"""
+    daemon_threads = True
+
+
+class PriceHandler(BaseHTTPRequestHandler):
+    """Answers every request with a price document over keep-alive"""
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):  #pylint: disable=C0103
+        body = json.dumps({"BTC": {"EUR": 9000.0}}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_session_reuses_connections(monkeypatch):
+    """
+    Tests that cryptocompare requests go over the shared session
+    and reuse its connection
+    """
+    monkeypatch.setattr(http, "SESSION", None)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PriceHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = "http://127.0.0.1:{}/data/price".format(server.server_port)
+    try:
+        http.use_pooled_session()
+        for _ in range(3):
+            assert cryptocompare.query_cryptocompare(url) == {
+                "BTC": {
+                    "EUR": 9000.0
+                }
+            }
+        assert http.get_session() is http.get_session()
+        stats = http.get_http_stats()
+    finally:
+        http.get_session().close()
+        server.shutdown()
+        server.server_close()
+
+    assert stats == {
+        "requests": 3,
+        "connections": 1,
+        "reused": 2
+    }
+
+
+def test_pooled_session_at_startup():
+    """Tests that the pooled session is installed when Django starts"""
+    assert isinstance(cryptocompare.cryptocompare.requests,
+                      http._SessionRequests)  #pylint: disable=W0212
@@ -0,0 +1,42 @@
+"""Contains all tests for the rate limiter"""
+
+from _pytest.monkeypatch import MonkeyPatch
+
+from .. import rate_limit
+from ..rate_limit import TokenBucket
+
+
+class FakeClock:
+    """Replaces time.time and time.sleep of the rate limiter"""
+
+    def __init__(self, monkeypatch: MonkeyPatch):
+        self.now = 1000.0
+        monkeypatch.setattr(rate_limit.time, "time", lambda: self.now)
+        monkeypatch.setattr(rate_limit.time, "sleep", self.sleep)
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_token_bucket(monkeypatch: MonkeyPatch):
+    """
+    Tests that buckets with the same key share their tokens
+    and that a rate limit error slows the bucket down
+    """
+    clock = FakeClock(monkeypatch)
+    bucket = TokenBucket("binance-test", rate=2)
+    other_worker = TokenBucket("binance-test", rate=2)
+
+    assert bucket.acquire() == 0
+    assert other_worker.acquire() == 0.5
+    assert bucket.acquire() == 0.5
+    assert TokenBucket("bitfinex-test", rate=2).acquire() == 0
+
+    bucket.penalize()
+    assert other_worker.acquire() == 1.0
+    assert bucket.acquire() == 1.0
+
+    # the rate recovers after a while without errors
+    clock.now += rate_limit.RECOVERY_INTERVAL
+    assert bucket.acquire() == 0
+    assert other_worker.acquire() == 0.5
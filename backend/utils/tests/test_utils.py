@@ -1,10 +1,16 @@
 """Contains all tests for the utility functions"""
 
+from datetime import datetime, timezone
 import pytest
 from _pytest.monkeypatch import MonkeyPatch
+from mixer.backend.django import mixer
 import cryptocompare
 
-from ..utils import exchange_can_batch, get_name_price
+from backend.coins.models import PriceCandle
+
+from .. import price_providers, utils
+from ..utils import exchange_can_batch, get_name_price, prefetch_prices
+from .prices import patch_historical_price
 
 
 def test_exchange_can_batch():
@@ -58,8 +64,7 @@ def test_name_converter(monkeypatch: MonkeyPatch):
     5	 LTC | EUR | 2017-11-07 | 242.6    EUR
     300	 BNB | BTC | 2017-12-28 | 0.18759  BTC
     """
-    monkeypatch.setattr(cryptocompare, "get_historical_price",
-                        new_get_historical_price)
+    patch_historical_price(monkeypatch, new_get_historical_price)
 
     result = get_name_price(5, "BTC", "ETH", 1512950400)
     assert round(result, 2) == 164.55
@@ -77,4 +82,359 @@ def test_name_converter(monkeypatch: MonkeyPatch):
     assert round(result, 1) == 242.6
 
     result = get_name_price(300, "BNB", "BTC", 1514419200)
-    assert round(result, 6) == 0.18759
\ No newline at end of file
+    assert round(result, 6) == 0.18759
+
+def new_fetch_price_history(base, target, to_timestamp, limit,
+                            granularity="day"):
+    """Fake histoday range request, every day costs 100 * day index"""
+    first_day = to_timestamp - limit * 86400
+    return {
+        day: 100.0 * (day - first_day) / 86400 + 100.0
+        for day in range(first_day, to_timestamp + 1, 86400)
+    }
+
+
+def patch_price_history(monkeypatch: MonkeyPatch, fetch_price_history):
+    """Replaces the range requests of the cryptocompare provider"""
+    monkeypatch.setattr(price_providers.CryptoCompareProvider,
+                        "get_price_history",
+                        lambda self, *args: fetch_price_history(*args))
+
+
+def test_prefetch_prices(monkeypatch: MonkeyPatch):
+    """
+    Tests that a batch of lookups is resolved with one range request
+    per pair and get_name_price does not call the API afterwards
+    """
+    requests = []
+
+    def fetch_price_history(base, target, to_timestamp, limit, granularity):
+        requests.append((base, target, to_timestamp, limit))
+        return new_fetch_price_history(base, target, to_timestamp, limit)
+
+    def fail_get_historical_price(base, target, timestamp):
+        raise AssertionError("Should be resolved from the cache")
+
+    patch_price_history(monkeypatch, fetch_price_history)
+
+    lookups = []
+    for trade in range(50):
+        # 50 trades spread over 5 days, 1 hour apart
+        timestamp = 1512950400 + trade * 3600 * 2
+        lookups.append(("XLM", "BTC", timestamp))
+        lookups.append(("XLM", "ETH", timestamp))
+        lookups.append(("BTC", "BTC", timestamp))  # skipped
+
+    assert prefetch_prices(lookups) == 2
+    assert ("XLM", "BTC", 1512950400 + 4 * 86400, 4) in requests
+
+    patch_historical_price(monkeypatch, fail_get_historical_price)
+    assert get_name_price(2, "XLM", "BTC", 1512950400 + 3600) == 200.0
+    assert get_name_price(1, "XLM", "ETH", 1512950400 + 86400 * 4) == 500.0
+
+    assert prefetch_prices(lookups) == 0, "Should not refetch cached days"
+
+
+def test_name_price_reads_price_candles(monkeypatch: MonkeyPatch):
+    """
+    Tests that stored candles are used without calling the API
+    and that fetched prices are stored as candles
+    """
+    mixer.blend(
+        "coins.PriceCandle",
+        symbol="BTC",
+        quote="EUR",
+        period=PriceCandle.PERIOD_DAY,
+        bucket=datetime(2017, 12, 11, tzinfo=timezone.utc),
+        close=13006.11)
+
+    def fail_get_historical_price(base, target, timestamp):
+        raise AssertionError("Should be resolved from the PriceCandle table")
+
+    patch_historical_price(monkeypatch, fail_get_historical_price)
+    result = get_name_price(2, "BTC", "EUR", 1512950400 + 3600)
+    assert round(result, 2) == 26012.22
+
+    patch_historical_price(monkeypatch, new_get_historical_price)
+    get_name_price(1, "BTC", "ETH", 1512950400)
+    candle = PriceCandle.objects.get(symbol="BTC", quote="ETH")
+    assert float(candle.close) == 32.91
+
+
+def test_name_price_buckets(monkeypatch: MonkeyPatch, settings):
+    """
+    Tests that timestamps of the same bucket share one entry
+    and the hit rate counters
+    """
+    requests = []
+
+    def get_historical_price(base, target, timestamp):
+        requests.append(timestamp)
+        return {base: {target: 2.0}}
+
+    patch_historical_price(monkeypatch, get_historical_price)
+    utils.reset_price_stats()
+
+    for second in range(0, 86400, 3600):
+        assert get_name_price(1, "ETH", "BTC", 1512950400 + second) == 2.0
+    assert requests == [1512950400], "Should use the day bucket"
+
+    stats = utils.get_price_stats()
+    assert stats["lookups"] == 24
+    assert stats["requests"] == 1
+    assert stats["memory"]["hits"] == 23
+    assert round(stats["hit_rate"], 2) == 0.96
+
+    settings.PRICE_GRANULARITY = "hour"
+    patch_price_history(monkeypatch, new_fetch_price_history)
+    assert get_name_price(1, "ETH", "BTC", 1512950400 + 4000) == 100.0
+    assert utils.get_bucket_timestamp(1512950400 + 4000) == 1512954000
+
+
+def test_trim_price_cache(price_cache):
+    """Tests that expired diskcache entries are evicted and counted"""
+    utils.reset_price_stats()
+    price_cache.set("expired", 1.0, expire=-1)
+    price_cache.set("valid", 2.0)
+
+    assert utils.trim_price_cache() == 1
+    assert utils.get_price_stats()["disk"]["evictions"] == 1
+    assert price_cache.get("valid") == 2.0
+
+
+def test_live_price(monkeypatch: MonkeyPatch):
+    """Tests that live prices are looked up at call time and cached"""
+    requests = []
+
+    def get_price(bases, targets):
+        requests.append((bases, targets))
+        return {bases[0]: {targets[0]: 9000.0}}
+
+    monkeypatch.setattr(cryptocompare, "get_price", get_price)
+
+    assert get_name_price(2, "BTC", "EUR") == 18000.0
+    assert get_name_price(1, "BTC", "EUR") == 9000.0
+    assert requests == [(["BTC"], ["EUR"])]
+
+
+def test_name_price_triangulation(monkeypatch: MonkeyPatch):
+    """
+    Tests that fiat prices of currencies with a known BTC price are
+    calculated through BTC and BTC -> EUR is only requested once
+    """
+    prices = {
+        ("XLM", "BTC"): 0.00003136,
+        ("LTC", "BTC"): 0.02,
+        ("BTC", "EUR"): 10000.0
+    }
+    requests = []
+
+    def get_historical_price(base, target, timestamp):
+        requests.append((base, target))
+        return {base: {target: prices[(base, target)]}}
+
+    patch_historical_price(monkeypatch, get_historical_price)
+
+    get_name_price(1500, "XLM", "BTC", 1509753600)
+    get_name_price(1, "LTC", "BTC", 1509753600)
+    assert round(get_name_price(1500, "XLM", "EUR", 1509753600), 2) == 470.4
+    assert round(get_name_price(5, "LTC", "EUR", 1509753600), 2) == 1000.0
+
+    assert requests == [("XLM", "BTC"), ("LTC", "BTC"), ("BTC", "EUR")]
+    assert utils.get_price_stats()["triangulated"] == 2
+
+
+def test_prefetch_prices_triangulation(monkeypatch: MonkeyPatch):
+    """Tests that prefetch fetches both legs instead of the fiat price"""
+    requests = []
+
+    def fetch_price_history(base, target, to_timestamp, limit, granularity):
+        requests.append((base, target))
+        return new_fetch_price_history(base, target, to_timestamp, limit)
+
+    patch_price_history(monkeypatch, fetch_price_history)
+
+    prefetch_prices([("XLM", "EUR", 1512950400), ("LTC", "EUR", 1512950400),
+                     ("XLM", "BTC", 1512950400)])
+    assert sorted(requests) == [("BTC", "EUR"), ("LTC", "BTC"),
+                                ("XLM", "BTC")]
+
+
+def test_prefetch_prices_concurrent(monkeypatch: MonkeyPatch, settings):
+    """Tests that all range requests are submitted at once"""
+    settings.PRICE_ASYNC_REQUESTS = True
+    batches = []
+
+    def fetch_json_concurrently(urls, **options):
+        batches.append(urls)
+        return [{
+            "Response": "Success",
+            "Data": [{
+                "time": 1512950400,
+                "close": 0.5
+            }]
+        } for url in urls]
+
+    monkeypatch.setattr(price_providers, "fetch_json_concurrently",
+                        fetch_json_concurrently)
+
+    assert prefetch_prices([("XLM", "BTC", 1512950400),
+                            ("LTC", "BTC", 1512950400)]) == 2
+    assert len(batches) == 1 and len(batches[0]) == 2
+    assert get_name_price(2, "LTC", "BTC", 1512950400) == 1.0
+
+
+def test_name_price_coalesced(monkeypatch: MonkeyPatch):
+    """
+    Tests that a worker waits for the price another worker
+    is fetching instead of requesting it again
+    """
+    key = utils._price_key("XLM", "BTC", "day", 1512950400)
+    assert utils._acquire_fetch_lock(key)
+    assert not utils._acquire_fetch_lock(key)
+
+    def other_worker(seconds):
+        utils.CACHE.set(key, 0.5)
+        utils._release_fetch_lock(key)
+
+    def fail_get_historical_price(base, target, timestamp):
+        raise AssertionError("Should wait for the other worker")
+
+    monkeypatch.setattr(utils.time, "sleep", other_worker)
+    patch_historical_price(monkeypatch, fail_get_historical_price)
+
+    assert get_name_price(2, "XLM", "BTC", 1512950400) == 1.0
+    assert utils.get_price_stats()["coalesced"] == 1
+    assert utils._acquire_fetch_lock(key)
+
+
+def test_prefetch_prices_coalesced(monkeypatch: MonkeyPatch):
+    """Tests that a pair another worker is fetching is not requested"""
+    requests = []
+
+    def fetch_price_history(base, target, to_timestamp, limit, granularity):
+        requests.append((base, target))
+        return new_fetch_price_history(base, target, to_timestamp, limit)
+
+    def other_worker(seconds):
+        utils.store_prices("LTC", "BTC", {1512950400: 0.01})
+        utils._release_fetch_lock("LTCBTCday")
+
+    patch_price_history(monkeypatch, fetch_price_history)
+    monkeypatch.setattr(utils.time, "sleep", other_worker)
+
+    assert utils._acquire_fetch_lock("LTCBTCday")
+    assert prefetch_prices([("XLM", "BTC", 1512950400),
+                            ("LTC", "BTC", 1512950400)]) == 1
+    assert requests == [("XLM", "BTC")]
+
+
+def test_name_price_unpriced(monkeypatch: MonkeyPatch, settings):
+    """
+    Tests that missing prices are cached and that the circuit breaker
+    of a pair stops requests after too many failures
+    """
+    settings.PRICE_BREAKER_THRESHOLD = 2
+    requests = []
+
+    def get_historical_price(base, target, timestamp):
+        requests.append((base, target, timestamp))
+        if base == "DEAD":
+            # the API answers with an error for delisted coins
+            return {"Response": "Error",
+                    "Message": "There is no data for the symbol DEAD ."}
+        return {base: {target: 0.5}}
+
+    patch_historical_price(monkeypatch, get_historical_price)
+
+    assert get_name_price(10, "DEAD", "BTC", 1512950400) == 0.0
+    result = utils.resolve_name_price(10, "DEAD", "BTC", 1512950400)
+    assert result == (0.0, False, "negative_cache")
+    assert len(requests) == 1
+
+    result = utils.resolve_name_price(10, "DEAD", "BTC", 1513036800)
+    assert result == (0.0, False, "error")
+    result = utils.resolve_name_price(10, "DEAD", "BTC", 1513123200)
+    assert result == (0.0, False, "circuit_open")
+    assert len(requests) == 2
+
+    # other pairs are not affected
+    assert utils.resolve_name_price(10, "XLM", "BTC", 1513123200) == \
+        (5.0, True, None)
+    assert utils.get_price_stats()["unpriced"] == 4
+
+
+def test_name_price_provider_error(monkeypatch: MonkeyPatch, settings):
+    """
+    Tests that failed requests are only skipped for a short time and
+    don't open the circuit breaker of the pair
+    """
+    settings.PRICE_BREAKER_THRESHOLD = 1
+    settings.PRICE_ERROR_TTL = 300
+    requests = []
+    responses = [None, None, {"XLM": {"BTC": 0.5}}]
+
+    def get_historical_price(base, target, timestamp):
+        requests.append(timestamp)
+        return responses.pop(0)  # failed requests are returned as None
+
+    patch_historical_price(monkeypatch, get_historical_price)
+
+    result = utils.resolve_name_price(10, "XLM", "BTC", 1512950400)
+    assert result == (0.0, False, "provider_error")
+    result = utils.resolve_name_price(10, "XLM", "BTC", 1512950400)
+    assert result == (0.0, False, "negative_cache")
+
+    settings.PRICE_ERROR_TTL = 0
+    result = utils.resolve_name_price(10, "XLM", "BTC", 1513036800)
+    assert result == (0.0, False, "provider_error")
+    assert utils.resolve_name_price(10, "XLM", "BTC", 1513036800) == \
+        (5.0, True, None)
+    assert requests == [1512950400, 1513036800, 1513036800]
+
+
+def test_offline_provider(settings):
+    """
+    Tests that the offline provider answers lookups without network
+    access, with the same prices every time and the configured errors
+    """
+    settings.PRICE_PROVIDER = \
+        "backend.utils.price_providers.OfflinePriceProvider"
+    settings.PRICE_PROVIDER_OPTIONS = {"error_rate": 0.5}
+    provider = utils.get_price_provider()
+    assert isinstance(provider, price_providers.OfflinePriceProvider)
+    assert utils.get_price_provider() is provider
+
+    history = provider.get_price_history("XLM", "BTC", 1512950400, 99,
+                                         "day")
+    assert 20 < len(history) < 80, "About half should be missing"
+    assert history == provider.get_price_history("XLM", "BTC", 1512950400,
+                                                 99, "day")
+    for bucket, price in history.items():
+        assert provider.get_price("XLM", "BTC", bucket, "day") == price
+        assert price > 0
+
+    prefetch_prices([("XLM", "BTC", bucket) for bucket in history])
+    requests = provider.requests
+    for bucket, price in history.items():
+        assert get_name_price(2, "XLM", "BTC", bucket) == 2 * price
+    assert provider.requests == requests
+
+    spot = provider.get_spot_prices(["BTC", "ETH"], ["EUR", "USD"])
+    assert all(price > 0 for prices in spot.values()
+               for price in prices.values())
+
+
+def test_incomplete_provider():
+    """
+    Tests that a provider has to implement the range and spot price
+    requests
+    """
+
+    class HistoryProvider(price_providers.PriceProvider):
+        def get_price_history(self, base, target, to_timestamp, limit,
+                              granularity):
+            return {}
+
+    with pytest.raises(TypeError):
+        HistoryProvider()  #pylint: disable=E0110
@@ -1,8 +1,29 @@
 """Contains various utility functions"""
 
+from collections import Counter, defaultdict, namedtuple
+from datetime import datetime, timezone
+import os
 import time
-import cryptocompare as cc
 from diskcache import FanoutCache
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from django.utils.module_loading import import_string
+
+from backend.coins.models import PriceCandle
+from backend.utils.cache import MemoryCache
+from backend.utils.price_providers import GRANULARITIES, PriceProvider
+from backend.utils.price_providers import PriceProviderError
+
+# the PriceCandle period each granularity is stored as
+# minute prices are only kept in the local cache
+CANDLE_PERIODS = {
+    "hour": PriceCandle.PERIOD_HOUR,
+    "day": PriceCandle.PERIOD_DAY
+}
+
+# maximum number of buckets a single histo* request can return
+HISTORY_LIMIT = 2000
 
 
 def exchange_can_batch(exchange: str) -> bool:
@@ -17,30 +38,659 @@ def exchange_can_batch(exchange: str) -> bool:
     return True
 
 
-# use a simple cache mechanism to avoid hammering the API
-CACHE = FanoutCache('/tmp/diskcache/fanoutcache')
+# use a simple cache mechanism to avoid hammering the API.
+# diskcache doesn't count the entries it culls while writing, so culling
+# on write is off and trim_price_cache evicts entries instead.
+CACHE = FanoutCache('/tmp/diskcache/fanoutcache', cull_limit=0)
+
+# in-process cache in front of the PriceCandle table and CACHE,
+# created on first use from the settings, see get_memory_cache
+MEMORY_CACHE = None
+
+# the price provider and the settings it was created from,
+# see get_price_provider
+PROVIDER = None
+
+# lookup counters of this process, see get_price_stats
+STATS = Counter()
+
+# seconds between two checks while waiting for a fetch lock
+FETCH_LOCK_POLL_INTERVAL = 0.1
+
+# result of resolve_name_price, reason is None if the lookup succeeded,
+# "error" if the API had no price, "provider_error" if the request
+# failed, "negative_cache" if it had none or the request failed
+# recently and "circuit_open" if requests for the pair are paused
+PriceResult = namedtuple("PriceResult", ["value", "priced", "reason"])
+
+
+class PriceUnavailable(Exception):
+    """Raised when a price can not be resolved"""
+
+    def __init__(self, reason: str):
+        super(PriceUnavailable, self).__init__(reason)
+        self.reason = reason
+
+
+def get_memory_cache() -> MemoryCache:
+    """
+    Returns the in-process price cache. Its size and the time to live
+    of its entries are configured with PRICE_MEMORY_CACHE_SIZE and
+    PRICE_MEMORY_CACHE_TTL.
+    """
+    global MEMORY_CACHE
+    if MEMORY_CACHE is None:
+        MEMORY_CACHE = MemoryCache(
+            getattr(settings, "PRICE_MEMORY_CACHE_SIZE", 10000),
+            getattr(settings, "PRICE_MEMORY_CACHE_TTL", 3600))
+    return MEMORY_CACHE
+
+
+def get_price_provider() -> PriceProvider:
+    """
+    Returns the provider all prices are requested from. It is selected
+    with PRICE_PROVIDER, the dotted path of a PriceProvider class,
+    and created with the keyword arguments in PRICE_PROVIDER_OPTIONS.
+    """
+    global PROVIDER
+    path = getattr(settings, "PRICE_PROVIDER",
+                   "backend.utils.price_providers.CryptoCompareProvider")
+    options = getattr(settings, "PRICE_PROVIDER_OPTIONS", {})
+    if PROVIDER is None or PROVIDER[0] != (path, options):
+        PROVIDER = ((path, options), import_string(path)(**options))
+    return PROVIDER[1]
+
+
+def get_price_granularity() -> str:
+    """Returns the configured price granularity (minute, hour or day)"""
+    granularity = getattr(settings, "PRICE_GRANULARITY", "day")
+    if granularity not in GRANULARITIES:
+        raise ValueError(
+            "PRICE_GRANULARITY must be one of minute, hour or day")
+    return granularity
+
+
+def get_bucket_timestamp(timestamp: float, granularity: str = None) -> int:
+    """
+    Returns the Unix timestamp of the UTC bucket timestamp is in
+
+    Keyword arguments:
+    timestamp -- Unix Timestamp to normalize
+    granularity -- minute, hour or day (default: PRICE_GRANULARITY)
+    """
+    size = GRANULARITIES[granularity or get_price_granularity()]
+    return int(timestamp) - int(timestamp) % size
+
+
+def get_day_timestamp(timestamp: float) -> int:
+    """Returns the Unix timestamp of 00:00 UTC of the day timestamp is in"""
+    return get_bucket_timestamp(timestamp, "day")
+
+
+def get_price_stats() -> dict:
+    """
+    Returns the price lookup counters of this process
+
+    lookups -- number of historical price lookups
+    memory -- hits, misses, evictions and size of the in-process cache
+    db -- hits and misses of the PriceCandle table
+    disk -- hits, misses and evictions of the local diskcache
+    triangulated -- lookups calculated through the pivot currency
+    unpriced -- lookups without a price
+    coalesced -- lookups answered by another worker's request
+    requests -- lookups that needed a request
+    hit_rate -- share of lookups answered without a request
+    """
+    memory = get_memory_cache()
+    lookups = STATS["lookups"]
+    return {
+        "lookups": lookups,
+        "memory": {
+            "hits": memory.hits,
+            "misses": memory.misses,
+            "evictions": memory.evictions,
+            "size": len(memory)
+        },
+        "db": {
+            "hits": STATS["db_hits"],
+            "misses": STATS["db_misses"]
+        },
+        "disk": {
+            "hits": STATS["disk_hits"],
+            "misses": STATS["disk_misses"],
+            "evictions": STATS["disk_evictions"]
+        },
+        "triangulated": STATS["triangulated"],
+        "unpriced": STATS["unpriced"],
+        "coalesced": STATS["coalesced"],
+        "requests": STATS["requests"],
+        "hit_rate": (lookups - STATS["requests"]) / lookups if lookups else 0.0
+    }
+
+
+def reset_price_stats():
+    """Resets the price lookup counters"""
+    STATS.clear()
+    get_memory_cache().reset_stats()
+
+
+def trim_price_cache() -> int:
+    """
+    Evicts the expired entries of the local diskcache and, if it is
+    larger than its size limit, the least recently stored ones
+
+    Returns the number of evicted entries
+    """
+    evicted = CACHE.expire() + CACHE.cull()
+    STATS["disk_evictions"] += evicted
+    return evicted
+
+
+def _price_key(base: str, target: str, granularity: str, bucket: int) -> str:
+    return "{}{}{}{}".format(base, target, granularity, bucket)
+
+
+def _lock_key(key: str) -> str:
+    return "lock" + key
+
+
+def _acquire_fetch_lock(key: str) -> bool:
+    """
+    Tries to take the fetch lock for a cache key. The lock lives in
+    CACHE, so it is shared by all threads and processes on this host.
+    It expires after PRICE_FETCH_LOCK_TIMEOUT seconds in case its
+    holder dies before releasing it.
+    """
+    timeout = getattr(settings, "PRICE_FETCH_LOCK_TIMEOUT", 30)
+    return CACHE.add(_lock_key(key), os.getpid(), expire=timeout)
+
+
+def _release_fetch_lock(key: str):
+    CACHE.delete(_lock_key(key))
+
+
+def _bucket_to_datetime(bucket: int) -> datetime:
+    return datetime.utcfromtimestamp(bucket).replace(tzinfo=timezone.utc)
+
+
+def get_stored_prices(base: str,
+                      target: str,
+                      buckets,
+                      granularity: str = "day") -> dict:
+    """
+    Reads the prices of a pair from the PriceCandle table
+
+    Keyword arguments:
+    base -- name to convert from
+    target -- name to convert to
+    buckets -- iterable with bucket timestamps
+    granularity -- hour or day, minutes are not stored (default: day)
+
+    Returns a dict mapping the found bucket timestamps to the close price
+    """
+    buckets = set(buckets)
+    if not buckets or granularity not in CANDLE_PERIODS:
+        return {}
+
+    # query the covered range, a huge IN clause is slower and
+    # exceeds SQLite's variable limit
+    candles = PriceCandle.objects.filter(
+        symbol=base,
+        quote=target,
+        period=CANDLE_PERIODS[granularity],
+        bucket__gte=_bucket_to_datetime(min(buckets)),
+        bucket__lte=_bucket_to_datetime(max(buckets))).values_list(
+            "bucket", "close")
+
+    prices = {}
+    for bucket, close in candles:
+        bucket = int(bucket.timestamp())
+        if bucket in buckets:
+            prices[bucket] = float(close)
+    return prices
+
+
+def store_prices(base: str,
+                 target: str,
+                 prices: dict,
+                 granularity: str = "day"):
+    """
+    Writes prices of a pair to the PriceCandle table.
+    Buckets already stored are left untouched.
+
+    Keyword arguments:
+    base -- name to convert from
+    target -- name to convert to
+    prices -- dict mapping bucket timestamps to the close price
+    granularity -- hour or day, minutes are not stored (default: day)
+    """
+    if granularity not in CANDLE_PERIODS:
+        return
+
+    stored = get_stored_prices(base, target, prices.keys(), granularity)
+    candles = [
+        PriceCandle(
+            symbol=base,
+            quote=target,
+            period=CANDLE_PERIODS[granularity],
+            bucket=_bucket_to_datetime(bucket),
+            close=close) for bucket, close in prices.items()
+        if bucket not in stored
+    ]
+    if not candles:
+        return
+
+    try:
+        with transaction.atomic():
+            PriceCandle.objects.bulk_create(candles)
+    except IntegrityError:
+        # another worker stored some of the buckets in the meantime
+        for candle in candles:
+            PriceCandle.objects.get_or_create(
+                symbol=candle.symbol,
+                quote=candle.quote,
+                period=candle.period,
+                bucket=candle.bucket,
+                defaults={"close": candle.close})
+
+
+def get_live_price(base: str, target: str) -> float:
+    """
+    Returns the current price of one base in target.
+    Live prices are cached for PRICE_LIVE_TTL seconds.
+
+    Keyword arguments:
+    base -- name to convert from
+    target -- name to convert to
+    """
+    key = "live" + base + target
+    val = CACHE.get(key, None)
+    if val is None:
+        request_res = get_price_provider().get_spot_prices([base], [target])
+        val = request_res.get(base, {}).get(target)
+        if not val:
+            raise PriceUnavailable("error")
+        CACHE.set(key, val, expire=getattr(settings, "PRICE_LIVE_TTL", 60))
+    return val
+
+
+def get_pivot_currency() -> str:
+    """Returns the currency fiat prices are triangulated through"""
+    return getattr(settings, "PRICE_PIVOT_CURRENCY", "BTC")
+
+
+def can_triangulate(base: str, target: str) -> bool:
+    """
+    Returns True if the price of base in target can be calculated as
+    base -> pivot currency x pivot currency -> target. This is the case
+    for all prices of a non fiat currency in a fiat currency.
+    """
+    fiat_currencies = getattr(settings, "PRICE_FIAT_CURRENCIES", ("EUR", ))
+    pivot = get_pivot_currency()
+    return (target in fiat_currencies and base not in fiat_currencies
+            and base != pivot and target != pivot)
+
+
+def _get_cached_price(base: str, target: str, granularity: str,
+                      bucket: int) -> float:
+    """
+    Looks a price up in the in-process cache, the PriceCandle table
+    and the local diskcache without making a request.
+    Returns None if none of them knows the price.
+    """
+    key = _price_key(base, target, granularity, bucket)
+    memory = get_memory_cache()
+    val = memory.get(key)
+    if val is not None:
+        return val
+
+    val = get_stored_prices(base, target, [bucket], granularity).get(bucket)
+    if val is not None:
+        STATS["db_hits"] += 1
+    else:
+        STATS["db_misses"] += 1
+        val = CACHE.get(key, None)
+        if val is None:
+            STATS["disk_misses"] += 1
+            return None
+        STATS["disk_hits"] += 1
+        store_prices(base, target, {bucket: val}, granularity)
+
+    memory.set(key, val)
+    return val
+
+
+def _negative_key(key: str) -> str:
+    return "unpriced" + key
+
+
+def _check_unpriced(base: str, target: str, key: str):
+    """
+    Raises PriceUnavailable if the price is known to be missing
+    or the circuit breaker of the pair is open
+    """
+    if CACHE.get(_negative_key(key), None) is not None:
+        raise PriceUnavailable("negative_cache")
+    if CACHE.get("breaker{}{}".format(base, target), None) is not None:
+        raise PriceUnavailable("circuit_open")
+
+
+def _record_failure(base: str, target: str, key: str):
+    """
+    Remembers that the API had no price for key for PRICE_NEGATIVE_TTL
+    seconds. After PRICE_BREAKER_THRESHOLD failures of a pair within
+    that time all requests for the pair are skipped for
+    PRICE_BREAKER_COOLDOWN seconds. The first failure after the cooldown
+    opens the breaker again.
+    """
+    negative_ttl = getattr(settings, "PRICE_NEGATIVE_TTL", 21600)
+    CACHE.set(_negative_key(key), True, expire=negative_ttl)
+
+    failures_key = "failures{}{}".format(base, target)
+    failures = CACHE.get(failures_key, 0) + 1
+    CACHE.set(failures_key, failures, expire=negative_ttl)
+    if failures >= getattr(settings, "PRICE_BREAKER_THRESHOLD", 3):
+        cooldown = getattr(settings, "PRICE_BREAKER_COOLDOWN", 600)
+        print("Pausing price requests for {} -> {} for {}s".format(
+            base, target, cooldown))
+        CACHE.set(
+            "breaker{}{}".format(base, target), True, expire=cooldown)
+
+
+def _record_error(key: str):
+    """
+    Skips key for PRICE_ERROR_TTL seconds after its request failed.
+    A failed request says nothing about the price, so it is not
+    counted as a failure of the pair, see _record_failure.
+    """
+    error_ttl = getattr(settings, "PRICE_ERROR_TTL", 300)
+    if error_ttl > 0:
+        CACHE.set(_negative_key(key), True, expire=error_ttl)
+
+
+def _fetch_price(base: str, target: str, granularity: str,
+                 bucket: int) -> float:
+    """
+    Requests a price from the API and stores it in all cache tiers.
+    Raises PriceUnavailable if the API has no price or the request
+    failed.
+    """
+    key = _price_key(base, target, granularity, bucket)
+    _check_unpriced(base, target, key)
+
+    STATS["requests"] += 1
+    try:
+        val = get_price_provider().get_price(base, target, bucket,
+                                             granularity)
+    except PriceProviderError as err:
+        print("Price request for {} -> {} failed: {}".format(
+            base, target, err))
+        _record_error(key)
+        raise PriceUnavailable("provider_error")
+
+    # unknown or delisted coins come back without a price or a price of 0
+    if not val:
+        _record_failure(base, target, key)
+        raise PriceUnavailable("error")
+
+    CACHE.delete("failures{}{}".format(base, target))
+    CACHE.add(key, val)
+    store_prices(base, target, {bucket: val}, granularity)
+    get_memory_cache().set(key, val)
+    return val
+
+
+def _resolve_price(base: str, target: str, granularity: str,
+                   bucket: int) -> float:
+    val = _get_cached_price(base, target, granularity, bucket)
+    if val is not None:
+        return val
+
+    if can_triangulate(base, target):
+        # The pivot price is needed for the BTC book price anyway and
+        # the pivot -> fiat price is shared by all currencies of a bucket
+        pivot = get_pivot_currency()
+        base_pivot = _get_cached_price(base, pivot, granularity, bucket)
+        if base_pivot is not None:
+            STATS["triangulated"] += 1
+            val = base_pivot * _resolve_price(pivot, target, granularity,
+                                              bucket)
+            get_memory_cache().set(
+                _price_key(base, target, granularity, bucket), val)
+            return val
+
+    return _fetch_price_once(base, target, granularity, bucket)
+
+
+def _fetch_price_once(base: str, target: str, granularity: str,
+                      bucket: int) -> float:
+    """
+    Fetches a price unless another worker is already fetching it.
+    Only the worker holding the fetch lock of the key requests it,
+    all others wait for the result to show up in CACHE. If the lock
+    holder fails the next waiter takes over, if it takes longer than
+    PRICE_FETCH_LOCK_TIMEOUT the waiter fetches the price itself.
+    """
+    key = _price_key(base, target, granularity, bucket)
+    deadline = time.time() + getattr(settings, "PRICE_FETCH_LOCK_TIMEOUT",
+                                     30)
+    while True:
+        if _acquire_fetch_lock(key):
+            try:
+                return _fetch_price(base, target, granularity, bucket)
+            finally:
+                _release_fetch_lock(key)
+
+        if time.time() > deadline:
+            return _fetch_price(base, target, granularity, bucket)
+
+        time.sleep(FETCH_LOCK_POLL_INTERVAL)
+        _check_unpriced(base, target, key)
+        val = CACHE.get(key, None)
+        if val is not None:
+            STATS["coalesced"] += 1
+            get_memory_cache().set(key, val)
+            return val
+
+
+def resolve_name_price(amount: float,
+                       base: str,
+                       target: str,
+                       timestamp: float = None) -> PriceResult:
+    """
+    Calculates the price of one name in another name.
+    Returns a PriceResult, if there is no price its value is 0.0
+    and reason tells why.
+
+    Timestamps are normalized to UTC buckets of PRICE_GRANULARITY,
+    all timestamps of the same bucket share one entry. Prices are
+    read from the in-process cache, then from the PriceCandle table
+    and the local diskcache and only fetched from the API when all
+    of them miss. Found prices are promoted into the in-process cache.
+    Concurrent misses of the same price, also from other processes,
+    are coalesced into one request.
+
+    Missing prices are remembered for PRICE_NEGATIVE_TTL seconds and
+    pairs that keep failing are not requested for a while, so a sync
+    does not stall on unknown or delisted coins. Failed requests are
+    only skipped for PRICE_ERROR_TTL seconds.
+
+    A fiat price of a currency whose price in the pivot currency
+    (PRICE_PIVOT_CURRENCY) is known is calculated through the pivot
+    currency instead of being requested.
+
+    Keyword arguments:
+    amount -- amount to convert
+    base -- name to convert from
+    target -- name to convert to
+    timestamp -- historic date as a Unix Timestamp
+                 (default: None, the live price)
+    """
+    try:
+        if timestamp is None:
+            return PriceResult(amount * get_live_price(base, target), True,
+                               None)
+
+        STATS["lookups"] += 1
+        granularity = get_price_granularity()
+        bucket = get_bucket_timestamp(timestamp, granularity)
+        return PriceResult(
+            amount * _resolve_price(base, target, granularity, bucket),
+            True, None)
+    except PriceUnavailable as err:
+        STATS["unpriced"] += 1
+        print("No price for {} -> {} at {}: {}".format(
+            base, target, timestamp, err.reason))
+        return PriceResult(0.0, False, err.reason)
 
 
 def get_name_price(amount: float,
                    base: str,
                    target: str,
-                   timestamp: float = time.time()) -> float:
+                   timestamp: float = None) -> float:
     """
     Calculated the price of one name in another name.
-    Returns a float with the converted value as a decimal.Decimal
+    Returns a float with the converted value, 0.0 if there is no price.
+    See resolve_name_price.
 
     Keyword arguments:
     amount -- amount to convert
     base -- name to convert from
     target -- name to convert to
-    date -- historic date as a Unix Timestamp (default: time.time())
+    timestamp -- historic date as a Unix Timestamp
+                 (default: None, the live price)
+    """
+    return resolve_name_price(amount, base, target, timestamp).value
+
+
+def fetch_price_histories(requests: list) -> list:
+    """
+    Fetches the close prices of several ranges of buckets from the
+    price provider, see PriceProvider.get_price_histories.
+
+    Keyword arguments:
+    requests -- list of (base, target, to_timestamp, limit, granularity)
+                tuples
+
+    Returns a list with one dict per request mapping the bucket
+    timestamps to the close price
     """
-    key = base + target + str(timestamp)
-    request_res = CACHE.get(key, None)
-    if request_res is None:
-        request_res = cc.get_historical_price(base, target, timestamp)
-        CACHE.add(key, request_res)
+    return get_price_provider().get_price_histories(requests)
+
+
+def prefetch_prices(lookups) -> int:
+    """
+    Resolves the prices for a whole import batch with as few requests
+    as possible. Lookups are reduced to PRICE_GRANULARITY buckets,
+    duplicates and stored buckets are dropped and the remaining buckets
+    of each pair are filled with range requests, which are all
+    submitted at once. get_name_price will afterwards find them in the
+    PriceCandle table or the local cache.
+
+    Fiat prices that can be triangulated are resolved by fetching the
+    price in the pivot currency and the pivot currency's fiat price.
+    Buckets without data are left out and fall back to a single lookup
+    in get_name_price. A pair that another worker is fetching right now
+    is only checked again after it is done.
+
+    Keyword arguments:
+    lookups -- iterable with (base, target, timestamp) tuples
+
+    Returns the number of requests made
+    """
+    granularity = get_price_granularity()
+    pivot = get_pivot_currency()
+    pairs = defaultdict(set)
+    for base, target, timestamp in lookups:
+        if not base or not target or base == target:
+            continue
+
+        bucket = get_bucket_timestamp(timestamp, granularity)
+        if can_triangulate(base, target):
+            # fetch both legs, the pivot leg is shared by all currencies
+            pairs[(base, pivot)].add(bucket)
+            pairs[(pivot, target)].add(bucket)
+        else:
+            pairs[(base, target)].add(bucket)
+
+    # Pairs another worker is fetching are retried once its fetch lock
+    # is released, by then their buckets are usually stored
+    deadline = time.time() + getattr(settings, "PRICE_FETCH_LOCK_TIMEOUT",
+                                     30)
+    num_requests = 0
+    while pairs:
+        locks = []
+        owned = {}
+        for (base, target), buckets in pairs.items():
+            key = "{}{}{}".format(base, target, granularity)
+            if _acquire_fetch_lock(key):
+                locks.append(key)
+                owned[(base, target)] = buckets
+            elif time.time() > deadline:
+                owned[(base, target)] = buckets
+
+        try:
+            num_requests += _fetch_ranges(owned, granularity)
+        finally:
+            for key in locks:
+                _release_fetch_lock(key)
+
+        pairs = {
+            pair: buckets
+            for pair, buckets in pairs.items() if pair not in owned
+        }
+        if pairs:
+            time.sleep(FETCH_LOCK_POLL_INTERVAL)
+
+    # a batch stores many prices, keep the cache within its limits
+    trim_price_cache()
+    return num_requests
+
+
+def _fetch_ranges(pairs: dict, granularity: str) -> int:
+    """
+    Fetches the buckets of each pair that are not cached or stored yet
+    with as few range requests as possible, see prefetch_prices.
+
+    Keyword arguments:
+    pairs -- dict mapping (base, target) tuples to sets of buckets
+    granularity -- minute, hour or day
+
+    Returns the number of requests made
+    """
+    size = GRANULARITIES[granularity]
+    memory = get_memory_cache()
+    requests = []
+    requested_buckets = []
+    for (base, target), buckets in pairs.items():
+        buckets = [
+            bucket for bucket in buckets if memory.get(
+                _price_key(base, target, granularity, bucket)) is None
+        ]
+        stored = get_stored_prices(base, target, buckets, granularity)
+        buckets = sorted(
+            bucket for bucket in buckets if bucket not in stored
+            and CACHE.get(_price_key(base, target, granularity, bucket),
+                          None) is None)
+        while buckets:
+            # one request covers up to HISTORY_LIMIT buckets
+            last_bucket = buckets[0] + HISTORY_LIMIT * size
+            chunk = [bucket for bucket in buckets if bucket <= last_bucket]
+            buckets = buckets[len(chunk):]
+
+            limit = (chunk[-1] - chunk[0]) // size
+            requests.append((base, target, chunk[-1], limit, granularity))
+            requested_buckets.append(set(chunk))
 
-    val = request_res[base][target]
+    histories = fetch_price_histories(requests)
+    for request, requested, history in zip(requests, requested_buckets,
+                                           histories):
+        base, target = request[0], request[1]
+        for bucket, val in history.items():
+            key = _price_key(base, target, granularity, bucket)
+            CACHE.set(key, val)
+            if bucket in requested:
+                memory.set(key, val)
+        store_prices(base, target, history, granularity)
 
-    return amount * val
+    return len(requests)